@@ -1,21 +1,39 @@
-from fastapi import FastAPI, HTTPException, Form, Depends, Security # ✨ Agrega Depends, Security
-from fastapi.responses import HTMLResponse, JSONResponse 
+from fastapi import FastAPI, HTTPException, Form, Depends, Security, Request, Header # ✨ Agrega Depends, Security
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer # ✨ NUEVO
-from pydantic import BaseModel, field_validator
+from pydantic import BaseModel, ConfigDict, TypeAdapter, field_validator, model_validator
+from functools import cached_property
 from typing import Dict, List, Union, Optional, Annotated # ✨ Agrega Annotated
-from datetime import datetime, timedelta # ✨ Agrega timedelta
+from datetime import datetime, timedelta, timezone # ✨ Agrega timedelta
+from urllib.parse import urlsplit
 import os
+import re
+import base64
+import hashlib
+import hmac
+import math
+import bisect
 import logging
 import httpx
 import asyncio
 import json
 import uuid
+import itertools
+from collections import deque
+from enum import Enum
 import time
-import pika
-import redis 
+import aio_pika # Cliente AMQP asíncrono: los consumidores corren en el loop de la app
+import redis.asyncio as aioredis # Cliente Redis asíncrono (pool compartido)
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from contextvars import ContextVar
+from contextlib import nullcontext
 import jwt # ✨ NUEVO (pip install pyjwt)
 from passlib.context import CryptContext # ✨ NUEVO (pip install passlib)
-from threading import Thread
+try:
+    import h2 # noqa: F401 -- Opcional (httpx[http2]): habilita HTTP/2 hacia las sucursales
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
 
 # --- CONFIGURACIÓN Y MODELOS ---
 logging.basicConfig(level=logging.INFO)
@@ -24,13 +42,163 @@ logger = logging.getLogger(__name__)
 # [CONFIGURACIÓN REDIS]
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+# Pool de conexiones compartido por toda la app (se crea en startup y se cierra en shutdown)
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "2.0")) # Espera máxima por una conexión libre
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", "1.0"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "1.0")) # Timeout por comando
+# Caída de Redis: se deja de intentar (fail fast) y un sondeo de fondo con backoff detecta la vuelta
+REDIS_PROBE_MAX_BACKOFF = float(os.getenv("REDIS_PROBE_MAX_BACKOFF", "30"))
+# Última foto buena de inventario/ventas (se sirve marcada como desactualizada mientras Redis no responde)
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "") # Opcional: archivo local para sobrevivir a un reinicio sin Redis
+SNAPSHOT_SAVE_INTERVAL = float(os.getenv("SNAPSHOT_SAVE_INTERVAL", "30"))
+SNAPSHOT_SALES_LIMIT = 100 # Ventas recientes que se conservan (las que muestra el dashboard)
 TOTAL_USERS_KEY = "global_user_count" 
 USERS_HASH_KEY = "global_user_data" 
 
 # [NUEVO] Claves de Redis para el estado compartido
 INVENTORY_HASH_KEY = "central_inventory"
-SALES_LIST_KEY = "central_sales_history"
+# El stock vive en un hash aparte para poder decrementarlo con HINCRBY/HSET sin reescribir el JSON del producto
+INVENTORY_STOCK_HASH_KEY = "central_inventory_stock"
+# Contador de versión del inventario: se incrementa en cada cambio de producto o de stock
+INVENTORY_VERSION_KEY = "central_inventory_version"
+# Canal pub/sub por el que cada cambio de producto/stock se anuncia a todas las instancias de la Central
+INVENTORY_EVENTS_CHANNEL = "central_inventory_events"
+# Eventos que llegan adelantados (p. ej. el propio v+2 antes que el v+1 de otra instancia) esperan a que se cierre el hueco
+INVENTORY_GAP_GRACE_SECONDS = float(os.getenv("INVENTORY_GAP_GRACE_SECONDS", "1.0"))
+INVENTORY_GAP_MAX_PENDING = 1000 # Más eventos en espera que esto: se recarga la foto sin esperar
+# Changelog del inventario: stream cuyo ID de entrada es la versión ("<v>-0"); las sucursales piden deltas desde su versión
+INVENTORY_CHANGELOG_KEY = "central_inventory_changelog"
+INVENTORY_CHANGELOG_MAXLEN = int(os.getenv("INVENTORY_CHANGELOG_MAXLEN", "10000"))
+INVENTORY_CHANGES_MAX = int(os.getenv("INVENTORY_CHANGES_MAX", "500")) # Más cambios pendientes que esto: se responde con la foto
+INVENTORY_LONG_POLL_MAX_SECONDS = 30.0
+# Canales pub/sub que alimentan el stream SSE de los dashboards (GET /events), junto con el de inventario
+DASHBOARD_SALES_CHANNEL = "central_dashboard_sales"
+DASHBOARD_USERS_CHANNEL = "central_dashboard_users"
+DASHBOARD_SSE_MAX_CLIENTS = int(os.getenv("DASHBOARD_SSE_MAX_CLIENTS", "200")) # Por instancia
+DASHBOARD_SSE_QUEUE_SIZE = 256 # Eventos pendientes por cliente; si se llena, el cliente recibe 'resync'
+DASHBOARD_SSE_KEEPALIVE_SECONDS = 15.0
+# [NUEVO] Historial de ventas como Redis Stream (reemplaza la LIST recortada a 1000 ventas)
+SALES_STREAM_KEY = "central_sales_stream"
+LEGACY_SALES_LIST_KEY = "central_sales_history" # LIST anterior; se migra al stream una sola vez en startup
+SALES_RETENTION_DAYS = int(os.getenv("SALES_RETENTION_DAYS", "30")) # Retención por antigüedad (MINID ~)
+SALES_STREAM_MAXLEN = int(os.getenv("SALES_STREAM_MAXLEN", "0")) # Si > 0, se recorta por cantidad (MAXLEN ~)
+SALES_PAGE_MAX = 500
+# [NUEVO] Agregados de ventas mantenidos en escritura (excluyen ventas de prueba)
+SALES_STATS_KEY = "central_sales_stats" # revenue, count, units
+SALES_STATS_UNITS_KEY = "central_sales_stats:units_by_product"
+SALES_STATS_BRANCH_KEY = "central_sales_stats:revenue_by_branch"
+SALES_STATS_HOURLY_KEY = "central_sales_stats:hourly" # campos "<YYYY-MM-DDTHH>|revenue" y "<YYYY-MM-DDTHH>|count"
+SALES_STATS_MAX_HOURS = 24 * 31 # Ventana legible por GET /stats; los buckets más viejos se borran en segundo plano
+SALES_STATS_PRUNE_INTERVAL_SECONDS = 3600
+# Idempotencia compacta: Bloom filter rotativo por ventana (reemplaza una clave sale_lock:{sale_id} por venta).
+# Se consultan la generación actual y la anterior, así una venta se reconoce durante 1 a 2 ventanas.
+# Un falso positivo descartaría una venta real como duplicada: DEDUP_FP_RATE debe ser muy bajo.
+DEDUP_WINDOW_SECONDS = int(os.getenv("DEDUP_WINDOW_SECONDS", "3600"))
+DEDUP_EXPECTED_ITEMS = int(os.getenv("DEDUP_EXPECTED_ITEMS", "1000000")) # Ventas/eventos esperados por ventana
+DEDUP_FP_RATE = float(os.getenv("DEDUP_FP_RATE", "1e-6"))
+DEDUP_BLOOM_BITS = math.ceil(-DEDUP_EXPECTED_ITEMS * math.log(DEDUP_FP_RATE) / math.log(2) ** 2)
+DEDUP_BLOOM_HASHES = max(1, round(DEDUP_BLOOM_BITS / DEDUP_EXPECTED_ITEMS * math.log(2)))
+SALE_DEDUP_KEY_PREFIX = "sale_dedup"
+USER_EVENT_DEDUP_KEY_PREFIX = "user_event_dedup"
+SALE_BATCH_MAX = int(os.getenv("SALE_BATCH_MAX", "1000")) # Máximo de ventas por POST /sale-notifications/batch
 TEST_PRODUCT_ID = 999
+# [NUEVO] Tráfico de prueba (producto 999, sucursales TEST-*) aislado del real: historial y Bloom propios,
+# su propia cola/consumidor y un cupo HTTP. Una prueba de carga no debe frenar las ventas reales.
+TEST_SALES_STREAM_KEY = "central_sales_stream:test"
+TEST_SALES_STREAM_MAXLEN = int(os.getenv("TEST_SALES_STREAM_MAXLEN", "10000"))
+TEST_SALE_DEDUP_KEY_PREFIX = "sale_dedup_test"
+TEST_SALE_CONSUMER_CONCURRENCY = int(os.getenv("TEST_SALE_CONSUMER_CONCURRENCY", "2"))
+TEST_SALE_CONSUMER_BATCH_SIZE = int(os.getenv("TEST_SALE_CONSUMER_BATCH_SIZE", "20"))
+TEST_HTTP_CONCURRENCY = int(os.getenv("TEST_HTTP_CONCURRENCY", "4")) # Peticiones HTTP de prueba simultáneas
+TEST_SYNC_CONCURRENCY = int(os.getenv("TEST_SYNC_CONCURRENCY", "1")) # Sincronizaciones con sucursales de ventas de prueba
+
+# [CONFIGURACIÓN CONSUMIDORES AMQP]
+# prefetch_count acota los mensajes sin ack por consumidor; la concurrencia son los "carriles" que procesan en paralelo.
+# Las ventas de un mismo producto siempre caen en el mismo carril (orden preservado para el stock).
+RABBITMQ_PREFETCH_COUNT = int(os.getenv("RABBITMQ_PREFETCH_COUNT", "400")) # Debe alcanzar para llenar los micro-lotes
+SALE_CONSUMER_CONCURRENCY = int(os.getenv("SALE_CONSUMER_CONCURRENCY", "16"))
+USER_CONSUMER_CONCURRENCY = int(os.getenv("USER_CONSUMER_CONCURRENCY", "4"))
+# Micro-lotes de ventas: se confirman en un solo script de Redis y con un único basic_ack(multiple=True)
+SALE_CONSUMER_BATCH_SIZE = int(os.getenv("SALE_CONSUMER_BATCH_SIZE", "100"))
+SALE_CONSUMER_BATCH_WINDOW_MS = float(os.getenv("SALE_CONSUMER_BATCH_WINDOW_MS", "5"))
+# Prioridad: mientras los consumidores de ventas reales tengan al menos estos mensajes en vuelo, el de prueba espera
+REAL_SALES_SATURATION_IN_FLIGHT = int(os.getenv("REAL_SALES_SATURATION_IN_FLIGHT", str(SALE_CONSUMER_CONCURRENCY)))
+TEST_SALES_YIELD_SECONDS = 0.05
+CONSUMER_RETRY_DELAY_SECONDS = 1.0 # Consumidores sin colas de reintento: pausa antes de devolver el mensaje a la cola
+# Reintentos de ventas: colas de espera con TTL que devuelven el mensaje a su cola (el broker lleva los timers).
+# Tras SALE_RETRY_MAX_ATTEMPTS intentos (o si el mensaje es inválido) va al "parking lot" para revisión manual.
+SALE_RETRY_DELAYS_SECONDS = [int(d) for d in os.getenv("SALE_RETRY_DELAYS_SECONDS", "1,10,60").split(",")]
+SALE_RETRY_MAX_ATTEMPTS = int(os.getenv("SALE_RETRY_MAX_ATTEMPTS", "5"))
+SALES_PARKING_LOT_QUEUE = os.getenv("RABBITMQ_QUEUE_PARKING_LOT", "ventas_central.parking_lot")
+RETRY_COUNT_HEADER = "x-retry-count"
+# Consumo de ventas del fanout:
+#   broadcast   -> cada instancia tiene su propia cola y recibe TODAS las ventas (la idempotencia descarta la copia)
+#   partitioned -> un exchange x-consistent-hash (enlazado al fanout) reparte por product_id entre colas durables
+#                  fijas; cada instancia consume solo las particiones que le tocan (plugin rabbitmq_consistent_hash_exchange)
+SALES_CONSUMPTION_MODE = os.getenv("SALES_CONSUMPTION_MODE", "broadcast")
+SALES_PARTITIONS = int(os.getenv("SALES_PARTITIONS", "8"))
+EXCHANGE_SALES_PARTITIONED = os.getenv("RABBITMQ_EXCHANGE_PARTITIONED", "ventas_particionadas")
+SALES_PARTITION_QUEUE_PREFIX = "ventas_central_part"
+# Membresía de instancias en Redis (ZSET instancia -> último heartbeat) para repartir las particiones
+SALES_CONSUMERS_KEY = "central_sales_consumers"
+MEMBERSHIP_HEARTBEAT_SECONDS = float(os.getenv("MEMBERSHIP_HEARTBEAT_SECONDS", "5"))
+MEMBERSHIP_TTL_SECONDS = float(os.getenv("MEMBERSHIP_TTL_SECONDS", "15"))
+# Colas por instancia (copia del fanout de ventas y eventos de usuario): '{cola}.{SERVER_NAME}', durables.
+# Sobreviven a reconexiones y reinicios, así que SERVER_NAME debe ser único y estable por instancia.
+#   quorum -> replicada y en disco (por defecto)
+#   lazy   -> clásica con x-queue-mode=lazy: el backlog va directo a disco, no a la RAM del broker
+INSTANCE_QUEUE_TYPE = os.getenv("RABBITMQ_INSTANCE_QUEUE_TYPE", "quorum")
+INSTANCE_QUEUE_MAX_LENGTH = int(os.getenv("RABBITMQ_INSTANCE_QUEUE_MAX_LENGTH", "1000000"))
+# reject-publish: con la cola llena el broker rechaza la publicación del fanout (nack al publicador con confirmaciones).
+# Los reintentos de ventas no vuelven por la cola de la instancia, así que un desborde no descarta reintentos.
+INSTANCE_QUEUE_OVERFLOW = os.getenv("RABBITMQ_INSTANCE_QUEUE_OVERFLOW", "reject-publish") # o drop-head
+INSTANCE_QUEUE_EXPIRES_HOURS = float(os.getenv("RABBITMQ_INSTANCE_QUEUE_EXPIRES_HOURS", "72")) # Instancia retirada: el broker borra su cola
+
+# [CONFIGURACIÓN SINCRONIZACIÓN CON SUCURSALES]
+# Se lee una sola vez; todas las rutas de sincronización comparten el mismo cliente HTTP (keep-alive)
+BRANCHES = [url.strip().rstrip("/") for url in os.getenv("BRANCHES", "http://sucursal-demo:8002").split(",") if url.strip()]
+SYNC_HTTP2 = os.getenv("SYNC_HTTP2", "1") == "1" # Solo aplica a sucursales https (ALPN) y si 'h2' está instalado
+SYNC_MAX_CONNECTIONS_PER_BRANCH = int(os.getenv("SYNC_MAX_CONNECTIONS_PER_BRANCH", "10"))
+SYNC_KEEPALIVE_EXPIRY = float(os.getenv("SYNC_KEEPALIVE_EXPIRY", "30"))
+SYNC_CONNECT_TIMEOUT = float(os.getenv("SYNC_CONNECT_TIMEOUT", "1.0"))
+SYNC_READ_TIMEOUT = float(os.getenv("SYNC_READ_TIMEOUT", "3.0"))
+SYNC_POOL_TIMEOUT = float(os.getenv("SYNC_POOL_TIMEOUT", "2.0")) # Espera máxima por una conexión libre
+SYNC_FANOUT_CONCURRENCY = int(os.getenv("SYNC_FANOUT_CONCURRENCY", "64")) # Peticiones simultáneas a sucursales (entre todas)
+SYNC_REQUEST_DEADLINE_SECONDS = float(os.getenv("SYNC_REQUEST_DEADLINE_SECONDS", "5.0")) # Plazo de cada fase: espera de turno y petición (por separado)
+# Circuit breaker por sucursal: una sucursal caída se salta al instante en vez de esperar el timeout en cada envío
+BRANCH_CB_WINDOW = int(os.getenv("BRANCH_CB_WINDOW", "20")) # Últimos resultados para la tasa de error
+BRANCH_CB_MIN_REQUESTS = int(os.getenv("BRANCH_CB_MIN_REQUESTS", "5")) # Mínimo de resultados para juzgar la tasa
+BRANCH_CB_ERROR_RATE = float(os.getenv("BRANCH_CB_ERROR_RATE", "0.5"))
+BRANCH_CB_CONSECUTIVE_FAILURES = int(os.getenv("BRANCH_CB_CONSECUTIVE_FAILURES", "3")) # Abre antes si la sucursal no responde nada
+BRANCH_CB_OPEN_SECONDS = float(os.getenv("BRANCH_CB_OPEN_SECONDS", "5")) # Primera espera antes de la prueba half-open
+BRANCH_CB_MAX_OPEN_SECONDS = float(os.getenv("BRANCH_CB_MAX_OPEN_SECONDS", "60")) # Se duplica en cada prueba fallida hasta este tope
+BRANCH_LATENCY_EWMA_ALPHA = 0.2
+# Registro dinámico: cada sucursal se anuncia con heartbeats; BRANCHES queda como semilla fija siempre incluida
+BRANCH_REGISTRY_KEY = "central_branch_registry" # ZSET url -> último heartbeat (epoch)
+BRANCH_REGISTRY_IDS_KEY = "central_branch_registry:ids" # url -> branch_id
+BRANCH_TTL_SECONDS = float(os.getenv("BRANCH_TTL_SECONDS", "30")) # Sin heartbeat en este tiempo la sucursal sale del registro
+BRANCH_REGISTRY_REFRESH_SECONDS = float(os.getenv("BRANCH_REGISTRY_REFRESH_SECONDS", "5"))
+# Una sucursal registrada recibe todas las ventas: el alta exige el secreto compartido (X-Branch-Token)
+# y, si se define la lista, solo se aceptan URLs hacia esos hosts. Sin secreto no hay registro dinámico.
+BRANCH_REGISTRATION_SECRET = os.getenv("BRANCH_REGISTRATION_SECRET", "")
+BRANCH_ALLOWED_HOSTS = {host.strip().lower() for host in os.getenv("BRANCH_ALLOWED_HOSTS", "").split(",") if host.strip()}
+
+# [OUTBOX HACIA SUCURSALES] Las ventas reales y los cambios de inventario se escriben en un stream durable
+# en el mismo script que los confirma; un despachador de fondo los entrega a cada sucursal en orden,
+# con un cursor por sucursal (hash) y un lease por sucursal para que solo una instancia le entregue a la vez.
+OUTBOX_STREAM_KEY = "central_branch_outbox"
+OUTBOX_CURSORS_KEY = "central_branch_outbox:cursors" # sucursal -> ID de la última entrada entregada
+OUTBOX_LEASE_KEY_PREFIX = "central_branch_outbox:lease"
+OUTBOX_MAXLEN = int(os.getenv("OUTBOX_MAXLEN", "100000")) # Tope de seguridad si una sucursal queda caída mucho tiempo
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "200"))
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "10"))
+OUTBOX_IDLE_POLL_SECONDS = float(os.getenv("OUTBOX_IDLE_POLL_SECONDS", "0.2")) # Consulta del final del outbox (una por instancia)
+OUTBOX_RETRY_MAX_BACKOFF = float(os.getenv("OUTBOX_RETRY_MAX_BACKOFF", "30"))
+OUTBOX_TRIM_INTERVAL_SECONDS = 60
+# Las sucursales traen el inventario por GET /inventory/changes; el push por el outbox queda para las que no lo hacen
+INVENTORY_PUSH_TO_BRANCHES = os.getenv("INVENTORY_PUSH_TO_BRANCHES", "0") == "1"
+SALE_HISTORY_PATH = "/sync-sale-history"
 
 # [NUEVO TALLER 7] --- CONFIGURACIÓN DE SEGURIDAD (JWT) ---
 SECRET_KEY = os.getenv("JWT_SECRET", "mi_super_clave_secreta_ecomarket_2025") 
@@ -43,22 +211,116 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 # Esquema de autenticación
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
-def get_redis_client():
-    """Retorna el cliente Redis, decodificando respuestas para obtener strings."""
-    try:
-        r = redis.StrictRedis(
-            host=REDIS_HOST, 
-            port=REDIS_PORT, 
-            decode_responses=True, # Decodifica automáticamente de bytes a string
-            socket_connect_timeout=1
-        )
-        r.ping() 
-        return r
-    except Exception as e:
-        logger.error(f"❌ Fallo al conectar a Redis: {e}")
-        return None 
+redis_pool: Optional[aioredis.BlockingConnectionPool] = None
+redis_client: Optional[aioredis.Redis] = None
+
+def init_redis_pool():
+    """Crea el pool de conexiones Redis de la app. No abre conexiones hasta el primer comando."""
+    global redis_pool, redis_client
+    redis_pool = aioredis.BlockingConnectionPool(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        decode_responses=True, # Decodifica automáticamente de bytes a string
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+        health_check_interval=30, # Solo hace PING si la conexión estuvo inactiva, no en cada llamada
+    )
+    redis_client = aioredis.Redis(connection_pool=redis_pool)
+
+async def close_redis_pool():
+    global redis_pool, redis_client
+    if redis_client:
+        await redis_client.aclose()
+    if redis_pool:
+        await redis_pool.aclose()
+    redis_client = None
+    redis_pool = None
+
+def get_redis_client() -> Optional[aioredis.Redis]:
+    """
+    Retorna el cliente Redis compartido (None si el pool aún no fue creado o si Redis está caído).
+    Mientras está caído no se paga el connect timeout en cada petición: el sondeo de fondo avisa cuando vuelve.
+    """
+    return redis_client if redis_health["up"] else None
+
+redis_health = {"up": True, "down_since": None}
+redis_down_event = asyncio.Event() # Despierta al sondeo de salud
+
+def note_redis_error(e: Exception):
+    """Si el error es de conexión/timeout, marca Redis como caído (los demás errores no cambian el estado)."""
+    if not isinstance(e, (RedisConnectionError, RedisTimeoutError, ConnectionError, OSError)):
+        return
+    if redis_health["up"]:
+        redis_health.update(up=False, down_since=time.time())
+        redis_down_event.set()
+        if inventory_cache.ready:
+            # Sin Redis la caché ya no recibe eventos: pasa a ser la foto buena (y se sirve como tal)
+            remember_inventory(inventory_cache.version, inventory_cache.products.values())
+            inventory_cache.invalidate()
+        logger.error(f"🔌 [{SERVER_NAME}] Redis no responde ({e}). Sirviendo la última foto buena hasta que vuelva.")
+
+def mark_redis_up():
+    if not redis_health["up"]:
+        logger.info(f"✅ [{SERVER_NAME}] Redis disponible de nuevo tras {time.time() - redis_health['down_since']:.1f}s.")
+    redis_health.update(up=True, down_since=None)
+    redis_down_event.clear()
+
+async def redis_health_probe():
+    """Tarea de fondo: cuando Redis está marcado como caído, hace PING con backoff exponencial hasta que responda."""
+    backoff = 0.5
+    while True:
+        await redis_down_event.wait()
+        await asyncio.sleep(backoff)
+        try:
+            if redis_client is None:
+                raise RedisConnectionError("pool no inicializado")
+            await redis_client.ping()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            backoff = min(backoff * 2, REDIS_PROBE_MAX_BACKOFF)
+            logger.warning(f"⚠️ [{SERVER_NAME}] Redis sigue sin responder ({e}). Próximo intento en {backoff:.1f}s")
+            continue
+        backoff = 0.5
+        mark_redis_up()
+
+# Estado por petición: los accesos a datos anotan aquí si sirvieron la foto vieja.
+# Es un dict mutable para que también lo vean los endpoints síncronos (contexto copiado en el threadpool).
+response_staleness: ContextVar[Optional[dict]] = ContextVar("response_staleness", default=None)
+
+def mark_response_stale(saved_at: float):
+    state = response_staleness.get()
+    if state is not None:
+        state["saved_at"] = min(state.get("saved_at", saved_at), saved_at) # Se informa el dato más viejo
+
+class StaleDataHeaderMiddleware:
+    """Middleware ASGI puro: si la respuesta usó datos de la última foto buena, agrega X-Data-Stale y X-Data-Age."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        state = {}
+        token = response_staleness.set(state)
+
+        async def send_with_staleness(message):
+            if message["type"] == "http.response.start" and "saved_at" in state:
+                age = max(0, int(time.time() - state["saved_at"]))
+                headers = [*message.get("headers", []), (b"x-data-stale", b"true"), (b"x-data-age", str(age).encode())]
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_staleness)
+        finally:
+            response_staleness.reset(token)
 
 SERVER_NAME = os.getenv("SERVER_NAME", "CENTRAL_UNNAMED")
+INSTANCE_ID = f"{SERVER_NAME}:{uuid.uuid4().hex[:8]}" # Único aunque dos réplicas compartan SERVER_NAME
 
 app = FastAPI(
     title=f"🌿 EcoMarket Central API ({SERVER_NAME})",
@@ -67,6 +329,7 @@ app = FastAPI(
     docs_url="/docs",
     redoc_url="/redoc"
 )
+app.add_middleware(StaleDataHeaderMiddleware)
 
 # --- Modelos Pydantic ---
 class Product(BaseModel):
@@ -75,7 +338,37 @@ class Product(BaseModel):
     price: float
     stock: int
 
+def _parse_timestamp_fallback(v: str) -> datetime:
+    """Ruta lenta original: formatos no ISO o con microsegundos variables."""
+    # Añadir 'Z' si no tiene zona horaria para compatibilidad ISO
+    if not v.endswith('Z') and '+' not in v and '-' not in v[10:]:
+         v += 'Z'
+    try:
+        # Intenta parsear el formato ISO estándar
+        return datetime.fromisoformat(v.replace('Z', '+00:00'))
+    except ValueError:
+        try:
+            # Fallback para formatos con microsegundos variables
+            return datetime.strptime(v, '%Y-%m-%dT%H:%M:%S.%f%z')
+        except Exception:
+            logger.warning(f"Timestamp no ISO, usando now(): {v}")
+            return datetime.now() # O maneja el error como prefieras
+
+def parse_sale_timestamp(v: str) -> datetime:
+    """Ruta rápida ISO-8601: un solo fromisoformat; sin zona horaria se asume UTC (igual que antes)."""
+    try:
+        dt = datetime.fromisoformat(v[:-1] + '+00:00' if v.endswith('Z') else v)
+    except ValueError:
+        return _parse_timestamp_fallback(v)
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
 class SaleNotification(BaseModel):
+    """
+    Venta validada UNA sola vez en el borde (HTTP o AMQP). Es inmutable: el mismo objeto
+    recorre commit, historial y sincronización sin model_dump()/re-validación intermedios.
+    """
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     sale_id: Optional[str] = None 
     branch_id: str
     product_id: int
@@ -85,26 +378,39 @@ class SaleNotification(BaseModel):
     total_amount: float
     change: Optional[float] = None
 
+    @model_validator(mode="before")
+    @classmethod
+    def zero_test_product_amounts(cls, data):
+        # Las ventas del producto de test no suman dinero (antes se mutaba el objeto en process_sale_notification)
+        if isinstance(data, dict) and str(data.get("product_id")) == str(TEST_PRODUCT_ID):
+            data = {**data, "total_amount": 0.0, "money_received": 0.0, "change": 0.0}
+        return data
+
     @field_validator("timestamp", mode="before")
     def parse_timestamp(cls, v):
         if isinstance(v, str):
-            # Añadir 'Z' si no tiene zona horaria para compatibilidad ISO
-            if not v.endswith('Z') and '+' not in v and '-' not in v[10:]:
-                 v += 'Z'
-            try:
-                # Intenta parsear el formato ISO estándar
-                return datetime.fromisoformat(v.replace('Z', '+00:00'))
-            except ValueError:
-                try:
-                    # Fallback para formatos con microsegundos variables
-                    return datetime.strptime(v, '%Y-%m-%dT%H:%M:%S.%f%z')
-                except Exception:
-                    logger.warning(f"Timestamp no ISO, usando now(): {v}")
-                    return datetime.now() # O maneja el error como prefieras
+            return parse_sale_timestamp(v)
+        return v
+
+    @cached_property
+    def json_payload(self) -> str:
+        """JSON serializado una única vez y reutilizado en el stream de Redis y en la sincronización."""
+        return self.model_dump_json()
+
+class SalesPage(BaseModel):
+    sales: List[SaleNotification]
+    next_cursor: Optional[str] = None
+
+class BranchHeartbeat(BaseModel):
+    branch_id: str
+    url: str # URL base con la que la Central llega a la sucursal
+
+    @field_validator("url")
+    def normalize_url(cls, v):
+        v = v.strip().rstrip("/")
+        if not v.startswith(("http://", "https://")):
+            raise ValueError("La URL de la sucursal debe empezar con http:// o https://")
         return v
-    
-    class Config:
-        extra = "ignore" 
 
 # [MODIFICADO] Esto es ahora solo el inventario *inicial*
 initial_inventory: Dict[int, Product] = {
@@ -170,7 +476,82 @@ def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
 # === FUNCIONES DE ACCESO A DATOS (REDIS) ========================
 # =================================================================
 
-def initialize_redis_data():
+# [NUEVO] Última foto buena (stale-while-revalidate): se actualiza en cada lectura exitosa
+# y se sirve, marcada como desactualizada, mientras Redis no responde.
+last_known_good = {
+    "version": None, "products": None, "inventory_at": 0.0,
+    "sales": None, "sales_at": 0.0,
+    "stats": None, "stats_hours": 0, "stats_at": 0.0,
+    "dirty": False,
+}
+
+def remember_inventory(version, products: List[Product]):
+    last_known_good.update(version=version, products=list(products), inventory_at=time.time(), dirty=True)
+
+def remember_recent_sales(sales: List[SaleNotification]):
+    """Guarda las ventas más recientes (más nuevas primero)."""
+    last_known_good.update(sales=sales[:SNAPSHOT_SALES_LIMIT], sales_at=time.time(), dirty=True)
+
+def remember_stats(stats: dict, hours: int):
+    # Se conserva la consulta con más horas: sirve también para cualquier ventana menor
+    if last_known_good["stats"] is None or hours >= last_known_good["stats_hours"]:
+        last_known_good.update(stats=stats, stats_hours=hours, stats_at=time.time(), dirty=True)
+
+def stale_inventory():
+    """(versión, productos) de la última foto buena, o (None, []) si nunca hubo una."""
+    if last_known_good["products"] is None:
+        return None, []
+    mark_response_stale(last_known_good["inventory_at"])
+    return last_known_good["version"], last_known_good["products"]
+
+def save_snapshot_to_disk():
+    """Escribe la foto en SNAPSHOT_PATH de forma atómica (archivo temporal + rename)."""
+    data = {
+        "inventory_at": last_known_good["inventory_at"],
+        "version": last_known_good["version"],
+        "products": [p.model_dump() for p in last_known_good["products"] or []],
+        "sales_at": last_known_good["sales_at"],
+        "sales": [json.loads(n.json_payload) for n in last_known_good["sales"] or []],
+        "stats_at": last_known_good["stats_at"],
+        "stats_hours": last_known_good["stats_hours"],
+        "stats": last_known_good["stats"],
+    }
+    tmp_path = f"{SNAPSHOT_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, SNAPSHOT_PATH)
+
+def load_snapshot_from_disk():
+    if not SNAPSHOT_PATH or not os.path.exists(SNAPSHOT_PATH):
+        return
+    try:
+        with open(SNAPSHOT_PATH, encoding="utf-8") as f:
+            data = json.load(f)
+        last_known_good.update(
+            version=data["version"],
+            products=[Product(**p) for p in data["products"]] if data["inventory_at"] else None,
+            inventory_at=data["inventory_at"],
+            sales=[SaleNotification(**n) for n in data["sales"]] if data["sales_at"] else None,
+            sales_at=data["sales_at"],
+            stats=data["stats"], stats_hours=data["stats_hours"], stats_at=data["stats_at"],
+        )
+        logger.info(f"💾 [{SERVER_NAME}] Foto local cargada desde {SNAPSHOT_PATH} ({len(data['products'])} productos).")
+    except Exception as e:
+        logger.error(f"❌ [{SERVER_NAME}] No se pudo leer la foto local {SNAPSHOT_PATH}: {e}")
+
+async def snapshot_persist_loop():
+    """Tarea de fondo (solo si SNAPSHOT_PATH está definido): vuelca la foto a disco cuando cambió."""
+    while True:
+        await asyncio.sleep(SNAPSHOT_SAVE_INTERVAL)
+        if not last_known_good["dirty"]:
+            continue
+        last_known_good["dirty"] = False
+        try:
+            await asyncio.to_thread(save_snapshot_to_disk)
+        except Exception as e:
+            logger.error(f"❌ [{SERVER_NAME}] No se pudo guardar la foto local en {SNAPSHOT_PATH}: {e}")
+
+async def initialize_redis_data():
     """Inicializa contadores y el inventario central en Redis si no existen."""
     r = get_redis_client()
     if not r:
@@ -178,219 +559,1331 @@ def initialize_redis_data():
         return
 
     try:
-        if r.get(TOTAL_USERS_KEY) is None:
-             r.set(TOTAL_USERS_KEY, 0)
+        if await r.get(TOTAL_USERS_KEY) is None:
+             await r.set(TOTAL_USERS_KEY, 0)
         
-        if not r.exists(INVENTORY_HASH_KEY):
+        if not await r.exists(INVENTORY_HASH_KEY):
             logger.info(f"ℹ️ [{SERVER_NAME}] Inventario vacío en Redis. Poblando con datos iniciales...")
             pipeline = r.pipeline()
             for prod_id, product in initial_inventory.items():
-                pipeline.hset(INVENTORY_HASH_KEY, str(prod_id), product.model_dump_json())
-            pipeline.execute()
+                pipeline.hset(INVENTORY_HASH_KEY, str(prod_id), product_to_redis_json(product))
+                pipeline.hset(INVENTORY_STOCK_HASH_KEY, str(prod_id), product.stock)
+            pipeline.incr(INVENTORY_VERSION_KEY)
+            await pipeline.execute()
             logger.info(f"✅ [{SERVER_NAME}] Inventario central poblado en Redis con {len(initial_inventory)} productos.")
+        elif not await r.exists(INVENTORY_STOCK_HASH_KEY):
+            # Migración: inventarios antiguos guardaban el stock dentro del JSON del producto
+            products_json = await r.hgetall(INVENTORY_HASH_KEY)
+            stocks = {prod_id: json.loads(p_json).get("stock", 0) for prod_id, p_json in products_json.items()}
+            if stocks:
+                await r.hset(INVENTORY_STOCK_HASH_KEY, mapping=stocks)
+            logger.info(f"✅ [{SERVER_NAME}] Stock de {len(stocks)} productos migrado a {INVENTORY_STOCK_HASH_KEY}.")
         else:
             logger.info(f"✅ [{SERVER_NAME}] Inventario central ya existe en Redis. Omitiendo población.")
             
     except Exception as e:
+        note_redis_error(e)
         logger.error(f"❌ [{SERVER_NAME}] Fallo al inicializar data en Redis: {e}")
 
-async def get_all_products_from_redis() -> List[Product]:
-    """Obtiene todos los productos del Hash de Redis."""
+def product_to_redis_json(product: Product) -> str:
+    """JSON del producto sin el stock (el stock se guarda en INVENTORY_STOCK_HASH_KEY)."""
+    return product.model_dump_json(exclude={"stock"})
+
+def product_from_redis(product_json: str, stock: Optional[str]) -> Product:
+    data = json.loads(product_json)
+    if stock is not None:
+        data["stock"] = int(stock)
+    data.setdefault("stock", 0)
+    return Product(**data)
+
+class LocalInventoryCache:
+    """
+    Copia en memoria del inventario (read-through) de esta instancia.
+    Cada cambio llega por pub/sub con un número de versión: los eventos con versión vieja
+    se descartan y los adelantados esperan en 'pending' a que llegue el que falta. Solo un hueco
+    que no se cierra en INVENTORY_GAP_GRACE_SECONDS fuerza una recarga completa desde Redis.
+    Solo se usa mientras el listener está suscrito ('ready'); si no, se lee de Redis.
+    """
+    def __init__(self):
+        self.products: Dict[int, Product] = {}
+        self.version = 0
+        self.ready = False
+        self.pending: Dict[int, dict] = {} # Eventos adelantados, por versión
+        self.gap_since: Optional[float] = None # Desde cuándo falta el evento version + 1
+
+    def load(self, version: Optional[str], products: List[Product]):
+        self.products = {p.id: p for p in products}
+        self.version = int(version or 0)
+        self.pending, self.gap_since = {}, None
+        notify_inventory_changed()
+
+    def apply(self, event: dict):
+        """Aplica un evento (o lo guarda si llega adelantado) y todos los pendientes que queden en secuencia."""
+        version = int(event["v"])
+        if version <= self.version:
+            return # Evento viejo (ya incluido en la foto actual, o el eco de una escritura propia): se descarta
+        self.pending[version] = event
+        applied = False
+        while self.version + 1 in self.pending:
+            self._apply_next(self.pending.pop(self.version + 1))
+            applied = True
+        if not self.pending:
+            self.gap_since = None
+        elif applied or self.gap_since is None:
+            self.gap_since = time.monotonic() # Hueco nuevo: empieza su plazo
+        if applied:
+            notify_inventory_changed()
+
+    def gap_expired(self) -> bool:
+        """True si el hueco de versiones no se cerró a tiempo (hay que recargar la foto)."""
+        if self.gap_since is None:
+            return False
+        return len(self.pending) > INVENTORY_GAP_MAX_PENDING or time.monotonic() - self.gap_since > INVENTORY_GAP_GRACE_SECONDS
+
+    def _apply_next(self, event: dict):
+        product_id = int(event["id"])
+        if event["op"] == "delete":
+            self.products.pop(product_id, None)
+        elif event["op"] == "upsert":
+            self.products[product_id] = Product(**event["product"], stock=event["stock"])
+        elif event["op"] == "stock" and product_id in self.products:
+            # Nuevo objeto: quien ya tenga una referencia al producto no ve cambios a medias
+            self.products[product_id] = self.products[product_id].model_copy(update={"stock": int(event["stock"])})
+        self.version = int(event["v"])
+
+    def invalidate(self):
+        self.ready = False
+
+inventory_cache = LocalInventoryCache()
+# Long-poll de GET /inventory/changes: se reemplaza por uno nuevo en cada cambio aplicado a la caché
+inventory_changed = asyncio.Event()
+
+def notify_inventory_changed():
+    global inventory_changed
+    changed, inventory_changed = inventory_changed, asyncio.Event()
+    changed.set()
+
+def apply_local_inventory_event(event_json: Optional[str]):
+    """
+    Aplica en esta instancia el evento de una escritura propia, sin esperar el eco del pub/sub.
+    Si aún falta el evento anterior de otra instancia, queda pendiente (el listener recarga si el hueco no se cierra).
+    """
+    if event_json and inventory_cache.ready:
+        inventory_cache.apply(json.loads(event_json))
+
+async def read_inventory_snapshot(r: aioredis.Redis):
+    """Versión + todos los productos (JSON + stock) en un solo viaje y de forma consistente (MULTI/EXEC)."""
+    pipeline = r.pipeline() # MULTI/EXEC: foto consistente de ambos hashes
+    pipeline.get(INVENTORY_VERSION_KEY)
+    pipeline.hgetall(INVENTORY_HASH_KEY)
+    pipeline.hgetall(INVENTORY_STOCK_HASH_KEY)
+    version, products_json, stocks = await pipeline.execute()
+    products = [product_from_redis(p_json, stocks.get(prod_id)) for prod_id, p_json in products_json.items()]
+    return int(version or 0), products
+
+async def get_inventory_snapshot():
+    """Inventario desde la caché local, Redis o, si Redis no responde, la última foto buena."""
+    if inventory_cache.ready:
+        return inventory_cache.version, list(inventory_cache.products.values())
     r = get_redis_client()
-    if not r: return []
+    if not r: return stale_inventory()
     try:
-        products_json = await asyncio.to_thread(r.hvals, INVENTORY_HASH_KEY)
-        products = [Product(**json.loads(p_json)) for p_json in products_json]
-        return products
+        version, products = await read_inventory_snapshot(r)
     except Exception as e:
+        note_redis_error(e)
         logger.error(f"Error al leer inventario de Redis: {e}")
-        return []
+        return stale_inventory()
+    remember_inventory(version, products)
+    return version, products
+
+async def get_all_products_from_redis() -> List[Product]:
+    """Obtiene todos los productos (caché local o, si no está lista, Redis en un solo viaje)."""
+    _version, products = await get_inventory_snapshot()
+    return products
 
 async def get_product_from_redis(product_id: int) -> Optional[Product]:
-    """Obtiene un solo producto de Redis."""
+    """Obtiene un solo producto (caché local o Redis)."""
+    if inventory_cache.ready:
+        return inventory_cache.products.get(product_id)
     r = get_redis_client()
-    if not r: return None
+    if not r:
+        _version, products = stale_inventory()
+        return next((p for p in products if p.id == product_id), None)
     try:
-        product_json = await asyncio.to_thread(r.hget, INVENTORY_HASH_KEY, str(product_id))
+        pipeline = r.pipeline()
+        pipeline.hget(INVENTORY_HASH_KEY, str(product_id))
+        pipeline.hget(INVENTORY_STOCK_HASH_KEY, str(product_id))
+        product_json, stock = await pipeline.execute()
         if product_json:
-            return Product(**json.loads(product_json))
+            return product_from_redis(product_json, stock)
     except Exception as e:
+        note_redis_error(e)
         logger.error(f"Error al leer producto {product_id} de Redis: {e}")
     return None
 
+# Alta/edición/baja de producto: escribe ambos hashes, incrementa la versión, publica el evento, lo anota en el
+# changelog y, si el push está activo, deja el cambio en el outbox de las sucursales (todo atómico)
+# KEYS: 1=inventario, 2=stock, 3=versión, 4=outbox, 5=changelog
+# ARGV: 1=op (upsert/delete), 2=product_id, 3=JSON sin stock, 4=stock, 5=canal, 6=MAXLEN del outbox, 7=JSON completo,
+#       8=MAXLEN del changelog, 9=push a sucursales (1/0)
+PRODUCT_WRITE_LUA = """
+local version = redis.call('INCR', KEYS[3])
+local event
+if ARGV[1] == 'delete' then
+    redis.call('HDEL', KEYS[1], ARGV[2])
+    redis.call('HDEL', KEYS[2], ARGV[2])
+    event = '{"v":' .. version .. ',"op":"delete","id":' .. ARGV[2] .. '}'
+    if ARGV[9] == '1' then
+        redis.call('XADD', KEYS[4], 'MAXLEN', '~', ARGV[6], '*', 'method', 'DELETE', 'path', '/inventory/' .. ARGV[2], 'body', '')
+    end
+else
+    redis.call('HSET', KEYS[1], ARGV[2], ARGV[3])
+    redis.call('HSET', KEYS[2], ARGV[2], ARGV[4])
+    event = '{"v":' .. version .. ',"op":"upsert","id":' .. ARGV[2] .. ',"stock":' .. ARGV[4] .. ',"product":' .. ARGV[3] .. '}'
+    -- POST /inventory de la sucursal crea o actualiza
+    if ARGV[9] == '1' then
+        redis.call('XADD', KEYS[4], 'MAXLEN', '~', ARGV[6], '*', 'method', 'POST', 'path', '/inventory', 'body', ARGV[7])
+    end
+end
+redis.call('PUBLISH', ARGV[5], event)
+-- pcall: si la versión no supera al último ID (p. ej. se borró el contador) no se aborta la escritura;
+-- el lector ve el hueco y responde con la foto completa
+redis.pcall('XADD', KEYS[5], 'MAXLEN', '~', ARGV[8], version .. '-0', 'e', event)
+return event
+"""
+product_write_script = None
+
 async def save_product_to_redis(product: Product) -> bool:
-    """Guarda/Actualiza un producto en el Hash de Redis."""
+    """Guarda/Actualiza un producto (JSON y stock) de forma atómica y avisa a las demás instancias."""
     r = get_redis_client()
-    if not r: return False
+    if not r or not product_write_script: return False
     try:
-        await asyncio.to_thread(r.hset, INVENTORY_HASH_KEY, str(product.id), product.model_dump_json())
+        event_json = await product_write_script(
+            keys=[INVENTORY_HASH_KEY, INVENTORY_STOCK_HASH_KEY, INVENTORY_VERSION_KEY, OUTBOX_STREAM_KEY, INVENTORY_CHANGELOG_KEY],
+            args=["upsert", product.id, product_to_redis_json(product), product.stock, INVENTORY_EVENTS_CHANNEL,
+                  OUTBOX_MAXLEN, product.model_dump_json(), INVENTORY_CHANGELOG_MAXLEN, int(INVENTORY_PUSH_TO_BRANCHES)],
+        )
+        apply_local_inventory_event(event_json)
         return True
     except Exception as e:
+        note_redis_error(e)
         logger.error(f"Error al guardar producto {product.id} en Redis: {e}")
         return False
 
 async def delete_product_from_redis(product_id: int) -> bool:
-    """Elimina un producto del Hash de Redis."""
+    """Elimina un producto (JSON y stock) de Redis y avisa a las demás instancias."""
     r = get_redis_client()
-    if not r: return False
+    if not r or not product_write_script: return False
     try:
-        await asyncio.to_thread(r.hdel, INVENTORY_HASH_KEY, str(product_id))
+        event_json = await product_write_script(
+            keys=[INVENTORY_HASH_KEY, INVENTORY_STOCK_HASH_KEY, INVENTORY_VERSION_KEY, OUTBOX_STREAM_KEY, INVENTORY_CHANGELOG_KEY],
+            args=["delete", product_id, "", 0, INVENTORY_EVENTS_CHANNEL, OUTBOX_MAXLEN, "",
+                  INVENTORY_CHANGELOG_MAXLEN, int(INVENTORY_PUSH_TO_BRANCHES)],
+        )
+        apply_local_inventory_event(event_json)
         return True
     except Exception as e:
+        note_redis_error(e)
         logger.error(f"Error al eliminar producto {product_id} de Redis: {e}")
         return False
 
-async def get_sales_from_redis(limit: int = 50) -> List[SaleNotification]:
-    """Obtiene las últimas 'limit' ventas de la Lista de Redis."""
+async def inventory_invalidation_listener():
+    """
+    Tarea de fondo: mantiene la caché local sincronizada vía pub/sub.
+    Se suscribe ANTES de cargar la foto para no perder eventos; si la conexión cae,
+    la caché deja de usarse hasta volver a suscribirse y recargar.
+    """
+    backoff = 1.0
+    while True:
+        pubsub = None
+        try:
+            r = get_redis_client()
+            if not r:
+                await asyncio.sleep(backoff)
+                continue
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+            await pubsub.subscribe(INVENTORY_EVENTS_CHANNEL)
+            inventory_cache.invalidate()
+            version, products = await read_inventory_snapshot(r)
+            remember_inventory(version, products)
+            inventory_cache.load(version, products)
+            inventory_cache.ready = True
+            backoff = 1.0
+            logger.info(f"🧠 [{SERVER_NAME}] Caché local de inventario cargada (versión {inventory_cache.version}, {len(products)} productos).")
+            while inventory_cache.ready: # Se invalida desde fuera ante una caída de Redis
+                message = await pubsub.get_message(timeout=1.0)
+                if message is not None:
+                    inventory_cache.apply(json.loads(message["data"]))
+                if inventory_cache.gap_expired():
+                    logger.warning(f"⚠️ [{SERVER_NAME}] Hueco de versiones sin cerrar en la caché de inventario (versión {inventory_cache.version}, {len(inventory_cache.pending)} eventos en espera). Recargando...")
+                    break
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            note_redis_error(e)
+            logger.error(f"❌ [{SERVER_NAME}] Listener de inventario caído: {e}. Reintentando en {backoff:.0f}s")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+        finally:
+            if inventory_cache.ready:
+                # Lo último que vio la caché pasa a ser la foto buena mientras no haya suscripción
+                remember_inventory(inventory_cache.version, inventory_cache.products.values())
+            inventory_cache.invalidate()
+            if pubsub is not None:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+# --- EVENTOS EN VIVO PARA LOS DASHBOARDS (SSE) ---
+DASHBOARD_EVENT_NAMES = {
+    DASHBOARD_SALES_CHANNEL: "sale",
+    INVENTORY_EVENTS_CHANNEL: "inventory",
+    DASHBOARD_USERS_CHANNEL: "users",
+}
+SSE_RESYNC_FRAME = b"event: resync\ndata: {}\n\n" # El cliente vuelve a pedir los datos completos
+
+class DashboardEventHub:
+    """
+    Reparte a los dashboards conectados a esta instancia los eventos de los canales de DASHBOARD_EVENT_NAMES.
+    Una sola suscripción a Redis por instancia, y solo mientras haya algún dashboard conectado.
+    Cada evento se formatea una vez y se encola (los mismos bytes) para cada cliente.
+    """
+    def __init__(self):
+        self.clients: set = set()
+        self.relay: Optional[asyncio.Task] = None
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=DASHBOARD_SSE_QUEUE_SIZE)
+        self.clients.add(queue)
+        if self.relay is None or self.relay.done():
+            self.relay = asyncio.create_task(self._relay())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.clients.discard(queue)
+        if not self.clients and self.relay is not None:
+            self.relay.cancel()
+            self.relay = None
+
+    def broadcast(self, frame: bytes):
+        for queue in self.clients:
+            try:
+                queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                # Cliente lento: se descarta lo pendiente y se le pide recargar los datos completos
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(SSE_RESYNC_FRAME)
+
+    async def _relay(self):
+        backoff = 1.0
+        while True:
+            pubsub = None
+            try:
+                r = get_redis_client()
+                if not r:
+                    await asyncio.sleep(backoff)
+                    continue
+                pubsub = r.pubsub(ignore_subscribe_messages=True)
+                await pubsub.subscribe(*DASHBOARD_EVENT_NAMES)
+                self.broadcast(SSE_RESYNC_FRAME) # Lo ocurrido sin suscripción se recupera con una recarga de datos
+                backoff = 1.0
+                while True:
+                    message = await pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        self.broadcast(f"event: {DASHBOARD_EVENT_NAMES[message['channel']]}\ndata: {message['data']}\n\n".encode())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                note_redis_error(e)
+                logger.error(f"❌ [{SERVER_NAME}] Relay de eventos del dashboard caído: {e}. Reintentando en {backoff:.0f}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+            finally:
+                if pubsub is not None:
+                    try:
+                        await pubsub.aclose()
+                    except Exception:
+                        pass
+
+    async def close(self):
+        if self.relay is not None:
+            self.relay.cancel()
+            await asyncio.gather(self.relay, return_exceptions=True)
+            self.relay = None
+
+dashboard_hub = DashboardEventHub()
+
+def encode_sales_cursor(entry_id: str) -> str:
+    """Cursor opaco para paginar el stream de ventas."""
+    return base64.urlsafe_b64encode(entry_id.encode()).decode().rstrip("=")
+
+def decode_sales_cursor(cursor: str) -> str:
+    try:
+        entry_id = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    except Exception:
+        entry_id = ""
+    if not re.fullmatch(r"\d+-\d+", entry_id):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    return entry_id
+
+def datetime_to_stream_ms(value: datetime) -> int:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp() * 1000)
+
+def sales_retention_args() -> List[str]:
+    """Estrategia de recorte del stream para XADD: MAXLEN ~ n, MINID ~ (ahora - días) o ninguna."""
+    if SALES_STREAM_MAXLEN > 0:
+        return ["MAXLEN", str(SALES_STREAM_MAXLEN)]
+    if SALES_RETENTION_DAYS > 0:
+        min_ms = int((time.time() - SALES_RETENTION_DAYS * 86400) * 1000)
+        return ["MINID", str(min_ms)]
+    return ["NONE", "0"]
+
+# Migración única de la LIST legada (máx. 1000 ventas) a los streams. Todo en un script: con varias
+# instancias arrancando a la vez solo una la encuentra y el resto no hace nada.
+# Las ventas legadas van ANTES de las ya registradas en el stream (los IDs deben ser crecientes), así que
+# cada stream se reconstruye en una clave temporal: ventas legadas + entradas actuales, y RENAME.
+# KEYS[1]=LIST legada, KEYS[2]=stream de ventas, KEYS[3]=stream de prueba, KEYS[4]=clave temporal
+# ARGV: tríos (índice de KEYS destino, ms de la venta, JSON) en orden cronológico
+MIGRATE_SALES_LIST_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+local migrated = 0
+for target = 2, 3 do
+    local first = redis.call('XRANGE', KEYS[target], '-', '+', 'COUNT', 1)
+    local limit_ms = nil
+    if #first > 0 then limit_ms = tonumber(string.match(first[1][1], '^(%d+)-')) - 1 end
+    redis.call('DEL', KEYS[4])
+    local prev_ms, seq, added = -1, 0, 0
+    for i = 1, #ARGV, 3 do
+        if tonumber(ARGV[i]) == target then
+            local ms = tonumber(ARGV[i + 1])
+            if limit_ms and ms > limit_ms then ms = limit_ms end
+            if ms < prev_ms then ms = prev_ms end
+            if ms == prev_ms then seq = seq + 1 else seq = 0 end
+            if ms == 0 and seq == 0 then seq = 1 end
+            prev_ms = ms
+            redis.call('XADD', KEYS[4], string.format('%d-%d', ms, seq), 'sale', ARGV[i + 2])
+            added = added + 1
+        end
+    end
+    if added > 0 then
+        for _, entry in ipairs(redis.call('XRANGE', KEYS[target], '-', '+')) do
+            redis.call('XADD', KEYS[4], entry[1], unpack(entry[2]))
+        end
+        redis.call('RENAME', KEYS[4], KEYS[target])
+        migrated = migrated + added
+    end
+end
+redis.call('DEL', KEYS[1])
+return migrated
+"""
+
+async def migrate_legacy_sales_list():
+    """Pasa las ventas de la LIST 'central_sales_history' al stream (y las de prueba a su stream) y borra la LIST."""
+    r = get_redis_client()
+    if not r:
+        return
+    try:
+        raw_sales = await r.lrange(LEGACY_SALES_LIST_KEY, 0, -1)
+        if not raw_sales:
+            return
+        args, last_ms = [], int(time.time() * 1000)
+        for raw in raw_sales:
+            try:
+                notification = SaleNotification(**json.loads(raw))
+            except Exception as e:
+                logger.error(f"❌ [{SERVER_NAME}] Venta legada corrupta, se descarta en la migración: {e}")
+                continue
+            if isinstance(notification.timestamp, datetime): # Si no, hereda la hora de la venta anterior
+                last_ms = datetime_to_stream_ms(notification.timestamp)
+            args.extend([3 if is_test_sale(notification) else 2, last_ms, notification.json_payload])
+        migrated = await r.register_script(MIGRATE_SALES_LIST_LUA)(
+            keys=[LEGACY_SALES_LIST_KEY, SALES_STREAM_KEY, TEST_SALES_STREAM_KEY, f"{SALES_STREAM_KEY}:migrating"],
+            args=args,
+        )
+        if migrated:
+            logger.info(f"✅ [{SERVER_NAME}] {migrated} ventas de '{LEGACY_SALES_LIST_KEY}' migradas al stream.")
+    except Exception as e:
+        note_redis_error(e)
+        logger.error(f"❌ [{SERVER_NAME}] Error al migrar el historial legado de ventas: {e}")
+
+async def get_sales_page(
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    test: bool = False,
+):
+    """
+    Lee ventas del stream, de la más nueva a la más antigua.
+    Retorna (ventas, next_cursor). El rango temporal usa la hora de registro en la Central (ID del stream).
+    Con 'test' lee el historial aparte de las ventas de prueba (sin foto de respaldo).
+    """
+    latest_page = not (cursor or since or until or test)
     r = get_redis_client()
-    if not r: return []
+    if not r: return stale_recent_sales(limit) if latest_page else ([], None)
+    end = f"({decode_sales_cursor(cursor)}" if cursor else (str(datetime_to_stream_ms(until)) if until else "+")
+    start = str(datetime_to_stream_ms(since)) if since else "-"
     try:
-        sales_json = await asyncio.to_thread(r.lrange, SALES_LIST_KEY, -limit, -1)
-        sales = [SaleNotification(**json.loads(s_json)) for s_json in sales_json]
-        return sales
+        entries = await r.xrevrange(TEST_SALES_STREAM_KEY if test else SALES_STREAM_KEY, max=end, min=start, count=limit)
     except Exception as e:
+        note_redis_error(e)
         logger.error(f"Error al leer ventas de Redis: {e}")
-        return []
+        return stale_recent_sales(limit) if latest_page else ([], None)
+    sales = []
+    for entry_id, fields in entries:
+        try:
+            sales.append(SaleNotification(**json.loads(fields["sale"])))
+        except Exception as e:
+            logger.error(f"Entrada de venta {entry_id} corrupta en el stream: {e}")
+    next_cursor = encode_sales_cursor(entries[-1][0]) if len(entries) == limit else None
+    if latest_page and (limit >= SNAPSHOT_SALES_LIMIT or next_cursor is None):
+        remember_recent_sales(sales)
+    return sales, next_cursor
+
+def stale_recent_sales(limit: int):
+    """Primera página desde la última foto buena (sin cursor: no hay más páginas mientras Redis no vuelva)."""
+    if last_known_good["sales"] is None:
+        return [], None
+    mark_response_stale(last_known_good["sales_at"])
+    return last_known_good["sales"][:limit], None
 
-async def save_sale_to_redis(notification: SaleNotification):
-    """Guarda una notificación de venta en la Lista de Redis."""
+async def get_sales_from_redis(limit: int = 50) -> List[SaleNotification]:
+    """Obtiene las últimas 'limit' ventas (orden cronológico)."""
+    sales, _ = await get_sales_page(limit=limit)
+    return list(reversed(sales))
+
+def sale_hour_bucket(timestamp: Union[datetime, str]) -> str:
+    """Bucket horario (UTC) de una venta, p. ej. '2025-11-28T14'."""
+    if not isinstance(timestamp, datetime):
+        timestamp = datetime.now(timezone.utc)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc)
+    return timestamp.strftime("%Y-%m-%dT%H")
+
+async def get_sales_stats(hours: int = 24) -> dict:
+    """
+    Lee los agregados de ventas mantenidos en escritura: coste constante,
+    independiente del tamaño del historial. 'hours' limita los buckets horarios devueltos.
+    """
+    empty = {"total_revenue": 0.0, "sales_count": 0, "units_sold": 0,
+             "units_by_product": {}, "revenue_by_branch": {}, "hourly": []}
     r = get_redis_client()
-    if not r: return False
+    if not r: return stale_sales_stats(hours) or empty
+    now = datetime.now(timezone.utc)
+    hour_buckets = [sale_hour_bucket(now - timedelta(hours=h)) for h in reversed(range(hours))]
     try:
-        pipeline = r.pipeline()
-        
-        # [CORRECCIÓN V5.2] .model_dump_json() no acepta 'mode'. 
-        pipeline.rpush(SALES_LIST_KEY, notification.model_dump_json()) 
-        
-        pipeline.ltrim(SALES_LIST_KEY, -1000, -1) 
-        await asyncio.to_thread(pipeline.execute)
-        return True
+        pipeline = r.pipeline(transaction=False)
+        pipeline.hgetall(SALES_STATS_KEY)
+        pipeline.hgetall(SALES_STATS_UNITS_KEY)
+        pipeline.hgetall(SALES_STATS_BRANCH_KEY)
+        if hour_buckets:
+            pipeline.hmget(SALES_STATS_HOURLY_KEY, [f"{b}|{field}" for b in hour_buckets for field in ("revenue", "count")])
+        totals, units, branches, *hourly = await pipeline.execute()
     except Exception as e:
-        logger.error(f"Error al guardar venta {notification.sale_id} en Redis: {e}")
+        note_redis_error(e)
+        logger.error(f"Error al leer agregados de ventas de Redis: {e}")
+        return stale_sales_stats(hours) or empty
+    hourly_values = hourly[0] if hourly else []
+    stats = {
+        "total_revenue": round(float(totals.get("revenue", 0)), 2),
+        "sales_count": int(totals.get("count", 0)),
+        "units_sold": int(totals.get("units", 0)),
+        "units_by_product": {int(k): int(v) for k, v in units.items()},
+        "revenue_by_branch": {k: round(float(v), 2) for k, v in branches.items()},
+        "hourly": [
+            {"hour": bucket, "revenue": round(float(hourly_values[2 * i] or 0), 2), "count": int(hourly_values[2 * i + 1] or 0)}
+            for i, bucket in enumerate(hour_buckets)
+        ],
+    }
+    remember_stats(stats, hours)
+    return stats
+
+def stale_sales_stats(hours: int) -> Optional[dict]:
+    stats = last_known_good["stats"]
+    if stats is None:
+        return None
+    mark_response_stale(last_known_good["stats_at"])
+    return {**stats, "hourly": stats["hourly"][-hours:] if hours else []}
+
+# [NUEVO] Bloom filter en un string de bits de Redis. Las posiciones llegan calculadas desde Python
+# (bloom_positions) como "p1,p2,...": un string vacío significa "sin id, no se deduplica".
+DEDUP_BLOOM_LUA = """
+local function bloom_seen(key, positions)
+    if positions == '' or redis.call('EXISTS', key) == 0 then return false end
+    for pos in string.gmatch(positions, '%d+') do
+        if redis.call('GETBIT', key, pos) == 0 then return false end
+    end
+    return true
+end
+local function bloom_add(key, positions, ttl)
+    if positions == '' then return end
+    for pos in string.gmatch(positions, '%d+') do
+        redis.call('SETBIT', key, pos, 1)
+    end
+    redis.call('EXPIRE', key, ttl)
+end
+"""
+
+def bloom_positions(item_id: Optional[str]) -> str:
+    """Posiciones del id en el Bloom filter (doble hashing sobre blake2b)."""
+    if not item_id:
+        return ""
+    digest = hashlib.blake2b(item_id.encode(), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], "little")
+    h2 = int.from_bytes(digest[8:], "little") | 1
+    return ",".join(str((h1 + i * h2) % DEDUP_BLOOM_BITS) for i in range(DEDUP_BLOOM_HASHES))
+
+def dedup_generation_keys(prefix: str) -> List[str]:
+    """[generación actual, generación anterior] del Bloom filter rotativo."""
+    generation = int(time.time() // DEDUP_WINDOW_SECONDS)
+    return [f"{prefix}:{generation}", f"{prefix}:{generation - 1}"]
+
+# [NUEVO] Commit atómico de un lote de ventas en un solo viaje (EVALSHA).
+# Idempotencia + decremento de stock + historial + agregados se ejecutan juntos dentro de Redis,
+# así central1 y central2 no pueden pisarse los decrementos (sin read-modify-write en Python).
+# Una venta individual es simplemente un lote de 1.
+# KEYS: 1=inventario, 2=stock, 3=stream de ventas, 4=agregados globales, 5=unidades por producto,
+#       6=recaudación por sucursal, 7=buckets por hora, 8=versión del inventario,
+#       9=Bloom de ventas (generación actual), 10=Bloom de ventas (generación anterior),
+#       11=stream de ventas de prueba, 12/13=Bloom de ventas de prueba (generación actual / anterior),
+#       14=outbox hacia sucursales (solo ventas reales), 15=changelog del inventario
+# ARGV: 1=estrategia de recorte (MAXLEN/MINID/NONE), 2=umbral de recorte, 3=TTL del Bloom,
+#       4=canal de eventos de inventario, 5=cantidad de ventas del lote, 6=MAXLEN del stream de prueba,
+#       7=MAXLEN del outbox, 8=MAXLEN del changelog, 9=canal de ventas del dashboard,
+#       luego 8 valores por venta: product_id, cantidad, es_test (1/0), JSON de la venta,
+#       posiciones en el Bloom ("" si no tiene sale_id), branch_id, total_amount, bucket horario (YYYY-MM-DDTHH)
+# Retorna por venta: {estado, stock_anterior, stock_nuevo, JSON del producto, ID en el stream, evento de inventario}
+SALE_COMMIT_LUA = DEDUP_BLOOM_LUA + """
+local dedup_ttl = tonumber(ARGV[3])
+local results = {}
+local n = tonumber(ARGV[5])
+for i = 1, n do
+    local base = 9 + (i - 1) * 8
+    local product_id, quantity, is_test = ARGV[base + 1], ARGV[base + 2], ARGV[base + 3]
+    local sale_json, positions = ARGV[base + 4], ARGV[base + 5]
+    local branch_id, amount, hour = ARGV[base + 6], ARGV[base + 7], ARGV[base + 8]
+    -- Las ventas de prueba usan su propio Bloom (no llenan el de las reales) y su propio historial
+    local bloom_current, bloom_previous = KEYS[9], KEYS[10]
+    if is_test == '1' then
+        bloom_current, bloom_previous = KEYS[12], KEYS[13]
+    end
+
+    if bloom_seen(bloom_current, positions) or bloom_seen(bloom_previous, positions) then
+        results[i] = {'duplicate', -1, -1, '', '', ''}
+    else
+        local product_json = redis.call('HGET', KEYS[1], product_id)
+        if not product_json then
+            -- No se marca como vista: la venta puede reintentarse cuando el producto exista
+            results[i] = {'not_found', -1, -1, '', '', ''}
+        else
+            local old_stock = tonumber(redis.call('HGET', KEYS[2], product_id))
+            if old_stock == nil then
+                old_stock = tonumber(cjson.decode(product_json)['stock']) or 0
+            end
+            local new_stock = old_stock
+            local event = ''
+            local sales_count, revenue
+            if is_test == '0' then
+                new_stock = math.max(0, old_stock - tonumber(quantity))
+                if new_stock ~= old_stock then
+                    redis.call('HSET', KEYS[2], product_id, new_stock)
+                    local version = redis.call('INCR', KEYS[8])
+                    event = '{"v":' .. version .. ',"op":"stock","id":' .. product_id .. ',"stock":' .. new_stock .. '}'
+                    redis.call('PUBLISH', ARGV[4], event)
+                    -- Entra al changelog para no dejar huecos de versión; las sucursales lo ignoran (Stock Independiente)
+                    redis.pcall('XADD', KEYS[15], 'MAXLEN', '~', ARGV[8], version .. '-0', 'e', event)
+                end
+                -- Agregados (las ventas de prueba no contabilizan)
+                revenue = redis.call('HINCRBYFLOAT', KEYS[4], 'revenue', amount)
+                sales_count = redis.call('HINCRBY', KEYS[4], 'count', 1)
+                redis.call('HINCRBY', KEYS[4], 'units', quantity)
+                redis.call('HINCRBY', KEYS[5], product_id, quantity)
+                redis.call('HINCRBYFLOAT', KEYS[6], branch_id, amount)
+                redis.call('HINCRBYFLOAT', KEYS[7], hour .. '|revenue', amount)
+                redis.call('HINCRBY', KEYS[7], hour .. '|count', 1)
+            end
+
+            local entry_id
+            if is_test == '1' then
+                entry_id = redis.call('XADD', KEYS[11], 'MAXLEN', '~', ARGV[6], '*', 'sale', sale_json)
+            elseif ARGV[1] == 'NONE' then
+                entry_id = redis.call('XADD', KEYS[3], '*', 'sale', sale_json)
+            else
+                entry_id = redis.call('XADD', KEYS[3], ARGV[1], '~', ARGV[2], '*', 'sale', sale_json)
+            end
+            if is_test ~= '1' then
+                redis.call('XADD', KEYS[14], 'MAXLEN', '~', ARGV[7], '*', 'method', 'POST', 'path', '/sync-sale-history', 'body', sale_json)
+                -- Con los totales ya sumados: el dashboard los pinta tal cual, sin releer los agregados
+                redis.call('PUBLISH', ARGV[9], '{"sales_count":' .. sales_count .. ',"total_revenue":' .. revenue .. ',"sale":' .. sale_json .. '}')
+            end
+            bloom_add(bloom_current, positions, dedup_ttl)
+            results[i] = {'ok', old_stock, new_stock, product_json, entry_id, event}
+        end
+    end
+end
+return results
+"""
+sale_commit_script = None # Se registra en startup (redis-py usa EVALSHA y recarga el script si Redis lo perdió)
+
+# [NUEVO] Estadística de usuario creado: deduplicación por id del mensaje + INCR + HSET en un solo viaje.
+# KEYS: 1=contador de usuarios, 2=hash de usuarios, 3=Bloom actual, 4=Bloom anterior
+# ARGV: 1=TTL del Bloom, 2=posiciones del id ("" si no tiene), 3=email, 4=JSON del evento, 5=canal de usuarios del dashboard
+# Retorna el nuevo total, o -1 si el evento ya fue procesado.
+USER_STATS_LUA = DEDUP_BLOOM_LUA + """
+if bloom_seen(KEYS[3], ARGV[2]) or bloom_seen(KEYS[4], ARGV[2]) then
+    return -1
+end
+local total = redis.call('INCR', KEYS[1])
+-- HSET es idempotente por naturaleza (sobrescribe la misma clave)
+redis.call('HSET', KEYS[2], ARGV[3], ARGV[4])
+bloom_add(KEYS[3], ARGV[2], tonumber(ARGV[1]))
+redis.call('PUBLISH', ARGV[5], '{"total":' .. total .. '}')
+return total
+"""
+user_stats_script = None
+
+def register_redis_scripts():
+    global sale_commit_script, product_write_script, user_stats_script, outbox_lease_script, outbox_advance_script
+    r = get_redis_client()
+    if r:
+        sale_commit_script = r.register_script(SALE_COMMIT_LUA)
+        product_write_script = r.register_script(PRODUCT_WRITE_LUA)
+        user_stats_script = r.register_script(USER_STATS_LUA)
+        outbox_lease_script = r.register_script(OUTBOX_LEASE_LUA)
+        outbox_advance_script = r.register_script(OUTBOX_ADVANCE_LUA)
+
+def is_test_sale(notification: SaleNotification) -> bool:
+    return notification.branch_id.startswith("TEST") or notification.product_id == TEST_PRODUCT_ID
+
+async def commit_sales(notifications: List[SaleNotification]) -> list:
+    """
+    Confirma un lote de ventas con un único EVALSHA.
+    Retorna por venta (estado, stock_anterior, stock_nuevo, JSON del producto, ID en el stream).
+    Lanza excepción si Redis no está disponible (el llamador decide cómo reintentar).
+    """
+    r = get_redis_client()
+    if not r or not sale_commit_script:
+        raise ConnectionError("Redis no disponible")
+    keys = [
+        INVENTORY_HASH_KEY, INVENTORY_STOCK_HASH_KEY, SALES_STREAM_KEY,
+        SALES_STATS_KEY, SALES_STATS_UNITS_KEY, SALES_STATS_BRANCH_KEY, SALES_STATS_HOURLY_KEY,
+        INVENTORY_VERSION_KEY, *dedup_generation_keys(SALE_DEDUP_KEY_PREFIX),
+        TEST_SALES_STREAM_KEY, *dedup_generation_keys(TEST_SALE_DEDUP_KEY_PREFIX), OUTBOX_STREAM_KEY,
+        INVENTORY_CHANGELOG_KEY,
+    ]
+    args = [*sales_retention_args(), 2 * DEDUP_WINDOW_SECONDS, INVENTORY_EVENTS_CHANNEL, len(notifications),
+            TEST_SALES_STREAM_MAXLEN, OUTBOX_MAXLEN, INVENTORY_CHANGELOG_MAXLEN, DASHBOARD_SALES_CHANNEL]
+    for notification in notifications:
+        args.extend([
+            notification.product_id,
+            notification.quantity_sold,
+            1 if is_test_sale(notification) else 0,
+            notification.json_payload,
+            bloom_positions(notification.sale_id),
+            notification.branch_id,
+            notification.total_amount,
+            sale_hour_bucket(notification.timestamp),
+        ])
+    started = time.perf_counter()
+    try:
+        results = await sale_commit_script(keys=keys, args=args)
+    except Exception as e:
+        note_redis_error(e)
+        raise
+    STAGE_METRICS["redis_commit"].observe((time.perf_counter() - started) * 1000)
+    for result in results:
+        apply_local_inventory_event(result[5])
+    return results
+
+# [NUEVO] Respuesta de GET /inventory pre-serializada.
+# Se reconstruye solo cuando cambia la versión del inventario; el resto de peticiones
+# sirve los mismos bytes sin json.loads, sin re-validar el response_model y sin re-serializar.
+PRODUCT_LIST_ADAPTER = TypeAdapter(List[Product]) # Serializador JSON nativo (Rust) de pydantic
+inventory_payload_cache = {"version": None, "body": b"[]", "etag": None}
+
+async def get_inventory_payload():
+    """Retorna (bytes JSON, ETag) del inventario. Si nada cambió, basta comparar la versión."""
+    cache = inventory_payload_cache
+    if inventory_cache.ready:
+        version = inventory_cache.version # Sin viaje a Redis: la caché local ya conoce la versión vigente
+    else:
+        r = get_redis_client()
+        try:
+            version = int(await r.get(INVENTORY_VERSION_KEY) or 0) if r else None
+        except Exception as e:
+            note_redis_error(e)
+            logger.error(f"Error al leer versión del inventario: {e}")
+            version = None
+        if version is None:
+            # Redis caído: última foto buena (marcada como desactualizada por stale_inventory)
+            version, products = stale_inventory()
+            if version is None or (cache["etag"] is not None and version == cache["version"]):
+                return cache["body"], cache["etag"]
+            return build_inventory_payload(version, products)
+    if cache["etag"] is not None and version == cache["version"]:
+        return cache["body"], cache["etag"]
+
+    version, products = await get_inventory_snapshot()
+    return build_inventory_payload(version, products)
+
+def build_inventory_payload(version, products: List[Product]):
+    cache = inventory_payload_cache
+    body = PRODUCT_LIST_ADAPTER.dump_json(sorted(products, key=lambda p: p.id))
+    etag = f'"{hashlib.blake2b(body, digest_size=10).hexdigest()}"'
+    cache.update(version=version, body=body, etag=etag)
+    return body, etag
+
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    if not if_none_match or not etag:
         return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
 
 # -----------------------------------------------------------------
 
 # --- FUNCIONES ASÍNCRONAS DE SINCRONIZACIÓN ---
-async def sync_with_branches(method: str, endpoint: str, data: dict = None):
-    branch_urls_str = os.getenv("BRANCHES", "http://sucursal-demo:8002")
-    branch_urls = branch_urls_str.split(",")
-    
-    async with httpx.AsyncClient(timeout=5.0) as client:
-        tasks = []
-        for branch_url in branch_urls:
-            url = f"{branch_url}{endpoint}"
-            try:
-                if method == "POST":
-                    tasks.append(client.post(url, json=data))
-                elif method == "PUT":
-                    tasks.append(client.put(url, json=data))
-                elif method == "DELETE":
-                    tasks.append(client.delete(url))
-            except Exception as e:
-                logger.error(f"❌ [{SERVER_NAME}] Error creando tarea de sincronización para {url}: {e}")
-                
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        for branch_url, res in zip(branch_urls, results):
-            if isinstance(res, Exception):
-                logger.error(f"❌ [{SERVER_NAME}] Error al sincronizar con {branch_url}: {res}")
-            elif res and res.status_code >= 400:
-                logger.error(f"⚠️ [{SERVER_NAME}] Sucursal {branch_url} devolvió {res.status_code}")
-            else:
-                logger.info(f"✅ [{SERVER_NAME}] Sincronizado con {branch_url} ({endpoint})")
-
-
-# --- INICIO DE LA CORRECCIÓN (Stock Independiente) ---
-async def sync_sale_updates(notification_data: dict, product_to_sync: Optional[dict] = None, old_stock: Optional[int] = None):
+http_client: Optional[httpx.AsyncClient] = None
+# Cupo de peticiones simultáneas por sucursal: una sucursal lenta no acapara las conexiones del pool
+branch_slots: Dict[str, asyncio.Semaphore] = {}
+# Cupo global del fan-out: con cientos de sucursales no se abren cientos de peticiones a la vez
+sync_fanout_slots: Optional[asyncio.Semaphore] = None
+
+def init_http_client():
+    """Cliente HTTP compartido (pool keep-alive, HTTP/2 opcional) para sincronizar con las sucursales."""
+    global http_client, sync_fanout_slots
+    per_branch = max(1, SYNC_MAX_CONNECTIONS_PER_BRANCH)
+    fanout = max(1, SYNC_FANOUT_CONCURRENCY)
+    http2 = SYNC_HTTP2 and HTTP2_AVAILABLE
+    http_client = httpx.AsyncClient(
+        http2=http2, # Con HTTP/2 las peticiones a una sucursal se multiplexan en una conexión
+        limits=httpx.Limits(
+            # El cupo global ya limita las peticiones en vuelo; el pool solo necesita una conexión por turno
+            max_connections=fanout,
+            max_keepalive_connections=fanout,
+            keepalive_expiry=SYNC_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(SYNC_READ_TIMEOUT, connect=SYNC_CONNECT_TIMEOUT, pool=SYNC_POOL_TIMEOUT),
+    )
+    sync_fanout_slots = asyncio.Semaphore(fanout)
+    branch_slots.clear()
+    branch_slots.update({branch_url: asyncio.Semaphore(per_branch) for branch_url in BRANCHES})
+    logger.info(f"🌐 [{SERVER_NAME}] Cliente HTTP de sincronización listo (fan-out máx. {fanout}, HTTP/2: {'sí' if http2 else 'no'}).")
+
+async def close_http_client():
+    global http_client
+    if http_client:
+        await http_client.aclose()
+    http_client = None
+
+class CircuitState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+class BranchCircuitOpen(Exception):
+    """La sucursal tiene el circuito abierto: la petición no se envía."""
+
+class BranchCircuit:
     """
-    CORREGIDO: Esta función ahora SOLO sincroniza el historial de ventas
-    y YA NO sobrescribe el stock de las sucursales.
+    Salud de una sucursal vista desde esta instancia: ventana de resultados (tasa de error), EWMA de latencia
+    y circuito closed -> open -> half_open (una sola petición de prueba) -> closed/open.
     """
-    notification = SaleNotification(**notification_data)
+    def __init__(self, url: str):
+        self.url = url
+        self.state = CircuitState.CLOSED
+        self.outcomes = deque(maxlen=max(1, BRANCH_CB_WINDOW)) # True = fallo
+        self.consecutive_failures = 0
+        self.latency_ewma_ms: Optional[float] = None
+        self.open_seconds = BRANCH_CB_OPEN_SECONDS
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.skipped = 0 # Peticiones no enviadas por circuito abierto
+        self.last_error: Optional[str] = None
+
+    def retry_in(self) -> float:
+        """Segundos hasta que se permita la próxima petición (0 si ya se puede enviar)."""
+        if self.state == CircuitState.OPEN:
+            return max(0.0, self.opened_at + self.open_seconds - time.monotonic())
+        if self.state == CircuitState.HALF_OPEN and self.probe_in_flight:
+            return self.open_seconds
+        return 0.0
+
+    def allow(self) -> bool:
+        if self.state == CircuitState.CLOSED:
+            return True
+        if self.retry_in() > 0:
+            self.skipped += 1
+            return False
+        self.state = CircuitState.HALF_OPEN
+        self.probe_in_flight = True
+        logger.info(f"🔄 [{SERVER_NAME}] Circuito HALF_OPEN para {self.url}: enviando petición de prueba")
+        return True
+
+    def error_rate(self) -> float:
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
 
-    # 1. Sincronizar historial (para que la sucursal vea la venta en su dashboard)
-    await sync_with_branches("POST", "/sync-sale-history", notification_data)
-    logger.info(f"✅ [{SERVER_NAME}] Tarea de sincronización de historial ({notification.sale_id}) ejecutada.")
+    def _observe(self, failed: bool, latency_ms: float):
+        self.outcomes.append(failed)
+        if self.latency_ewma_ms is None:
+            self.latency_ewma_ms = latency_ms
+        else:
+            self.latency_ewma_ms += BRANCH_LATENCY_EWMA_ALPHA * (latency_ms - self.latency_ewma_ms)
+
+    def record_success(self, latency_ms: float):
+        self._observe(False, latency_ms)
+        self.consecutive_failures = 0
+        if self.state != CircuitState.CLOSED:
+            logger.info(f"🟢 [{SERVER_NAME}] Circuito CLOSED para {self.url}: la sucursal respondió")
+            self.outcomes.clear() # La ventana previa describe la caída, no el estado actual
+            self.outcomes.append(False)
+        self.state = CircuitState.CLOSED
+        self.probe_in_flight = False
+        self.open_seconds = BRANCH_CB_OPEN_SECONDS
+
+    def record_failure(self, latency_ms: float, error: str):
+        self._observe(True, latency_ms)
+        self.consecutive_failures += 1
+        self.last_error = error
+        if self.state == CircuitState.HALF_OPEN:
+            self.open_seconds = min(self.open_seconds * 2, BRANCH_CB_MAX_OPEN_SECONDS)
+            self._open()
+            logger.warning(f"⚠️ [{SERVER_NAME}] Prueba fallida para {self.url} ({error}). Próximo intento en {self.open_seconds:g}s")
+        elif self.state == CircuitState.CLOSED and (
+            self.consecutive_failures >= BRANCH_CB_CONSECUTIVE_FAILURES
+            or (len(self.outcomes) >= BRANCH_CB_MIN_REQUESTS and self.error_rate() >= BRANCH_CB_ERROR_RATE)
+        ):
+            self._open()
+            logger.error(f"❌ [{SERVER_NAME}] Circuito OPEN para {self.url} ({error}). Se salta durante {self.open_seconds:g}s")
+
+    def _open(self):
+        self.state = CircuitState.OPEN
+        self.opened_at = time.monotonic()
+        self.probe_in_flight = False
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state.value,
+            "error_rate": round(self.error_rate(), 3),
+            "window": len(self.outcomes),
+            "consecutive_failures": self.consecutive_failures,
+            "latency_ewma_ms": round(self.latency_ewma_ms, 2) if self.latency_ewma_ms is not None else None,
+            "retry_in_seconds": round(self.retry_in(), 2),
+            "skipped": self.skipped,
+            "last_error": self.last_error,
+        }
+
+branch_circuits: Dict[str, BranchCircuit] = {}
 
-    # 2. El bloque que enviaba el "PUT /inventory/{product_id}" ha sido eliminado.
+def get_branch_circuit(branch_url: str) -> BranchCircuit:
+    circuit = branch_circuits.get(branch_url)
+    if circuit is None:
+        circuit = branch_circuits[branch_url] = BranchCircuit(branch_url)
+    return circuit
+
+def is_branch_failure(response: httpx.Response) -> bool:
+    """5xx, 408 y 429 cuentan contra la sucursal; otros 4xx son rechazos de la petición, no fallos de la sucursal."""
+    return response.status_code >= 500 or response.status_code in (408, 429)
+
+async def acquire_branch_slots(branch_slot: asyncio.Semaphore):
+    await branch_slot.acquire()
+    try:
+        await sync_fanout_slots.acquire()
+    except BaseException:
+        branch_slot.release()
+        raise
+
+async def _send_to_branch(client: httpx.AsyncClient, branch_url: str, method: str, endpoint: str,
+                          data: dict = None, raw_json: Optional[str] = None) -> httpx.Response:
+    if raw_json is not None:
+        return await client.request(method, f"{branch_url}{endpoint}", content=raw_json, headers={"Content-Type": "application/json"})
+    return await client.request(method, f"{branch_url}{endpoint}", json=data)
+
+async def send_to_branch(client: httpx.AsyncClient, branch_url: str, method: str, endpoint: str,
+                         data: dict = None, raw_json: Optional[str] = None) -> httpx.Response:
+    """
+    Una petición a una sucursal: turno de la sucursal + turno global y luego la petición, cada fase con su plazo.
+    Solo la petición cuenta para el circuito: esperar turno porque el cupo local está lleno no es culpa de la sucursal.
+    Con el circuito abierto falla al instante con BranchCircuitOpen, sin tocar la red.
+    """
+    circuit = get_branch_circuit(branch_url)
+    if not circuit.allow():
+        raise BranchCircuitOpen(f"circuito abierto para {branch_url}")
+    slot = branch_slots.get(branch_url)
+    if slot is None:
+        slot = branch_slots[branch_url] = asyncio.Semaphore(max(1, SYNC_MAX_CONNECTIONS_PER_BRANCH))
+    try:
+        await asyncio.wait_for(acquire_branch_slots(slot), SYNC_REQUEST_DEADLINE_SECONDS)
+    except BaseException as e:
+        circuit.probe_in_flight = False # La prueba no llegó a salir: el circuito queda como estaba
+        if isinstance(e, asyncio.TimeoutError):
+            raise TimeoutError(f"sin turno de envío en {SYNC_REQUEST_DEADLINE_SECONDS:g}s (cupo local saturado)") from None
+        raise
+    try:
+        started = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(_send_to_branch(client, branch_url, method, endpoint, data, raw_json),
+                                              SYNC_REQUEST_DEADLINE_SECONDS)
+        except asyncio.TimeoutError:
+            circuit.record_failure((time.perf_counter() - started) * 1000, "timeout")
+            raise TimeoutError(f"sin respuesta en {SYNC_REQUEST_DEADLINE_SECONDS:g}s") from None
+        except asyncio.CancelledError:
+            circuit.probe_in_flight = False # Una prueba cancelada no debe dejar el circuito bloqueado
+            raise
+        except Exception as e:
+            circuit.record_failure((time.perf_counter() - started) * 1000, type(e).__name__)
+            raise
+    finally:
+        sync_fanout_slots.release()
+        slot.release()
+    if is_branch_failure(response):
+        circuit.record_failure((time.perf_counter() - started) * 1000, f"HTTP {response.status_code}")
+    else:
+        circuit.record_success((time.perf_counter() - started) * 1000)
+    return response
+
+async def sync_with_branches(method: str, endpoint: str, data: dict = None, raw_json: Optional[str] = None):
+    """Envía el cambio a todas las sucursales. 'raw_json' permite reenviar un JSON ya serializado sin volver a codificarlo."""
+    client = http_client
+    if client is None:
+        logger.error(f"❌ [{SERVER_NAME}] Cliente HTTP no inicializado. Sincronización {endpoint} omitida.")
+        return
+    branch_urls = branch_urls_view
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(send_to_branch(client, branch_url, method, endpoint, data, raw_json) for branch_url in branch_urls),
+        return_exceptions=True,
+    )
+    STAGE_METRICS["branch_sync"].observe((time.perf_counter() - started) * 1000)
     
-    is_test_sale = notification.branch_id.startswith("TEST") or notification.product_id == TEST_PRODUCT_ID
-    stock_changed = product_to_sync and old_stock is not None and product_to_sync.get('stock') != old_stock
+    for branch_url, res in zip(branch_urls, results):
+        if isinstance(res, BranchCircuitOpen):
+            continue # Sucursal caída conocida: ni espera ni log por cada cambio
+        if isinstance(res, Exception):
+            logger.error(f"❌ [{SERVER_NAME}] Error al sincronizar con {branch_url}: {res}")
+        elif res and res.status_code >= 400:
+            logger.error(f"⚠️ [{SERVER_NAME}] Sucursal {branch_url} devolvió {res.status_code}")
+        else:
+            logger.info(f"✅ [{SERVER_NAME}] Sincronizado con {branch_url} ({endpoint})")
+
+
+# --- REGISTRO DE SUCURSALES (heartbeats con TTL en Redis, vista cacheada en memoria) ---
+# Vista que usan el fan-out y el outbox; se refresca en segundo plano y no consulta Redis en cada sincronización
+branch_urls_view: List[str] = list(BRANCHES)
+branch_last_seen: Dict[str, float] = {} # url -> último heartbeat visto (solo sucursales registradas)
+
+def refresh_branch_view(registered: Dict[str, float]):
+    global branch_urls_view
+    branch_last_seen.clear()
+    branch_last_seen.update(registered)
+    view = list(dict.fromkeys([*BRANCHES, *sorted(registered)])) # La semilla fija primero, sin duplicados
+    for branch_url in set(branch_circuits) - set(view):
+        del branch_circuits[branch_url]
+    if view != branch_urls_view:
+        logger.info(f"🏪 [{SERVER_NAME}] Registro de sucursales: {len(view)} activas ({len(view) - len(BRANCHES)} por heartbeat).")
+    branch_urls_view = view
+
+async def branch_registry_refresher():
+    """Tarea de fondo: poda las sucursales sin heartbeat y recarga la vista. Si Redis cae, se conserva la última vista."""
+    while True:
+        r = get_redis_client()
+        if r:
+            try:
+                cutoff = time.time() - BRANCH_TTL_SECONDS
+                expired = await r.zrangebyscore(BRANCH_REGISTRY_KEY, "-inf", cutoff)
+                pipeline = r.pipeline(transaction=False)
+                pipeline.zremrangebyscore(BRANCH_REGISTRY_KEY, "-inf", cutoff)
+                if expired:
+                    pipeline.hdel(BRANCH_REGISTRY_IDS_KEY, *expired)
+                pipeline.zrange(BRANCH_REGISTRY_KEY, 0, -1, withscores=True)
+                results = await pipeline.execute()
+                refresh_branch_view(dict(results[-1]))
+            except Exception as e:
+                note_redis_error(e)
+                logger.error(f"❌ [{SERVER_NAME}] No se pudo refrescar el registro de sucursales: {e}")
+        await asyncio.sleep(BRANCH_REGISTRY_REFRESH_SECONDS)
+
+
+# --- OUTBOX HACIA SUCURSALES (entrega durable, fuera del camino del commit) ---
+# Lease por sucursal: se adquiere si está libre o se renueva si ya es nuestro
+OUTBOX_LEASE_LUA = """
+local holder = redis.call('GET', KEYS[1])
+if holder == false or holder == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+return 0
+"""
+outbox_lease_script = None
+# El cursor solo avanza si seguimos teniendo el lease (otra instancia pudo tomarlo durante un reintento largo).
+# Cada avance renueva el lease: una pasada larga (muchos grupos) no lo deja vencer a mitad de camino
+OUTBOX_ADVANCE_LUA = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+redis.call('PEXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+outbox_advance_script = None
+outbox_status: Dict[str, dict] = {} # sucursal -> estado del despachador en esta instancia (para /metrics)
+# Los despachadores sin pendientes esperan este evento en vez de consultar Redis cada uno por su cuenta;
+# se reemplaza por uno nuevo en cada aviso, así ningún despachador se pierde una entrada
+outbox_wakeup = asyncio.Event()
+
+def group_outbox_entries(entries: list) -> List[list]:
+    """Agrupa ventas consecutivas (un solo POST por lotes); el resto se entrega de a una, en orden."""
+    groups = []
+    for entry in entries:
+        if groups and entry[1]["path"] == SALE_HISTORY_PATH and groups[-1][-1][1]["path"] == SALE_HISTORY_PATH:
+            groups[-1].append(entry)
+        else:
+            groups.append([entry])
+    return groups
+
+async def deliver_outbox_group(client: httpx.AsyncClient, branch_url: str, group: list):
+    """Lanza excepción si hay que reintentar (red, 5xx, 408/429); un 4xx permanente se registra y se da por entregado."""
+    fields = group[0][1]
+    if fields["path"] == SALE_HISTORY_PATH:
+        method, path = "POST", f"{SALE_HISTORY_PATH}/batch"
+        body = "[" + ",".join(fields["body"] for _entry_id, fields in group) + "]"
+    else:
+        method, path, body = fields["method"], fields["path"], fields["body"] or None
+    started = time.perf_counter()
+    response = await send_to_branch(client, branch_url, method, path, raw_json=body)
+    STAGE_METRICS["branch_sync"].observe((time.perf_counter() - started) * 1000)
+    if is_branch_failure(response):
+        raise RuntimeError(f"{method} {path} devolvió {response.status_code}")
+    if response.status_code >= 400:
+        logger.warning(f"⚠️ [{SERVER_NAME}] Sucursal {branch_url} rechazó {method} {path} ({response.status_code}). Se descarta.")
+
+def outbox_lease_ms() -> int:
+    # Entre dos renovaciones cabe una entrega completa: espera de turno + petición, cada una con su plazo
+    return int(max(OUTBOX_LEASE_SECONDS, 2 * SYNC_REQUEST_DEADLINE_SECONDS + 1) * 1000)
+
+async def outbox_branch_dispatcher(branch_url: str):
+    """
+    Tarea de fondo (una por sucursal): mientras esta instancia tenga el lease, lee el outbox desde el cursor
+    de la sucursal, entrega en orden y avanza el cursor. Ante un fallo el cursor se queda y se reintenta con backoff;
+    con el circuito de la sucursal abierto no se envía nada y los cambios esperan en el outbox. Al quedar al día espera el aviso de outbox_tail_watcher (o la renovación del lease).
+    """
+    lease_key = f"{OUTBOX_LEASE_KEY_PREFIX}:{branch_url}"
+    status = outbox_status.setdefault(branch_url, {"owner": False, "cursor": None, "delivered": 0, "last_error": None})
+    backoff = 1.0
+    while True:
+        r = get_redis_client()
+        client = http_client
+        if not r or client is None or not outbox_lease_script:
+            await asyncio.sleep(1.0)
+            continue
+        wakeup = outbox_wakeup # Se toma antes de leer: una entrada que llegue después de la lectura nos despierta
+        try:
+            status["owner"] = bool(await outbox_lease_script(keys=[lease_key], args=[INSTANCE_ID, outbox_lease_ms()]))
+            if not status["owner"]:
+                await asyncio.sleep(OUTBOX_LEASE_SECONDS / 2)
+                continue
+            retry_in = get_branch_circuit(branch_url).retry_in()
+            if retry_in > 0:
+                await asyncio.sleep(min(retry_in, OUTBOX_LEASE_SECONDS / 2)) # Sin soltar el lease
+                continue
+            cursor = await r.hget(OUTBOX_CURSORS_KEY, branch_url) or "0-0"
+            entries = await r.xrange(OUTBOX_STREAM_KEY, min=f"({cursor}", max="+", count=OUTBOX_BATCH_SIZE)
+        except Exception as e:
+            note_redis_error(e)
+            logger.error(f"❌ [{SERVER_NAME}] Outbox: no se pudo leer para {branch_url}: {e}")
+            await asyncio.sleep(1.0)
+            continue
+        status["cursor"] = cursor
+        if not entries:
+            try:
+                await asyncio.wait_for(wakeup.wait(), OUTBOX_LEASE_SECONDS / 2)
+            except asyncio.TimeoutError:
+                pass # Toca renovar el lease
+            continue
+        try:
+            for group in group_outbox_entries(entries):
+                await deliver_outbox_group(client, branch_url, group)
+                last_id = group[-1][0]
+                if not await outbox_advance_script(keys=[lease_key, OUTBOX_CURSORS_KEY], args=[INSTANCE_ID, branch_url, last_id, outbox_lease_ms()]):
+                    status["owner"] = False
+                    break # Lease perdido: la otra instancia retoma desde el cursor guardado
+                status["cursor"] = last_id
+                status["delivered"] += len(group)
+            backoff = 1.0
+            status["last_error"] = None
+        except BranchCircuitOpen:
+            continue # Otro envío tiene la prueba half-open en curso: se espera al circuito
+        except Exception as e:
+            status["last_error"] = str(e)
+            if get_branch_circuit(branch_url).state != CircuitState.CLOSED:
+                backoff = 1.0
+                continue # El circuito se abrió: él marca cuándo volver a probar
+            logger.warning(f"⚠️ [{SERVER_NAME}] Outbox: entrega a {branch_url} fallida ({e}). Reintentando en {backoff:.0f}s...")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, OUTBOX_RETRY_MAX_BACKOFF)
+
+async def outbox_tail_watcher():
+    """Tarea de fondo: una sola consulta al final del outbox por instancia; avisa a los despachadores si hay entradas nuevas."""
+    global outbox_wakeup
+    last_id = None
+    while True:
+        r = get_redis_client()
+        if r:
+            try:
+                tail = await r.xrevrange(OUTBOX_STREAM_KEY, count=1)
+                tail_id = tail[0][0] if tail else None
+                if tail_id != last_id:
+                    last_id = tail_id
+                    wakeup, outbox_wakeup = outbox_wakeup, asyncio.Event()
+                    wakeup.set()
+            except Exception as e:
+                note_redis_error(e)
+        await asyncio.sleep(OUTBOX_IDLE_POLL_SECONDS)
 
-    if product_to_sync and not is_test_sale and stock_changed:
-        product_name = product_to_sync.get('name', 'Producto Desconocido')
-        logger.info(f"ℹ️ [{SERVER_NAME}] Stock central de {product_name} actualizado. NO se sincroniza stock a sucursales.")
-    elif is_test_sale:
-        logger.warning(f"⚠️ [{SERVER_NAME}] Es venta de prueba, se omite la sincronización PUT de Stock.")
-# --- FIN DE LA CORRECCIÓN ---
+async def outbox_dispatch_manager():
+    """Tarea de fondo: mantiene un despachador por sucursal de la vista del registro (altas y bajas en caliente)."""
+    dispatchers: Dict[str, asyncio.Task] = {}
+    try:
+        while True:
+            wanted = set(branch_urls_view)
+            for branch_url in set(dispatchers) - wanted:
+                dispatchers.pop(branch_url).cancel() # Su cursor queda guardado por si vuelve
+                outbox_status.pop(branch_url, None)
+            for branch_url in wanted - set(dispatchers):
+                dispatchers[branch_url] = asyncio.create_task(outbox_branch_dispatcher(branch_url))
+            await asyncio.sleep(BRANCH_REGISTRY_REFRESH_SECONDS)
+    finally:
+        for task in dispatchers.values():
+            task.cancel()
+        await asyncio.gather(*dispatchers.values(), return_exceptions=True)
+
+async def outbox_trimmer():
+    """Tarea de fondo: recorta el outbox hasta la entrada más antigua que alguna sucursal todavía no recibió."""
+    while True:
+        await asyncio.sleep(OUTBOX_TRIM_INTERVAL_SECONDS)
+        r = get_redis_client()
+        branch_urls = branch_urls_view
+        if not r or not branch_urls:
+            continue
+        try:
+            cursors = await r.hmget(OUTBOX_CURSORS_KEY, branch_urls)
+            if all(cursors):
+                oldest = min(cursors, key=lambda entry_id: tuple(int(part) for part in entry_id.split("-")))
+                await r.xtrim(OUTBOX_STREAM_KEY, minid=oldest, approximate=True)
+        except Exception as e:
+            note_redis_error(e)
+            logger.error(f"❌ [{SERVER_NAME}] No se pudo recortar el outbox: {e}")
 
+async def sales_stats_pruner():
+    """Tarea de fondo: borra los buckets horarios de ventas que ya quedaron fuera de la ventana de GET /stats."""
+    while True:
+        r = get_redis_client()
+        if r:
+            oldest_bucket = sale_hour_bucket(datetime.now(timezone.utc) - timedelta(hours=SALES_STATS_MAX_HOURS))
+            try:
+                # Los buckets "YYYY-MM-DDTHH" se ordenan como texto
+                expired = [field async for field, _value in r.hscan_iter(SALES_STATS_HOURLY_KEY, count=1000)
+                           if field.split("|", 1)[0] < oldest_bucket]
+                for start in range(0, len(expired), 1000):
+                    await r.hdel(SALES_STATS_HOURLY_KEY, *expired[start:start + 1000])
+                if expired:
+                    logger.info(f"🧹 [{SERVER_NAME}] {len(expired)} campos de agregados horarios anteriores a {oldest_bucket} eliminados.")
+            except Exception as e:
+                note_redis_error(e)
+                logger.error(f"❌ [{SERVER_NAME}] No se pudieron podar los agregados horarios de ventas: {e}")
+        await asyncio.sleep(SALES_STATS_PRUNE_INTERVAL_SECONDS)
 
 # --- LÓGICA DE NEGOCIO (Refactorizada para Redis) ---
 # [CORRECCIÓN V5.1] Convertida a 'async def'
-async def process_sale_notification(notification_data: dict):
+async def process_sale_notification(notification: SaleNotification):
     """
     Procesa la venta y la guarda en Redis.
     Esta función AHORA ES ASÍNCRONA.
+    El commit (idempotencia, stock, historial y agregados) es un único script atómico en Redis.
+    Recibe la venta ya validada en el borde (HTTP o AMQP); no se vuelve a validar aquí.
     """
     try:
-        # --- INICIO DE LA CORRECCIÓN (Triplicación / Idempotencia) ---
-        r = get_redis_client()
-        sale_id = notification_data.get('sale_id')
-        
+        sale_id = notification.sale_id
         if not sale_id:
             logger.warning(f"⚠️ [{SERVER_NAME}] Venta recibida sin sale_id, no se puede garantizar idempotencia. Procesando...")
-        elif r:
-            lock_key = f"sale_lock:{sale_id}"
-            # Intentamos establecer el lock (SET if Not Exists) con 1h de expiración
-            try:
-                is_first_instance = await asyncio.to_thread(r.set, lock_key, "processed", nx=True, ex=3600)
-                if not is_first_instance:
-                    logger.info(f"ℹ️ [{SERVER_NAME}] Venta {sale_id} ya está siendo procesada o fue procesada por otra instancia. Omitiendo.")
-                    return "skipped" # Devolvemos "skipped" para manejarlo en el endpoint HTTP
-            except Exception as e:
-                logger.error(f"❌ [{SERVER_NAME}] Error al verificar el lock de Redis para {sale_id}: {e}. Procesando de todas formas (riesgo de duplicado).")
-        # --- FIN DE LA CORRECCIÓN ---
 
-        notification = SaleNotification(**notification_data)
-        product = await get_product_from_redis(notification.product_id)
+        [(status, old_stock, new_stock, product_json, _entry_id, _event)] = await commit_sales([notification])
 
-        if not product:
+        if status == "duplicate":
+            logger.info(f"ℹ️ [{SERVER_NAME}] Venta {sale_id} ya está siendo procesada o fue procesada por otra instancia. Omitiendo.")
+            return "skipped" # Devolvemos "skipped" para manejarlo en el endpoint HTTP
+        if status == "not_found":
             logger.error(f"❌ [{SERVER_NAME}] Venta fallida: Producto ID {notification.product_id} no encontrado en Redis.")
             return None # Devolvemos None para "producto no encontrado"
 
-        old_stock = product.stock
-        product_to_sync = None 
-        is_test_sale = notification.branch_id.startswith("TEST") or notification.product_id == TEST_PRODUCT_ID
-        
-        if not is_test_sale:
-            product.stock = max(0, product.stock - notification.quantity_sold)
-            logger.info(f"🟢 [{SERVER_NAME}] [VENTA PROCESADA] {notification.branch_id} - {notification.quantity_sold}x {product.name} | Stock: {product.stock}")
-            
-            if product.stock != old_stock:
-                 await save_product_to_redis(product)
-                 product_to_sync = product.model_dump()
+        product_name = json.loads(product_json).get("name", "Producto Desconocido")
+        if not is_test_sale(notification):
+            logger.info(f"🟢 [{SERVER_NAME}] [VENTA PROCESADA] {notification.branch_id} - {notification.quantity_sold}x {product_name} | Stock: {new_stock}")
         else:
-            logger.warning(f"⚠️ [{SERVER_NAME}] [TEST VENTA] {notification.branch_id} - {notification.quantity_sold}x {product.name} | Stock CENTRAL NO MODIFICADO.")
-            if notification.product_id == TEST_PRODUCT_ID:
-                 notification.total_amount = 0.0
-                 notification.money_received = 0.0
-                 notification.change = 0.0
-        
-        # Guardar la venta en Redis
-        await save_sale_to_redis(notification)
-        
-        # Sincronizar con sucursales
-        try:
-            # [CORRECCIÓN V5.1] 'await' directo, sin 'asyncio.run()'
-            await sync_sale_updates(notification.model_dump(mode='json'), product_to_sync, old_stock)
-        except Exception as e:
-             logger.error(f"❌ [{SERVER_NAME}] Fallo en la sub-tarea de sincronización: {e}")
+            logger.warning(f"⚠️ [{SERVER_NAME}] [TEST VENTA] {notification.branch_id} - {notification.quantity_sold}x {product_name} | Stock CENTRAL NO MODIFICADO.")
+            spawn_sales_sync(sync_sales_history_batch([notification]))
+        # Las ventas reales quedaron en el outbox dentro del mismo commit: el despachador las entrega a las sucursales
         
-        return product.stock # Devolvemos el stock (int) en éxito
+        return new_stock # Devolvemos el stock (int) en éxito
     except Exception as e:
-        logger.error(f"❌ [{SERVER_NAME}] Error al procesar la venta: {e}. Datos: {notification_data}")
+        logger.error(f"❌ [{SERVER_NAME}] Error al procesar la venta: {e}. Datos: {notification.json_payload}")
         return None # Devolvemos None en error
+
+# [NUEVO] Ingesta por lotes: un solo commit en Redis y una sola sincronización con sucursales
+SALE_STATUS_LABELS = {"ok": "ok", "duplicate": "duplicate", "not_found": "unknown_product"}
+
+async def commit_sale_batch(notifications: List[SaleNotification]):
+    """Confirma el lote completo. Retorna (estado de cada venta en el mismo orden, ventas confirmadas)."""
+    results = await commit_sales(notifications)
+
+    items, committed = [], []
+    for notification, (status, _old_stock, new_stock, _product_json, _entry_id, _event) in zip(notifications, results):
+        item = {"sale_id": notification.sale_id, "status": SALE_STATUS_LABELS.get(status, status)}
+        if status == "ok":
+            item["updated_stock"] = new_stock
+            committed.append(notification)
+        items.append(item)
+    logger.info(f"📦 [{SERVER_NAME}] Lote de {len(notifications)} ventas procesado ({len(committed)} confirmadas).")
+    return items, committed
+
+sales_sync_tasks: set = set() # Referencias fuertes: el loop solo guarda referencias débiles a las tareas
+
+def spawn_sales_sync(coro) -> asyncio.Task:
+    """Lanza la sincronización en segundo plano sin que el recolector de basura la corte a mitad de camino."""
+    task = asyncio.create_task(coro)
+    sales_sync_tasks.add(task)
+    task.add_done_callback(sales_sync_tasks.discard)
+    return task
+
+async def sync_sales_history_batch(committed: List[SaleNotification]):
+    """Las ventas reales ya están en el outbox (mismo script del commit); aquí solo se sincronizan las de prueba."""
+    test_sales = [n for n in committed if is_test_sale(n)]
+    if not test_sales:
+        return
+    try:
+        await sync_test_sales_history(test_sales)
+    except Exception as e:
+        logger.error(f"❌ [{SERVER_NAME}] Fallo en la sincronización de ventas de prueba: {e}")
+
+test_sync_slots = asyncio.Semaphore(TEST_SYNC_CONCURRENCY)
+
+async def sync_test_sales_history(test_sales: List[SaleNotification]):
+    """Las ventas de prueba se sincronizan con un cupo propio; si está ocupado se omiten (no compiten con las reales)."""
+    if test_sync_slots.locked():
+        logger.info(f"ℹ️ [{SERVER_NAME}] Sincronización de {len(test_sales)} ventas de prueba omitida (cupo ocupado).")
+        return
+    async with test_sync_slots:
+        batch_json = "[" + ",".join(n.json_payload for n in test_sales) + "]"
+        await sync_with_branches("POST", "/sync-sale-history/batch", raw_json=batch_json)
+
+async def process_sale_batch(notifications: List[SaleNotification]) -> List[dict]:
+    """Confirma el lote completo y retorna el estado de cada venta (en el mismo orden), sin esperar a las sucursales."""
+    items, committed = await commit_sale_batch(notifications)
+    spawn_sales_sync(sync_sales_history_batch(committed))
+    return items
         
 # --- LÓGICA DE PROCESAMIENTO DE USUARIOS (Refactorizada para async) ---
 async def process_user_created_event_async(message_data: dict, worker_name: str):
@@ -406,33 +1899,25 @@ async def process_user_created_event_async(message_data: dict, worker_name: str)
         logger.info(f"✅ [{SERVER_NAME}] Email simulado completado.")
     
     elif worker_name == "Estadisticas":
-        if r:
-            # --- INICIO DE LA CORRECCIÓN (Idempotencia de Usuarios) ---
+        if r and user_stats_script:
             user_email = message_data.get('email')
             message_id = message_data.get('id') # El 'id' (UUID) del mensaje de usuario
-            
             if not message_id:
                 logger.warning(f"⚠️ [{SERVER_NAME}] Evento de usuario para {user_email} sin 'id'. No se puede garantizar idempotencia. Procesando...")
-            else:
-                lock_key = f"user_event_lock:{message_id}"
-                try:
-                    # Intentamos establecer el lock (SET if Not Exists) con 1h de expiración
-                    is_first_instance = await asyncio.to_thread(r.set, lock_key, "processed", nx=True, ex=3600)
-                    if not is_first_instance:
-                        logger.info(f"ℹ️ [{SERVER_NAME}] Evento de usuario {message_id} ({user_email}) ya fue procesado por otra instancia. Omitiendo estadísticas.")
-                        return # No procesar de nuevo
-                except Exception as e:
-                    logger.error(f"❌ [{SERVER_NAME}] Error al verificar lock de Redis para {message_id}: {e}. Procesando de todas formas (riesgo de duplicado).")
-            # --- FIN DE LA CORRECCIÓN ---
 
             try:
-                # Esta lógica ahora solo la corre la primera instancia
-                await asyncio.to_thread(r.incr, TOTAL_USERS_KEY)
-                current_total = await asyncio.to_thread(r.get, TOTAL_USERS_KEY)
-                # HSET es idempotente por naturaleza (sobrescribe la misma clave)
-                await asyncio.to_thread(r.hset, USERS_HASH_KEY, user_email, json.dumps(message_data))
+                # Idempotencia + contador + hash en un solo script: solo la primera instancia suma
+                current_total = await user_stats_script(
+                    keys=[TOTAL_USERS_KEY, USERS_HASH_KEY, *dedup_generation_keys(USER_EVENT_DEDUP_KEY_PREFIX)],
+                    args=[2 * DEDUP_WINDOW_SECONDS, bloom_positions(message_id), user_email, json.dumps(message_data),
+                          DASHBOARD_USERS_CHANNEL],
+                )
+                if current_total == -1:
+                    logger.info(f"ℹ️ [{SERVER_NAME}] Evento de usuario {message_id} ({user_email}) ya fue procesado por otra instancia. Omitiendo estadísticas.")
+                    return
                 logger.info(f"🎁 [{SERVER_NAME} - ESTADÍSTICAS] Nuevo usuario ({message_data.get('nombre')}) guardado en Redis. Total Global: {current_total}")
             except Exception as e:
+                note_redis_error(e)
                 logger.error(f"Error guardando usuario en Redis: {e}")
         else:
             logger.warning(f"⚠️ [{SERVER_NAME} - ESTADÍSTICAS] Redis no disponible. El contador de usuarios no se incrementó.")
@@ -441,106 +1926,699 @@ async def process_user_created_event_async(message_data: dict, worker_name: str)
         logger.warning(f"Worker desconocido '{worker_name}' procesando evento de usuario.")
 # -----------------------------------------------------------------
 
-# --- WORKERS Y AMQP (Modificado para llamar a 'asyncio.run') ---
-def callback(ch, method, properties, body):
+# --- MÉTRICAS DE CONSUMIDORES (en memoria, por instancia) ---
+# Permiten ver si el cuello de botella es Redis (redis_commit), la sincronización con sucursales
+# (branch_sync) o el propio consumidor (profundidad de cola / en vuelo / ritmo).
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+PUBLISHED_AT_HEADER = "x-published-at" # Epoch en ms que pone la sucursal al publicar
+
+class LatencyHistogram:
+    """Histograma de buckets fijos (ms). Los percentiles se estiman con el límite superior del bucket."""
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1) # El último bucket es "+Inf"
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, value_ms: float):
+        value_ms = max(value_ms, 0.0)
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, value_ms)] += 1
+        self.count += 1
+        self.total_ms += value_ms
+        self.max_ms = max(self.max_ms, value_ms)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= rank:
+                return float(bound)
+        return self.max_ms
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 2) if self.count else None,
+            "p50_ms": self.percentile(0.50),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": round(self.max_ms, 2),
+            "buckets": {**{str(bound): count for bound, count in zip(LATENCY_BUCKETS_MS, self.counts)}, "+Inf": self.counts[-1]},
+        }
+
+class RateCounter:
+    """Eventos por segundo en ventana deslizante (un contador por segundo: 'window' segundos completos + el en curso)."""
+    def __init__(self, window: int = 60):
+        self.window = window
+        self.seconds = deque() # [(segundo, eventos)]
+
+    def add(self, amount: int = 1):
+        now = int(time.monotonic())
+        if self.seconds and self.seconds[-1][0] == now:
+            self.seconds[-1][1] += amount
+        else:
+            self.seconds.append([now, amount])
+        while self.seconds and self.seconds[0][0] < now - self.window:
+            self.seconds.popleft()
+
+    def per_second(self, span: int) -> float:
+        # Se excluye el segundo en curso (incompleto)
+        now = int(time.monotonic())
+        total = sum(amount for second, amount in self.seconds if now - span <= second < now)
+        return round(total / span, 2)
+
+class ConsumerMetrics:
+    def __init__(self, name: str):
+        self.name = name
+        self.queue = name # Nombre real de la cola (las de instancia llevan '.{SERVER_NAME}')
+        self.received = 0
+        self.acked = 0
+        self.retried = 0
+        self.rejected = 0
+        self.redelivered = 0
+        self.in_flight = 0
+        self.rate = RateCounter()
+        self.processing = LatencyHistogram() # Por micro-lote: de recibir el lote a tener el resultado
+        self.end_to_end = LatencyHistogram() # Por mensaje confirmado: de la publicación en la sucursal al commit
+        self.depth: Optional[int] = None
+        self.consumer_count: Optional[int] = None
+        self.depth_at: Optional[float] = None
+
+    def record_outcomes(self, outcomes: List[str]):
+        self.in_flight -= len(outcomes)
+        acked = outcomes.count(MESSAGE_ACK)
+        self.acked += acked
+        self.retried += outcomes.count(MESSAGE_RETRY)
+        self.rejected += outcomes.count(MESSAGE_REJECT)
+        self.rate.add(acked)
+
+    def snapshot(self) -> dict:
+        return {
+            "queue": self.queue,
+            "received": self.received,
+            "acked": self.acked,
+            "retried": self.retried,
+            "rejected": self.rejected,
+            "redelivered": self.redelivered,
+            "in_flight": self.in_flight,
+            "rate_10s": self.rate.per_second(10),
+            "rate_60s": self.rate.per_second(60),
+            "processing": self.processing.snapshot(),
+            "end_to_end": self.end_to_end.snapshot(),
+            "queue_depth": self.depth,
+            "queue_consumers": self.consumer_count,
+            "queue_depth_age_s": round(time.time() - self.depth_at, 1) if self.depth_at else None,
+        }
+
+consumer_metrics: Dict[str, ConsumerMetrics] = {}
+STAGE_METRICS = {"redis_commit": LatencyHistogram(), "branch_sync": LatencyHistogram()}
+parking_lot_depth = {"depth": None, "at": None}
+
+def get_consumer_metrics(name: str) -> ConsumerMetrics:
+    metrics = consumer_metrics.get(name)
+    if metrics is None:
+        metrics = consumer_metrics[name] = ConsumerMetrics(name)
+    return metrics
+
+def message_published_at_ms(message: aio_pika.abc.AbstractIncomingMessage) -> Optional[float]:
+    """Momento de publicación: cabecera en ms de la sucursal o, si no está, el timestamp AMQP (en segundos)."""
+    published_at = (message.headers or {}).get(PUBLISHED_AT_HEADER)
+    if published_at is not None:
+        try:
+            return float(published_at)
+        except (TypeError, ValueError):
+            pass
+    if message.timestamp is not None:
+        return message.timestamp.timestamp() * 1000
+    return None
+
+QUEUE_DEPTH_POLL_SECONDS = float(os.getenv("QUEUE_DEPTH_POLL_SECONDS", "10"))
+
+async def queue_depth_poller():
+    """Tarea de fondo: consulta (declare pasivo) los mensajes pendientes y consumidores de cada cola."""
+    while True:
+        await asyncio.sleep(QUEUE_DEPTH_POLL_SECONDS)
+        try:
+            connection = await get_amqp_connection()
+        except Exception as e:
+            logger.error(f"❌ [{SERVER_NAME}] Sin conexión AMQP para medir las colas: {e}")
+            continue
+        targets = [(metrics.queue, metrics) for metrics in list(consumer_metrics.values())]
+        targets.append((SALES_PARKING_LOT_QUEUE, None))
+        for queue_name, metrics in targets:
+            try:
+                # Un canal por cola: un declare pasivo fallido (cola inexistente) cierra su canal
+                async with connection.channel() as channel:
+                    queue = await channel.declare_queue(queue_name, passive=True)
+                    depth, consumers = queue.declaration_result.message_count, queue.declaration_result.consumer_count
+            except Exception as e:
+                logger.debug(f"[{SERVER_NAME}] No se pudo medir la cola {queue_name}: {e}")
+                continue
+            if metrics is None:
+                parking_lot_depth.update(depth=depth, at=time.time())
+            else:
+                metrics.depth, metrics.consumer_count, metrics.depth_at = depth, consumers, time.time()
+
+# --- WORKERS Y AMQP (Consumidores asíncronos en el loop de la app) ---
+background_tasks: List[asyncio.Task] = [] # Tareas de fondo de la app (se cancelan en shutdown)
+amqp_connection: Optional[aio_pika.abc.AbstractConnection] = None # Compartida: un canal por consumidor
+amqp_connection_lock = asyncio.Lock()
+
+async def get_amqp_connection() -> aio_pika.abc.AbstractConnection:
+    """Retorna la conexión AMQP compartida, reconectando si se cerró."""
+    global amqp_connection
+    async with amqp_connection_lock:
+        if amqp_connection is None or amqp_connection.is_closed:
+            amqp_connection = await aio_pika.connect(
+                host=RABBITMQ_HOST,
+                port=5672,
+                login=RABBITMQ_USER,
+                password=RABBITMQ_PASS,
+                heartbeat=60,
+            )
+        return amqp_connection
+
+async def close_amqp_connection():
+    global amqp_connection
+    if amqp_connection is not None and not amqp_connection.is_closed:
+        await amqp_connection.close()
+    amqp_connection = None
+
+# Resultado de procesar cada mensaje: se confirma, se descarta (sin reintento) o se devuelve a la cola
+MESSAGE_ACK, MESSAGE_REJECT, MESSAGE_RETRY = "ack", "reject", "retry"
+
+class DeliveryAckTracker:
+    """
+    Confirma mensajes de un canal en bloque. Los carriles terminan en cualquier orden, así que solo se
+    envía basic_ack(multiple=True) para el prefijo contiguo (en orden de entrega) de mensajes ya resueltos.
+    Los rechazados / reintentados se resuelven uno a uno (on_reject / on_retry) y hacen de barrera: siguen
+    pendientes hasta que su handler termina, para que ningún ack múltiple de otro carril los confirme de paso
+    (su ack/nack propio llegaría después con un delivery tag desconocido y el broker cerraría el canal).
+    """
+    def __init__(self, on_reject, on_retry):
+        self.pending = deque() # Mensajes sin resolver, en orden de entrega
+        self.settled = {} # delivery_tag -> resultado
+        self.on_reject = on_reject
+        self.on_retry = on_retry
+        self.ack_lock = asyncio.Lock() # Los ack múltiples salen en el mismo orden en que se calcularon sus prefijos
+
+    def track(self, message):
+        self.pending.append(message)
+
+    async def settle(self, messages, outcomes):
+        for message, outcome in zip(messages, outcomes):
+            if outcome == MESSAGE_ACK:
+                self.settled[message.delivery_tag] = outcome
+        for message, outcome in zip(messages, outcomes):
+            if outcome == MESSAGE_ACK:
+                continue
+            handler = self.on_reject if outcome == MESSAGE_REJECT else self.on_retry
+            try:
+                await handler(message)
+            except Exception as e:
+                logger.error(f"❌ [{SERVER_NAME}] No se pudo reprogramar/descartar el mensaje {message.delivery_tag}: {e}. Se devuelve a la cola.")
+                await message.nack(requeue=True)
+            self.settled[message.delivery_tag] = outcome # Recién ahora deja de frenar el prefijo
+        # El prefijo se calcula sin 'await' y el lock se toma sin ceder el loop: los ack salen en orden
+        last_ack = None
+        while self.pending and self.pending[0].delivery_tag in self.settled:
+            message = self.pending.popleft()
+            if self.settled.pop(message.delivery_tag) == MESSAGE_ACK:
+                last_ack = message
+        if last_ack is not None:
+            async with self.ack_lock:
+                await last_ack.ack(multiple=True)
+
+# Cada consumidor se describe con: decode (bytes -> objeto, valida en el borde), lane_of (clave de orden, o None)
+# y process_batch (corrutina que recibe una lista de objetos y retorna un resultado por cada uno).
+# Un mensaje que no se puede decodificar se rechaza sin reintento.
+def decode_sale_message(message: aio_pika.abc.AbstractIncomingMessage) -> SaleNotification:
+    # Validación única en el borde AMQP (directo desde los bytes, sin json.loads intermedio)
+    return SaleNotification.model_validate_json(message.body)
+
+def sale_lane_of(notification: SaleNotification) -> int:
+    return notification.product_id
+
+async def process_sale_messages(notifications: List[SaleNotification]) -> List[str]:
+    """
+    Confirma el micro-lote en un solo script de Redis. Si el lote falla, se separa y se reintenta
+    venta por venta: las que vuelven a fallar se devuelven a la cola sin frenar al resto.
+    """
     try:
-        notification_data = json.loads(body.decode())
-        exchange = method.exchange
-        
-        # [CORRECCIÓN V5.1] Usar asyncio.run() para llamar a las funciones async
-        if exchange in [EXCHANGE_DIRECT, EXCHANGE_FANOUT]:
-            logger.info(f"📥 [{SERVER_NAME}] Mensaje de Venta recibido del exchange {exchange}")
-            asyncio.run(process_sale_notification(notification_data))
-        
-        elif exchange == EXCHANGE_USER_EVENTS:
-            queue_name = method.consumer_tag 
-            worker_name = "Notificaciones" if QUEUE_USER_NOTIFS in queue_name else "Estadisticas"
+        _items, committed = await commit_sale_batch(notifications)
+    except Exception as e:
+        if len(notifications) == 1:
+            logger.error(f"❌ [{SERVER_NAME}] Error al confirmar la venta {notifications[0].sale_id}: {e}")
+            return [MESSAGE_RETRY]
+        logger.warning(f"⚠️ [{SERVER_NAME}] Falló el lote de {len(notifications)} ventas ({e}). Reintentando una por una...")
+        outcomes = []
+        for notification in notifications:
+            outcomes.extend(await process_sale_messages([notification]))
+        return outcomes
+    # Las sucursales reciben las ventas reales por el outbox; el ack no espera a ninguna sincronización
+    spawn_sales_sync(sync_sales_history_batch(committed))
+    return [MESSAGE_ACK] * len(notifications)
+
+# [NUEVO] Prioridad de las ventas reales sobre las de prueba
+real_sale_queues: set = set() # Colas (lógicas) de ventas reales; sus métricas indican la saturación
+
+def real_sales_in_flight() -> int:
+    return sum(metrics.in_flight for name, metrics in consumer_metrics.items() if name in real_sale_queues)
+
+async def process_test_sale_messages(notifications: List[SaleNotification]) -> List[str]:
+    """Consumidor de prueba: cede el paso mientras los consumidores de ventas reales estén saturados."""
+    while real_sales_in_flight() >= REAL_SALES_SATURATION_IN_FLIGHT:
+        await asyncio.sleep(TEST_SALES_YIELD_SECONDS)
+    return await process_sale_messages(notifications)
+
+test_http_slots = asyncio.Semaphore(TEST_HTTP_CONCURRENCY)
+
+def admit_test_request():
+    """Tráfico HTTP de prueba: 429 si su cupo está lleno o si las ventas reales están saturadas."""
+    if test_http_slots.locked() or real_sales_in_flight() >= REAL_SALES_SATURATION_IN_FLIGHT:
+        raise HTTPException(status_code=429, detail="Tráfico de prueba limitado, reintente más tarde.", headers={"Retry-After": "1"})
+
+def decode_user_event(message: aio_pika.abc.AbstractIncomingMessage) -> dict:
+    return json.loads(message.body)
+
+def user_event_processor(worker_name: str):
+    async def process_user_events(events: List[dict]) -> List[str]:
+        for message_data in events:
             logger.info(f"📥 [{SERVER_NAME} - USUARIOS - {worker_name}] Evento recibido. Procesando acción...")
-            asyncio.run(process_user_created_event_async(notification_data, worker_name))
+            await process_user_created_event_async(message_data, worker_name)
+        return [MESSAGE_ACK] * len(events)
+    return process_user_events
+
+def retry_queue_name(queue_name: str, delay_seconds: int) -> str:
+    return f"{queue_name}.retry.{delay_seconds}s"
+
+def instance_queue_name(queue_name: str) -> str:
+    return f"{queue_name}.{SERVER_NAME}"
+
+def instance_queue_arguments() -> dict:
+    """Argumentos de las colas por instancia: tipo (quorum / lazy), tope de longitud y política de desborde."""
+    arguments = {}
+    if INSTANCE_QUEUE_EXPIRES_HOURS > 0:
+        arguments["x-expires"] = int(INSTANCE_QUEUE_EXPIRES_HOURS * 3600 * 1000)
+    if INSTANCE_QUEUE_TYPE == "quorum":
+        arguments["x-queue-type"] = "quorum"
+    else:
+        arguments["x-queue-mode"] = "lazy"
+    if INSTANCE_QUEUE_MAX_LENGTH > 0:
+        arguments["x-max-length"] = INSTANCE_QUEUE_MAX_LENGTH
+        arguments["x-overflow"] = INSTANCE_QUEUE_OVERFLOW
+    return arguments
 
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-        
+async def declare_retry_topology(channel, queue_name: str):
+    """
+    Colas de espera '{cola}.retry.{N}s' (una por nivel de TTL) que, al expirar el mensaje, lo devuelven
+    a 'queue_name' vía el exchange por defecto, y el parking lot compartido de ventas.
+    Son durables y sin x-expires: nunca tienen consumidores, así que el broker las daría por inactivas.
+    'queue_name' debe ser una cola compartida (nunca la de una instancia): así las colas de espera son
+    un juego fijo y un reintento no depende de que la instancia que falló siga existiendo.
+    """
+    for delay in SALE_RETRY_DELAYS_SECONDS:
+        await channel.declare_queue(
+            retry_queue_name(queue_name, delay),
+            durable=True,
+            arguments={
+                "x-message-ttl": delay * 1000,
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": queue_name,
+            },
+        )
+    await channel.declare_queue(SALES_PARKING_LOT_QUEUE, durable=True)
+
+def copy_message(message: aio_pika.abc.AbstractIncomingMessage, **headers) -> aio_pika.Message:
+    return aio_pika.Message(
+        body=message.body,
+        headers={**(message.headers or {}), **headers},
+        content_type=message.content_type,
+        message_id=message.message_id,
+        timestamp=message.timestamp,
+        delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+    )
+
+async def delete_legacy_retry_queues(queue_name: str):
+    """
+    Antes los reintentos de la cola por instancia tenían su propio juego de colas de espera. Se borran las de
+    esta instancia si están vacías (con mensajes se dejan: al expirar vuelven a su cola y se reintenta luego).
+    Las de instancias retiradas antes de este cambio hay que borrarlas a mano (rabbitmqctl delete_queue).
+    """
+    try:
+        connection = await get_amqp_connection()
     except Exception as e:
-        logger.error(f"❌ [{SERVER_NAME}] Error al procesar mensaje de RabbitMQ: {e}")
-        ch.basic_reject(delivery_tag=method.delivery_tag, requeue=False) 
+        logger.warning(f"⚠️ [{SERVER_NAME}] Limpieza de colas de espera antiguas omitida: {e}")
+        return
+    for delay in SALE_RETRY_DELAYS_SECONDS:
+        name = retry_queue_name(queue_name, delay)
+        try:
+            # Canal propio por cola: un PRECONDITION_FAILED (no vacía) cierra el canal
+            async with connection.channel() as channel:
+                await channel.queue_delete(name, if_empty=True)
+        except Exception as e:
+            logger.warning(f"⚠️ [{SERVER_NAME}] Cola de espera antigua {name} no borrada ({e}).")
+
+def sale_retry_handlers(channel, queue_name: str):
+    """
+    (on_reject, on_retry) de las ventas: se publica la copia (con confirmación del broker) y luego se confirma el original.
+    'queue_name' es la cola compartida a la que vuelven los reintentos (y la que se anota como origen en el parking lot).
+    """
+    async def park(message, reason: str):
+        attempts = int((message.headers or {}).get(RETRY_COUNT_HEADER, 0))
+        await channel.default_exchange.publish(
+            copy_message(message, **{"x-original-queue": queue_name, "x-parking-reason": reason}),
+            routing_key=SALES_PARKING_LOT_QUEUE,
+        )
+        await message.ack()
+        logger.error(f"🅿️ [{SERVER_NAME}] Venta enviada al parking lot ({reason}, {attempts} reintentos) desde {queue_name}.")
+
+    async def on_reject(message):
+        await park(message, "invalid_message")
+
+    async def on_retry(message):
+        attempts = int((message.headers or {}).get(RETRY_COUNT_HEADER, 0)) + 1
+        if attempts >= SALE_RETRY_MAX_ATTEMPTS:
+            await park(message, "max_retries")
+            return
+        delay = SALE_RETRY_DELAYS_SECONDS[min(attempts, len(SALE_RETRY_DELAYS_SECONDS)) - 1]
+        await channel.default_exchange.publish(
+            copy_message(message, **{RETRY_COUNT_HEADER: attempts}),
+            routing_key=retry_queue_name(queue_name, delay),
+        )
+        await message.ack()
+        logger.warning(f"🔁 [{SERVER_NAME}] Venta reprogramada en {delay}s (intento {attempts}/{SALE_RETRY_MAX_ATTEMPTS}).")
+
+    return on_reject, on_retry
 
+async def requeue_after_delay(message):
+    await asyncio.sleep(CONSUMER_RETRY_DELAY_SECONDS)
+    await message.nack(requeue=True)
 
-def start_rabbitmq_worker(queue_name: str, exchange_name: str, exchange_type: str, routing_key: str):
+async def reject_message(message):
+    await message.reject(requeue=False)
+
+async def consume_queue(queue_name: str, exchange_name: str, exchange_type: str, routing_key: str,
+                        decode, process_batch, lane_of=None, concurrency: int = 1,
+                        batch_size: int = 1, batch_window_ms: float = 0.0, retry_topology: bool = False,
+                        per_instance: bool = False, queue_arguments: Optional[dict] = None, retry_queue: Optional[str] = None):
+    """
+    Declara exchange/cola y consume en el loop de la app (mismo pool Redis y cliente HTTP).
+    Hay 'concurrency' carriles en paralelo; los mensajes con la misma clave (lane_of) van siempre al mismo
+    carril y se procesan en orden. Cada carril junta micro-lotes de hasta 'batch_size' mensajes o
+    'batch_window_ms' milisegundos, y el DeliveryAckTracker los confirma con un ack múltiple.
+    Con 'retry_topology' los fallos pasan por colas de espera con TTL y, al agotarse, al parking lot; vuelven a
+    'retry_queue' (por defecto, la misma cola). 'per_instance' usa la cola durable propia de la instancia
+    ('{cola}.{SERVER_NAME}', copia de un fanout) con los argumentos de instance_queue_arguments(); si no, la
+    cola es durable y compartida. Una cola por instancia con reintentos exige 'retry_queue' compartida.
+    Retorna o lanza excepción cuando el canal se cierra; supervise_consumer lo vuelve a levantar.
+    """
+    connection = await get_amqp_connection()
+    async with connection.channel() as channel:
+        # Sin QoS el broker empuja toda la cola al consumidor: prefetch acota los mensajes en vuelo
+        await channel.set_qos(prefetch_count=max(RABBITMQ_PREFETCH_COUNT, concurrency))
+        exchange = await channel.declare_exchange(exchange_name, exchange_type, durable=True)
+        if per_instance:
+            # Fanout: cola propia de la instancia (cada Central recibe su copia). Nombre estable y durable:
+            # tras un reinicio o reconexión se retoma el backlog donde quedó
+            queue = await channel.declare_queue(instance_queue_name(queue_name), durable=True, arguments=instance_queue_arguments())
+        else:
+            queue = await channel.declare_queue(queue_name, durable=True, arguments=queue_arguments)
+        await queue.bind(exchange, routing_key=routing_key)
+
+        if retry_topology:
+            retry_home = retry_queue or queue.name
+            if retry_home == queue.name and per_instance:
+                raise ValueError(f"{queue.name}: los reintentos de una cola por instancia deben volver a una cola compartida")
+            await declare_retry_topology(channel, retry_home)
+            tracker = DeliveryAckTracker(*sale_retry_handlers(channel, retry_home))
+        else:
+            tracker = DeliveryAckTracker(on_reject=reject_message, on_retry=requeue_after_delay)
+        metrics = get_consumer_metrics(queue_name)
+        metrics.queue = queue.name
+        loop = asyncio.get_running_loop()
+
+        async def next_batch(lane: asyncio.Queue) -> list:
+            batch = [await lane.get()]
+            deadline = loop.time() + batch_window_ms / 1000
+            while len(batch) < batch_size:
+                if not lane.empty():
+                    batch.append(lane.get_nowait())
+                    continue
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                # Sin wait_for: si el timeout coincide con la llegada de un mensaje, wait_for puede perderlo
+                getter = asyncio.ensure_future(lane.get())
+                await asyncio.wait({getter}, timeout=remaining)
+                if not getter.done():
+                    getter.cancel()
+                    await asyncio.wait({getter})
+                if getter.cancelled():
+                    break
+                batch.append(getter.result())
+            return batch
+
+        async def lane_worker(lane: asyncio.Queue):
+            while True:
+                batch = await next_batch(lane)
+                messages = [message for message, _payload in batch]
+                started = time.perf_counter()
+                try:
+                    outcomes = await process_batch([payload for _message, payload in batch])
+                except Exception as e:
+                    logger.error(f"❌ [{SERVER_NAME}] Error al procesar {len(batch)} mensajes de RabbitMQ ({queue.name}): {e}")
+                    outcomes = [MESSAGE_RETRY] * len(batch)
+                metrics.processing.observe((time.perf_counter() - started) * 1000)
+                metrics.record_outcomes(outcomes)
+                now_ms = time.time() * 1000
+                for message, outcome in zip(messages, outcomes):
+                    published_at = message_published_at_ms(message) if outcome == MESSAGE_ACK else None
+                    if published_at is not None:
+                        metrics.end_to_end.observe(now_ms - published_at)
+                try:
+                    await tracker.settle(messages, outcomes)
+                except Exception as e:
+                    # Canal cerrado: el broker reentregará lo no confirmado; el iterador termina y el supervisor reinicia
+                    logger.error(f"❌ [{SERVER_NAME}] No se pudieron confirmar mensajes ({queue.name}): {e}")
+
+        # El prefetch ya acota cuántos mensajes pueden esperar en los carriles
+        lanes = [asyncio.Queue() for _ in range(concurrency)]
+        workers = [asyncio.create_task(lane_worker(lane)) for lane in lanes]
+        round_robin = itertools.count()
+        logger.info(f'✅ [{SERVER_NAME}] Worker {queue.name} listo ({concurrency} en paralelo, lotes de hasta {batch_size}). Consumiendo...')
+        try:
+            async with queue.iterator() as messages:
+                async for message in messages:
+                    tracker.track(message)
+                    metrics.received += 1
+                    metrics.in_flight += 1
+                    if message.redelivered:
+                        metrics.redelivered += 1
+                    try:
+                        payload = decode(message)
+                    except Exception as e:
+                        logger.error(f"❌ [{SERVER_NAME}] Mensaje inválido en {queue.name}: {e}")
+                        metrics.record_outcomes([MESSAGE_REJECT])
+                        await tracker.settle([message], [MESSAGE_REJECT])
+                        continue
+                    key = lane_of(payload) if lane_of else next(round_robin)
+                    lanes[hash(key) % concurrency].put_nowait((message, payload))
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            metrics.in_flight = 0 # Lo no confirmado vuelve a la cola y se contará como reentrega
+
+async def supervise_consumer(queue_name: str, exchange_name: str, exchange_type: str, routing_key: str, **consumer):
+    """Mantiene vivo un consumidor: ante cualquier fallo (conexión, canal, bug) lo reinicia con backoff exponencial."""
     logger.info(f"✨ [{SERVER_NAME}] Iniciando Worker para {exchange_name} ({exchange_type.upper()}). Cola: {queue_name}")
+    backoff = 1.0
     while True:
+        started = time.monotonic()
         try:
-            credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
-            params = pika.ConnectionParameters(
-                host=RABBITMQ_HOST, 
-                port=5672,
-                credentials=credentials,
-                heartbeat=600,
-                blocked_connection_timeout=300,
+            await consume_queue(queue_name, exchange_name, exchange_type, routing_key, **consumer)
+            error = "el canal se cerró"
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = e
+        if time.monotonic() - started > 60:
+            backoff = 1.0 # Estuvo sano un buen rato: no arrastrar el backoff de caídas anteriores
+        logger.error(f"❌ [{SERVER_NAME}] Worker {queue_name} detenido ({error}). Reiniciando en {backoff:.0f}s...")
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, 30.0)
+
+# [NUEVO] Consumo particionado del fanout de ventas: cada venta llega a UNA sola instancia
+def sales_partition_queue(partition: int) -> str:
+    return f"{SALES_PARTITION_QUEUE_PREFIX}.{partition}"
+
+async def declare_sales_partition_topology():
+    """Exchange x-consistent-hash enlazado al fanout + una cola durable por partición (peso 1 cada una)."""
+    connection = await get_amqp_connection()
+    async with connection.channel() as channel:
+        fanout = await channel.declare_exchange(EXCHANGE_FANOUT, "fanout", durable=True)
+        partitioned = await channel.declare_exchange(EXCHANGE_SALES_PARTITIONED, "x-consistent-hash", durable=True)
+        await partitioned.bind(fanout, routing_key="")
+        for partition in range(SALES_PARTITIONS):
+            queue = await channel.declare_queue(
+                sales_partition_queue(partition), durable=True,
+                # Durante un rebalanceo dos instancias pueden suscribirse a la vez: solo una recibe mensajes
+                arguments={"x-single-active-consumer": True},
             )
-            connection = pika.BlockingConnection(params)
-            channel = connection.channel()
+            await queue.bind(partitioned, routing_key="1")
 
-            channel.exchange_declare(exchange=exchange_name, exchange_type=exchange_type, durable=True)
-            
-            consumer_tag = queue_name
-            queue_name_bound = queue_name
-
-            if exchange_name == EXCHANGE_FANOUT or exchange_name == EXCHANGE_USER_EVENTS:
-                result = channel.queue_declare(queue=f"{queue_name}_{SERVER_NAME}_{uuid.uuid4().hex[:6]}", exclusive=True, durable=False)
-                queue_name_bound = result.method.queue
-                consumer_tag = queue_name_bound 
-            elif exchange_name == EXCHANGE_DIRECT:
-                channel.queue_declare(queue=queue_name, durable=True)
-                queue_name_bound = queue_name
-                consumer_tag = queue_name
-            
-            channel.queue_bind(
-                exchange=exchange_name, queue=queue_name_bound, routing_key=routing_key
-            )
+def assign_sales_partitions(members: List[str]) -> set:
+    """Reparto determinista y parejo: todas las instancias calculan lo mismo a partir de la lista ordenada."""
+    members = sorted(members)
+    if INSTANCE_ID not in members:
+        return set()
+    index = members.index(INSTANCE_ID)
+    return {p for p in range(SALES_PARTITIONS) if p % len(members) == index}
 
-            channel.basic_consume(
-                queue=queue_name_bound, 
-                on_message_callback=callback,
-                auto_ack=False,
-                consumer_tag=consumer_tag
-            )
+async def sales_partition_manager(partition_consumer: dict):
+    """
+    Tarea de fondo (modo partitioned): heartbeat de la instancia en Redis, cálculo de las particiones
+    propias y arranque/parada de sus consumidores cuando una instancia entra o sale.
+    Si Redis no responde se conserva la asignación actual (single-active-consumer evita el doble consumo).
+    """
+    while True:
+        try:
+            await declare_sales_partition_topology()
+            break
+        except Exception as e:
+            logger.error(f"❌ [{SERVER_NAME}] No se pudo declarar la topología particionada: {e}. Reintentando en 5s...")
+            await asyncio.sleep(5)
 
-            logger.info(f'✅ [{SERVER_NAME}] Worker {consumer_tag} listo. Consumiendo...')
-            channel.start_consuming()
+    consumers: Dict[int, asyncio.Task] = {}
+    try:
+        while True:
+            r = get_redis_client()
+            if r:
+                try:
+                    now = time.time()
+                    pipeline = r.pipeline(transaction=False)
+                    pipeline.zadd(SALES_CONSUMERS_KEY, {INSTANCE_ID: now})
+                    pipeline.zremrangebyscore(SALES_CONSUMERS_KEY, "-inf", now - MEMBERSHIP_TTL_SECONDS)
+                    pipeline.zrange(SALES_CONSUMERS_KEY, 0, -1)
+                    _, _, members = await pipeline.execute()
+                    wanted = assign_sales_partitions(members)
+                    for partition in set(consumers) - wanted:
+                        consumers.pop(partition).cancel()
+                    for partition in wanted - set(consumers):
+                        real_sale_queues.add(sales_partition_queue(partition))
+                        consumers[partition] = asyncio.create_task(supervise_consumer(
+                            sales_partition_queue(partition), EXCHANGE_SALES_PARTITIONED, "x-consistent-hash", "1",
+                            queue_arguments={"x-single-active-consumer": True}, **partition_consumer,
+                        ))
+                    if wanted != sales_partitions_owned:
+                        logger.info(f"🧩 [{SERVER_NAME}] Particiones de ventas: {sorted(wanted)} ({len(members)} instancias activas).")
+                        sales_partitions_owned.clear()
+                        sales_partitions_owned.update(wanted)
+                except Exception as e:
+                    note_redis_error(e)
+                    logger.error(f"❌ [{SERVER_NAME}] Heartbeat de particiones fallido: {e}")
+            await asyncio.sleep(MEMBERSHIP_HEARTBEAT_SECONDS)
+    finally:
+        for task in consumers.values():
+            task.cancel()
+        await asyncio.gather(*consumers.values(), return_exceptions=True)
+        sales_partitions_owned.clear()
+        # Salida ordenada: las demás instancias toman nuestras particiones en su próximo heartbeat
+        r = get_redis_client()
+        if r:
+            try:
+                await r.zrem(SALES_CONSUMERS_KEY, INSTANCE_ID)
+            except Exception as e:
+                logger.error(f"❌ [{SERVER_NAME}] No se pudo salir del grupo de consumidores: {e}")
 
-        except pika.exceptions.AMQPConnectionError as e:
-            logger.error(f"❌ [{SERVER_NAME}] Fallo en la conexión a RabbitMQ (Worker {queue_name}): {e}. Reintentando en 5s...")
-            time.sleep(5)
-        except pika.exceptions.ChannelClosedByBroker as e:
-            logger.error(f"❌ [{SERVER_NAME}] Canal cerrado por el broker (Worker {queue_name}): {e}. Reintento de reconexión.")
-            time.sleep(5)
-        except Exception as e:
-            logger.error(f"❌ [{SERVER_NAME}] Error crítico en el worker de RabbitMQ ({queue_name}): {e}. Terminando thread.")
-            break
+sales_partitions_owned: set = set()
 
 @app.on_event("startup")
 async def startup_event():
     logger.info(f"🚀 [{SERVER_NAME}] Iniciando Central API con 4 Workers (Ventas y Usuarios)...")
-    Thread(target=initialize_redis_data, daemon=True).start()
+    load_snapshot_from_disk()
+    init_redis_pool()
+    init_http_client()
+    register_redis_scripts()
+    await initialize_redis_data()
+    await migrate_legacy_sales_list()
+    background_tasks.append(asyncio.create_task(redis_health_probe()))
+    background_tasks.append(asyncio.create_task(inventory_invalidation_listener()))
+    if SNAPSHOT_PATH:
+        background_tasks.append(asyncio.create_task(snapshot_persist_loop()))
+    background_tasks.append(asyncio.create_task(queue_depth_poller()))
+    background_tasks.append(asyncio.create_task(branch_registry_refresher()))
+    background_tasks.append(asyncio.create_task(outbox_dispatch_manager()))
+    background_tasks.append(asyncio.create_task(outbox_tail_watcher()))
+    background_tasks.append(asyncio.create_task(outbox_trimmer()))
+    background_tasks.append(asyncio.create_task(sales_stats_pruner()))
     
-    global BRANCHES, RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, QUEUE_DIRECT, EXCHANGE_DIRECT, QUEUE_FANOUT, EXCHANGE_FANOUT, EXCHANGE_USER_EVENTS, QUEUE_USER_NOTIFS, QUEUE_USER_STATS
-    BRANCHES = os.getenv("BRANCHES", "http://sucursal-demo:8002").split(",")
+    global RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, QUEUE_DIRECT, QUEUE_DIRECT_TEST, EXCHANGE_DIRECT, QUEUE_FANOUT, EXCHANGE_FANOUT, EXCHANGE_USER_EVENTS, QUEUE_USER_NOTIFS, QUEUE_USER_STATS
     RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
     RABBITMQ_USER = os.getenv("RABBITMQ_USER", "ecomarket_user")
     RABBITMQ_PASS = os.getenv("RABBITMQ_PASS", "ecomarket_password")
     QUEUE_DIRECT = os.getenv("RABBITMQ_QUEUE_DIRECT", "ventas_central_direct") 
+    QUEUE_DIRECT_TEST = os.getenv("RABBITMQ_QUEUE_TEST", "ventas_central_test") # Ventas de prueba (mismo exchange directo)
     EXCHANGE_DIRECT = os.getenv("RABBITMQ_EXCHANGE_DIRECT", "notificaciones_direct") 
     QUEUE_FANOUT = "ventas_central_fanout"
     EXCHANGE_FANOUT = os.getenv("RABBITMQ_EXCHANGE_FANOUT", "ventas_global_fanout") 
     EXCHANGE_USER_EVENTS = os.getenv("RABBITMQ_EXCHANGE_USERS", "user_events_fanout")
     QUEUE_USER_NOTIFS = os.getenv("RABBITMQ_QUEUE_NOTIFS", "user_notifs_central")
     QUEUE_USER_STATS = os.getenv("RABBITMQ_QUEUE_STATS", "user_stats_central")
+    real_sale_queues.update({QUEUE_DIRECT, QUEUE_FANOUT})
     
-    Thread(target=start_rabbitmq_worker, args=(QUEUE_DIRECT, EXCHANGE_DIRECT, 'direct', QUEUE_DIRECT), daemon=True).start()
-    Thread(target=start_rabbitmq_worker, args=(QUEUE_FANOUT, EXCHANGE_FANOUT, 'fanout', ''), daemon=True).start()
-    Thread(target=start_rabbitmq_worker, args=(QUEUE_USER_NOTIFS, EXCHANGE_USER_EVENTS, 'fanout', ''), daemon=True).start()
-    Thread(target=start_rabbitmq_worker, args=(QUEUE_USER_STATS, EXCHANGE_USER_EVENTS, 'fanout', ''), daemon=True).start()
-    logger.info(f"✅ [{SERVER_NAME}] 4 Workers de RabbitMQ (Ventas y Usuarios) iniciados.")
+    sale_consumer = dict(decode=decode_sale_message, process_batch=process_sale_messages,
+                         lane_of=sale_lane_of, concurrency=SALE_CONSUMER_CONCURRENCY,
+                         batch_size=SALE_CONSUMER_BATCH_SIZE, batch_window_ms=SALE_CONSUMER_BATCH_WINDOW_MS,
+                         retry_topology=True)
+    test_sale_consumer = {**sale_consumer, "process_batch": process_test_sale_messages,
+                          "concurrency": TEST_SALE_CONSUMER_CONCURRENCY, "batch_size": TEST_SALE_CONSUMER_BATCH_SIZE}
+    consumers = [
+        ((QUEUE_DIRECT, EXCHANGE_DIRECT, 'direct', QUEUE_DIRECT), sale_consumer),
+        ((QUEUE_DIRECT_TEST, EXCHANGE_DIRECT, 'direct', QUEUE_DIRECT_TEST), test_sale_consumer),
+        ((QUEUE_USER_NOTIFS, EXCHANGE_USER_EVENTS, 'fanout', ''),
+         dict(decode=decode_user_event, process_batch=user_event_processor("Notificaciones"),
+              concurrency=USER_CONSUMER_CONCURRENCY, per_instance=True)),
+        ((QUEUE_USER_STATS, EXCHANGE_USER_EVENTS, 'fanout', ''),
+         dict(decode=decode_user_event, process_batch=user_event_processor("Estadisticas"),
+              concurrency=USER_CONSUMER_CONCURRENCY, per_instance=True)),
+    ]
+    if SALES_CONSUMPTION_MODE == "partitioned":
+        background_tasks.append(asyncio.create_task(sales_partition_manager(sale_consumer)))
+    else:
+        # Los reintentos de la copia por instancia vuelven por la cola directa compartida (como el replay del parking
+        # lot): si la instancia se retira, su cola expira (x-expires) pero sus reintentos los procesa otra.
+        # Ventana de pérdida que queda: lo aún no procesado en la cola de una instancia retirada se descarta al
+        # expirar; en broadcast las demás instancias recibieron su propia copia de esas ventas.
+        consumers.append(((QUEUE_FANOUT, EXCHANGE_FANOUT, 'fanout', ''),
+                          {**sale_consumer, "per_instance": True, "retry_queue": QUEUE_DIRECT}))
+        background_tasks.append(asyncio.create_task(delete_legacy_retry_queues(instance_queue_name(QUEUE_FANOUT))))
+    for args, consumer in consumers:
+        background_tasks.append(asyncio.create_task(supervise_consumer(*args, **consumer)))
+    logger.info(f"✅ [{SERVER_NAME}] Workers de RabbitMQ (Ventas y Usuarios) iniciados. Consumo del fanout de ventas: {SALES_CONSUMPTION_MODE}. Colas por instancia: {INSTANCE_QUEUE_TYPE}.")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    if sales_sync_tasks: # Sincronizaciones en curso: se les da un plazo antes de cerrar el cliente HTTP
+        await asyncio.wait(sales_sync_tasks, timeout=SYNC_REQUEST_DEADLINE_SECONDS)
+    await dashboard_hub.close()
+    await close_amqp_connection()
+    await close_http_client()
+    if SNAPSHOT_PATH and last_known_good["dirty"]:
+        try:
+            save_snapshot_to_disk()
+        except Exception as e:
+            logger.error(f"❌ [{SERVER_NAME}] No se pudo guardar la foto local en {SNAPSHOT_PATH}: {e}")
+    await close_redis_pool()
+    logger.info(f"👋 [{SERVER_NAME}] Pool de Redis cerrado.")
 # -----------------------------------------------------------------
 
 # --- ENDPOINTS (Refactorizados para Redis) ---
@@ -548,7 +2626,12 @@ async def startup_event():
 @app.get("/", tags=["General"])
 async def root():
     inventory = await get_all_products_from_redis()
-    sales_count = get_redis_client().llen(SALES_LIST_KEY) if get_redis_client() else 0
+    r = get_redis_client()
+    try:
+        sales_count = await r.xlen(SALES_STREAM_KEY) if r else 0
+    except Exception as e:
+        logger.error(f"Error al contar ventas en Redis: {e}")
+        sales_count = 0
     return {
         "service": "🌿 EcoMarket Central API",
         "server_name": SERVER_NAME, 
@@ -567,8 +2650,58 @@ async def login(form_data: LoginRequest):
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.get("/inventory", response_model=List[Product], tags=["Inventario"])
-async def get_inventory():
-    return await get_all_products_from_redis()
+async def get_inventory(request: Request):
+    # Bytes ya serializados + ETag fuerte: los clientes sin cambios reciben 304 sin cuerpo
+    body, etag = await get_inventory_payload()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"} if etag else {}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+async def inventory_snapshot_response() -> Response:
+    """Foto completa para GET /inventory/changes (reusa los bytes pre-serializados de GET /inventory)."""
+    body, _etag = await get_inventory_payload()
+    version = inventory_payload_cache["version"]
+    if version is None:
+        raise HTTPException(status_code=503, detail="Inventario no disponible")
+    return Response(content=b'{"version":%d,"mode":"snapshot","products":%s}' % (version, body), media_type="application/json")
+
+def inventory_delta_response(version: int, events: List[str]) -> Response:
+    # Los eventos ya están en JSON (los mismos del pub/sub): se concatenan sin re-serializar
+    return Response(content=f'{{"version":{version},"mode":"delta","changes":[{",".join(events)}]}}', media_type="application/json")
+
+@app.get("/inventory/changes", tags=["Inventario"])
+async def inventory_changes(since: int = 0, wait: float = 0):
+    """
+    Cambios de inventario posteriores a la versión 'since' (delta, en orden). Responde con la foto completa
+    si 'since' es 0 (bootstrap), si la sucursal está más de INVENTORY_CHANGES_MAX versiones atrás o si el
+    changelog ya no cubre el hueco. Con 'wait' > 0 y sin cambios, espera hasta 'wait' segundos (long-poll).
+    """
+    wait = min(max(wait, 0.0), INVENTORY_LONG_POLL_MAX_SECONDS)
+    r = get_redis_client()
+    if since <= 0 or not r:
+        return await inventory_snapshot_response()
+    try:
+        changed = inventory_changed # Se toma antes de leer la versión: un cambio posterior nos despierta
+        version = inventory_cache.version if inventory_cache.ready else int(await r.get(INVENTORY_VERSION_KEY) or 0)
+        if since == version and wait > 0:
+            try:
+                await asyncio.wait_for(changed.wait(), wait)
+            except asyncio.TimeoutError:
+                return inventory_delta_response(version, [])
+            version = inventory_cache.version if inventory_cache.ready else int(await r.get(INVENTORY_VERSION_KEY) or 0)
+        if since == version:
+            return inventory_delta_response(version, [])
+        if since > version or version - since > INVENTORY_CHANGES_MAX:
+            return await inventory_snapshot_response()
+        entries = await r.xrange(INVENTORY_CHANGELOG_KEY, min=f"{since + 1}-0", max=f"{version}-0")
+    except Exception as e:
+        note_redis_error(e)
+        logger.error(f"Error al leer el changelog de inventario: {e}")
+        return await inventory_snapshot_response()
+    if [entry_id for entry_id, _fields in entries] != [f"{v}-0" for v in range(since + 1, version + 1)]:
+        return await inventory_snapshot_response() # Hueco: versiones ya recortadas o sin entrada
+    return inventory_delta_response(version, [fields["e"] for _entry_id, fields in entries])
 
 @app.post("/inventory", response_model=Product, tags=["Inventario"])
 async def add_product(
@@ -579,8 +2712,7 @@ async def add_product(
     if existing_product:
         raise HTTPException(status_code=400, detail="El producto ya existe")
     
-    await save_product_to_redis(product)
-    asyncio.create_task(sync_with_branches("POST", "/inventory", product.model_dump())) 
+    await save_product_to_redis(product) # Las sucursales lo traen del changelog (y por el outbox si el push está activo)
     return product
 
 @app.put("/inventory/{product_id}", response_model=Product, tags=["Inventario"])
@@ -596,8 +2728,7 @@ async def update_product(
     if not existing_product:
         logger.warning(f"Producto {product_id} no encontrado para PUT, se creará.")
     
-    await save_product_to_redis(product)
-    asyncio.create_task(sync_with_branches("PUT", f"/inventory/{product_id}", product.model_dump()))
+    await save_product_to_redis(product) # Las sucursales lo traen del changelog (y por el outbox si el push está activo)
     return product
 
 @app.delete("/inventory/{product_id}", tags=["Inventario"])
@@ -609,15 +2740,20 @@ async def delete_product(
     if not removed:
         raise HTTPException(status_code=404, detail="Producto no encontrado")
     
-    await delete_product_from_redis(product_id)
-    asyncio.create_task(sync_with_branches("DELETE", f"/inventory/{product_id}"))
+    await delete_product_from_redis(product_id) # Las sucursales la traen del changelog (y por el outbox si el push está activo)
     return {"removed": removed.name, "id": removed.id}
 
 @app.post("/sale-notification", tags=["Ventas"])
 async def sale_notification(notification: SaleNotification):
     # --- INICIO DE LA CORRECCIÓN (Manejo de Idempotencia) ---
-    result = await process_sale_notification(notification.model_dump())
+    test_sale = is_test_sale(notification)
+    if test_sale:
+        admit_test_request()
+    async with test_http_slots if test_sale else nullcontext():
+        result = await process_sale_notification(notification)
     
+    if result is None and not redis_health["up"]:
+        raise HTTPException(status_code=503, detail="Redis no disponible, reintente la venta.")
     if result is None:
         raise HTTPException(status_code=404, detail="Producto no encontrado")
     elif result == "skipped":
@@ -627,12 +2763,220 @@ async def sale_notification(notification: SaleNotification):
     # Si no, result es updated_stock (int)
     return {"message": "Venta registrada correctamente", "updated_stock": result}
     # --- FIN DE LA CORRECCIÓN ---
+
+@app.post("/sale-notifications/batch", tags=["Ventas"])
+async def sale_notifications_batch(notifications: List[SaleNotification]):
+    """
+    Recibe un arreglo de ventas (p. ej. una sucursal vaciando su cola tras una caída).
+    Todo el lote se confirma en un único script de Redis; cada venta retorna ok / duplicate / unknown_product.
+    """
+    if len(notifications) > SALE_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"Lote demasiado grande (máx. {SALE_BATCH_MAX} ventas).")
+    if not notifications:
+        return {"processed": 0, "results": []}
+    # Un lote solo de prueba (la sucursal vacía su cola de prueba aparte) pasa por el cupo de prueba
+    test_batch = all(is_test_sale(n) for n in notifications)
+    if test_batch:
+        admit_test_request()
+    try:
+        async with test_http_slots if test_batch else nullcontext():
+            items = await process_sale_batch(notifications)
+    except Exception as e:
+        logger.error(f"❌ [{SERVER_NAME}] Error al confirmar lote de ventas: {e}")
+        raise HTTPException(status_code=503, detail="Redis no disponible, reintente el lote.")
+    summary = {label: 0 for label in SALE_STATUS_LABELS.values()}
+    for item in items:
+        summary[item["status"]] = summary.get(item["status"], 0) + 1
+    return {"processed": len(items), **summary, "results": items}
+
+@app.get("/stats", tags=["Ventas"])
+async def sales_stats(hours: int = 24):
+    """Agregados de ventas reales (sin ventas de prueba), mantenidos en cada commit."""
+    return await get_sales_stats(hours=max(0, min(hours, SALES_STATS_MAX_HOURS)))
+
+@app.get("/sales", response_model=SalesPage, tags=["Ventas"])
+async def list_sales(
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    test: bool = False,
+):
+    """
+    Historial de ventas paginado (más nuevas primero).
+    Usa 'next_cursor' de la respuesta para pedir la página siguiente; 'since'/'until' filtran por fecha de registro.
+    'test=true' consulta el historial de ventas de prueba.
+    """
+    limit = max(1, min(limit, SALES_PAGE_MAX))
+    sales, next_cursor = await get_sales_page(limit=limit, cursor=cursor, since=since, until=until, test=test)
+    return SalesPage(sales=sales, next_cursor=next_cursor)
+
+# [NUEVO] Administración del parking lot de ventas (mensajes que agotaron reintentos o son inválidos)
+def require_admin(current_user: dict = Depends(get_current_user)) -> dict:
+    if current_user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Se requiere rol admin")
+    return current_user
+
+@app.get("/admin/sales-parking-lot", tags=["Administracion"])
+async def inspect_sales_parking_lot(limit: int = 50, current_user: dict = Depends(require_admin)):
+    """Muestra hasta 'limit' mensajes del parking lot sin sacarlos (se devuelven a la cola al terminar)."""
+    limit = max(1, min(limit, SALES_PAGE_MAX))
+    try:
+        connection = await get_amqp_connection()
+        async with connection.channel() as channel:
+            queue = await channel.declare_queue(SALES_PARKING_LOT_QUEUE, durable=True)
+            held, items = [], []
+            # Se retienen sin ack mientras se leen para no ver dos veces el mismo mensaje
+            while len(held) < limit:
+                message = await queue.get(no_ack=False, fail=False)
+                if message is None:
+                    break
+                held.append(message)
+                items.append({
+                    "headers": {k: v for k, v in (message.headers or {}).items() if isinstance(v, (str, int, float, bool))},
+                    "body": message.body.decode(errors="replace"),
+                })
+            for message in held:
+                await message.nack(requeue=True)
+            total = queue.declaration_result.message_count
+    except Exception as e:
+        logger.error(f"❌ [{SERVER_NAME}] No se pudo leer el parking lot: {e}")
+        raise HTTPException(status_code=503, detail="RabbitMQ no disponible")
+    return {"queue": SALES_PARKING_LOT_QUEUE, "total": total, "messages": items}
+
+@app.post("/admin/sales-parking-lot/replay", tags=["Administracion"])
+async def replay_sales_parking_lot(limit: int = 100, current_user: dict = Depends(require_admin)):
+    """
+    Reenvía hasta 'limit' mensajes del parking lot a la cola directa de ventas con el contador de reintentos en cero.
+    Las ventas ya confirmadas se descartan solas por idempotencia (sale_id).
+    """
+    limit = max(1, min(limit, SALE_BATCH_MAX))
+    replayed = 0
+    try:
+        connection = await get_amqp_connection()
+        async with connection.channel() as channel:
+            queue = await channel.declare_queue(SALES_PARKING_LOT_QUEUE, durable=True)
+            while replayed < limit:
+                message = await queue.get(no_ack=False, fail=False)
+                if message is None:
+                    break
+                await channel.default_exchange.publish(
+                    copy_message(message, **{RETRY_COUNT_HEADER: 0, "x-replayed-by": current_user["username"]}),
+                    # Las ventas de prueba vuelven a su propia cola
+                    routing_key=QUEUE_DIRECT_TEST if (message.headers or {}).get("x-original-queue") == QUEUE_DIRECT_TEST else QUEUE_DIRECT,
+                )
+                await message.ack()
+                replayed += 1
+    except Exception as e:
+        logger.error(f"❌ [{SERVER_NAME}] Reenvío del parking lot interrumpido tras {replayed} mensajes: {e}")
+        raise HTTPException(status_code=503, detail=f"RabbitMQ no disponible (reenviados: {replayed})")
+    logger.info(f"♻️ [{SERVER_NAME}] {replayed} ventas reenviadas desde el parking lot por {current_user['username']}.")
+    return {"replayed": replayed}
+
+def require_branch_token(x_branch_token: Annotated[Optional[str], Header()] = None):
+    if not BRANCH_REGISTRATION_SECRET:
+        raise HTTPException(status_code=403, detail="Registro dinámico de sucursales desactivado")
+    if not x_branch_token or not hmac.compare_digest(x_branch_token.encode(), BRANCH_REGISTRATION_SECRET.encode()):
+        raise HTTPException(status_code=401, detail="Token de sucursal inválido")
+
+@app.post("/branches/heartbeat", tags=["Sucursales"], dependencies=[Depends(require_branch_token)])
+async def branch_heartbeat(heartbeat: BranchHeartbeat):
+    """
+    Alta/renovación de una sucursal en el registro. Una sucursal nueva empieza a recibir el outbox
+    desde su final (no se le reenvía el historial anterior a su alta).
+    """
+    host = (urlsplit(heartbeat.url).hostname or "").lower()
+    if BRANCH_ALLOWED_HOSTS and host not in BRANCH_ALLOWED_HOSTS:
+        logger.warning(f"⚠️ [{SERVER_NAME}] Heartbeat rechazado: host '{host}' fuera de BRANCH_ALLOWED_HOSTS.")
+        raise HTTPException(status_code=403, detail="Host de sucursal no permitido")
+    r = get_redis_client()
+    if not r:
+        raise HTTPException(status_code=503, detail="Registro de sucursales no disponible")
+    try:
+        pipeline = r.pipeline(transaction=False)
+        pipeline.zadd(BRANCH_REGISTRY_KEY, {heartbeat.url: time.time()})
+        pipeline.hset(BRANCH_REGISTRY_IDS_KEY, heartbeat.url, heartbeat.branch_id)
+        added, _ = await pipeline.execute()
+        if added:
+            tail = await r.xrevrange(OUTBOX_STREAM_KEY, count=1)
+            await r.hsetnx(OUTBOX_CURSORS_KEY, heartbeat.url, tail[0][0] if tail else "0-0")
+            logger.info(f"🏪 [{SERVER_NAME}] Sucursal registrada: {heartbeat.branch_id} ({heartbeat.url}).")
+    except Exception as e:
+        note_redis_error(e)
+        raise HTTPException(status_code=503, detail="Registro de sucursales no disponible")
+    if heartbeat.url not in branch_urls_view:
+        refresh_branch_view({**branch_last_seen, heartbeat.url: time.time()}) # Visible ya, sin esperar al refresco
+    return {"status": "ok", "ttl_seconds": BRANCH_TTL_SECONDS}
+
+@app.get("/branches", tags=["Sucursales"])
+async def list_branches():
+    """Vista de sucursales que usa esta instancia (semilla fija + registradas con heartbeat vigente)."""
+    branch_ids = {}
+    r = get_redis_client()
+    if r and branch_last_seen:
+        try:
+            urls = list(branch_last_seen)
+            branch_ids = dict(zip(urls, await r.hmget(BRANCH_REGISTRY_IDS_KEY, urls)))
+        except Exception as e:
+            note_redis_error(e)
+    return [
+        {"url": url, "branch_id": branch_ids.get(url), "static": url in BRANCHES, "last_heartbeat": branch_last_seen.get(url)}
+        for url in branch_urls_view
+    ]
+
+@app.get("/branches/health", tags=["Sucursales"])
+async def branches_health():
+    """
+    Salud de cada sucursal vista desde esta instancia: circuito, tasa de error en la ventana, EWMA de latencia
+    y posición de su cursor en el outbox (lo pendiente se entrega al cerrarse el circuito).
+    """
+    return {
+        "server": SERVER_NAME,
+        "branches": {
+            branch_url: {**get_branch_circuit(branch_url).snapshot(), "outbox": outbox_status.get(branch_url)}
+            for branch_url in branch_urls_view
+        },
+    }
+
+@app.get("/metrics", tags=["Monitoreo"])
+async def consumer_metrics_report():
+    """
+    Métricas de esta instancia: por consumidor (ritmo, en vuelo, reintentos, reentregas, histogramas de
+    procesamiento y de latencia extremo a extremo, profundidad de su cola) y por etapa (commit en Redis,
+    sincronización con sucursales).
+    """
+    return {
+        "server": SERVER_NAME,
+        "instance_id": INSTANCE_ID,
+        "redis_up": redis_health["up"],
+        "sales_consumption_mode": SALES_CONSUMPTION_MODE,
+        "sales_partitions_owned": sorted(sales_partitions_owned),
+        "consumers": {name: metrics.snapshot() for name, metrics in consumer_metrics.items()},
+        "stages": {name: histogram.snapshot() for name, histogram in STAGE_METRICS.items()},
+        "parking_lot_depth": parking_lot_depth["depth"],
+        "branches": len(branch_urls_view),
+        "outbox": outbox_status,
+    }
 # -----------------------------------------------------------------
 
 # =================================================================
 # === SIMULACIÓN DE PLANTILLAS HTML (Modificadas para Redis) ======
 # =================================================================
 
+DASHBOARD_CSS = """
+body { background-color: #FAFAFA; font-family: 'Segoe UI', sans-serif; color: #333; }
+.navbar { background-color: #ED4040; color: white; padding: 0.8rem 1.5rem; box-shadow: 0 2px 8px rgba(0, 0, 0, 0.08); }
+.navbar-brand { font-weight: 600; font-size: 1.3rem; color: white !important; }
+.metric-item { text-align: center; background: rgba(255, 255, 255, 0.15); border-radius: 8px; padding: 0.4rem 0.8rem; font-size: 0.85rem; color: #fff; min-width: 90px; margin-right: 10px; }
+.metric-item p { margin: 0; font-weight: 600; }
+.btn-sale { background-color: #ED4040; border: 1px solid rgba(255,255,255,0.5); color: white; }
+.card { border: none; border-radius: 12px; box-shadow: 0 2px 6px rgba(0,0,0,0.06); background-color: #fff; }
+.card-header.bg-coral { background-color: #F06060; color: #fff; font-weight: 600; }
+.card-header.bg-intense { background-color: #ED4040; color: #fff; font-weight: 600; }
+#toast { position: fixed; top: 20px; right: 20px; padding: 10px 20px; border-radius: 8px; color: white; font-weight: 600; z-index: 1050; display: none; }
+#toast.success { background-color: #4CAF50; } #toast.error { background-color: #ED4040; } #toast.warning { background-color: #FFC107; color: #333; }
+"""
+# Shell sin datos: métricas y tablas se llenan desde GET /dashboard/data y el stream de /events
 DASHBOARD_HTML_TEMPLATE = """
 <html>
 <head>
@@ -640,29 +2984,17 @@ DASHBOARD_HTML_TEMPLATE = """
 <meta name="viewport" content="width=device-width, initial-scale=1">
 <title>🔴EcoMarket Central - {SERVER_NAME_TITLE}</title> 
 <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css" rel="stylesheet">
-<style>
-body {{ background-color: #FAFAFA; font-family: 'Segoe UI', sans-serif; color: #333; }}
-.navbar {{ background-color: #ED4040; color: white; padding: 0.8rem 1.5rem; box-shadow: 0 2px 8px rgba(0, 0, 0, 0.08); }}
-.navbar-brand {{ font-weight: 600; font-size: 1.3rem; color: white !important; }}
-.metric-item {{ text-align: center; background: rgba(255, 255, 255, 0.15); border-radius: 8px; padding: 0.4rem 0.8rem; font-size: 0.85rem; color: #fff; min-width: 90px; margin-right: 10px; }}
-.metric-item p {{ margin: 0; font-weight: 600; }}
-.btn-sale {{ background-color: #ED4040; border: 1px solid rgba(255,255,255,0.5); color: white; }}
-.card {{ border: none; border-radius: 12px; box-shadow: 0 2px 6px rgba(0,0,0,0.06); background-color: #fff; }}
-.card-header.bg-coral {{ background-color: #F06060; color: #fff; font-weight: 600; }}
-.card-header.bg-intense {{ background-color: #ED4040; color: #fff; font-weight: 600; }}
-#toast {{ position: fixed; top: 20px; right: 20px; padding: 10px 20px; border-radius: 8px; color: white; font-weight: 600; z-index: 1050; display: none; }}
-#toast.success {{ background-color: #4CAF50; }} #toast.error {{ background-color: #ED4040; }} #toast.warning {{ background-color: #FFC107; color: #333; }}
-</style>
+<link href="{css_url}" rel="stylesheet">
 </head>
 <body>
 <nav class="navbar navbar-expand-lg navbar-dark">
     <a class="navbar-brand" href="#">EcoMarket Central - {SERVER_NAME_TITLE}</a>
     <div class="ms-auto d-flex align-items: center">
         <div class="d-flex me-3"> 
-            <div class="metric-item"><h6>Productos</h6><p>{total_products_count}</p></div>
-            <div class="metric-item"><h6>Ventas</h6><p>{total_sales_count}</p></div>
-            <div class="metric-item"><h6>Recaudación</h6><p>${total_revenue:.2f}</p></div>
-             <a href="/users" style="text-decoration:none; color:inherit;"> <div class="metric-item bg-primary"><h6>Usuarios</h6><p>{TOTAL_USERS_CREATED}</p></div></a>
+            <div class="metric-item"><h6>Productos</h6><p id="metric-products">-</p></div>
+            <div class="metric-item"><h6>Ventas</h6><p id="metric-sales">-</p></div>
+            <div class="metric-item"><h6>Recaudación</h6><p id="metric-revenue">-</p></div>
+             <a href="/users" style="text-decoration:none; color:inherit;"> <div class="metric-item bg-primary"><h6>Usuarios</h6><p id="metric-users">-</p></div></a>
         </div>
         
         <button id="loginBtn" class="btn btn-light text-danger fw-bold me-2" onclick="loginPrompt()">🔑 Login</button>
@@ -695,7 +3027,7 @@ body {{ background-color: #FAFAFA; font-family: 'Segoe UI', sans-serif; color: #
                     <div class="table-responsive" style="max-height:400px;">
                         <table class="table table-hover table-sm mb-0 align-middle">
                             <thead><tr><th>ID</th><th>Producto</th><th>Precio</th><th>Stock</th></tr></thead>
-                            <tbody>{inventory_html}</tbody>
+                            <tbody id="inventory-body"><tr><td colspan="4" class="text-center text-muted">Cargando...</td></tr></tbody>
                         </table>
                     </div>
                 </div>
@@ -708,7 +3040,23 @@ body {{ background-color: #FAFAFA; font-family: 'Segoe UI', sans-serif; color: #
                     <div class="table-responsive" style="max-height:400px;">
                         <table class="table table-striped table-sm mb-0 align-middle">
                             <thead><tr><th>Fecha</th><th>Sucursal</th><th>Producto</th><th>Cant.</th><th>Total</th><th>Recibido</th><th>Cambio</th><th>ID</th></tr></thead>
-                            <tbody>{notifications_html}</tbody>
+                            <tbody id="sales-body"><tr><td colspan="8" class="text-center text-muted">Cargando...</td></tr></tbody>
+                        </table>
+                    </div>
+                </div>
+            </div>
+        </div>
+        <div class="col-12">
+            <div class="card">
+                <div class="card-header bg-coral d-flex justify-content-between align-items-center">
+                    <span>Consumidores RabbitMQ</span>
+                    <small id="stage-metrics">Redis p95: - | Sync sucursales p95: - | Parking lot: -</small>
+                </div>
+                <div class="card-body p-0">
+                    <div class="table-responsive">
+                        <table class="table table-sm mb-0 align-middle">
+                            <thead><tr><th>Cola</th><th>Msg/s (10s)</th><th>En vuelo</th><th>Pendientes</th><th>Proc. p95</th><th>Extremo a extremo p95</th><th>Reintentos</th><th>Reentregas</th></tr></thead>
+                            <tbody id="consumer-metrics"><tr><td colspan="8" class="text-center text-muted">Sin datos todavía</td></tr></tbody>
                         </table>
                     </div>
                 </div>
@@ -722,7 +3070,7 @@ body {{ background-color: #FAFAFA; font-family: 'Segoe UI', sans-serif; color: #
 {delete_product_select_modal_html}
 <div id="toast"></div>
 <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/js/bootstrap.bundle.min.js"></script>
-{dashboard_js}
+<script src="{js_url}"></script>
 </body>
 </html>
 """
@@ -784,7 +3132,7 @@ TEST_SALE_FORM_HTML = f"""
                     const data = await res.json(); 
                     if (res.ok) {{
                         showAlert(
-                            `✅ Éxito! Venta de <b>${{formData.get('branch_id')}}</b> registrada en historial. 
+                            `✅ Éxito! Venta de <b>${{formData.get('branch_id')}}</b> registrada en el historial de prueba (<a href="/sales?test=true" class="alert-link">/sales?test=true</a>). 
                             Stock actual de Producto Falso: ${{data.updated_stock}}. 
                             <a href="/dashboard" class="alert-link">Ver Dashboard</a>`, 
                             'success');
@@ -861,8 +3209,7 @@ DELETE_PRODUCT_SELECT_MODAL_HTML = """
   </div>
 </div>
 """
-DASHBOARD_JS_SCRIPT = """
-<script>
+DASHBOARD_JS = """
 // --- LÓGICA DE SEGURIDAD (JWT) ---
 let JWT_TOKEN = localStorage.getItem("ecomarket_token");
 
@@ -912,7 +3259,6 @@ async function loginPrompt() {
             localStorage.setItem("ecomarket_token", JWT_TOKEN);
             showToast("✅ Login exitoso");
             updateUI();
-            setTimeout(() => location.reload(), 1000);
         } else {
             showToast("❌ Credenciales incorrectas", "error");
         }
@@ -924,7 +3270,6 @@ function logout() {
     JWT_TOKEN = null;
     updateUI();
     showToast("👋 Sesión cerrada");
-    setTimeout(() => location.reload(), 1000);
 }
 
 function showToast(message, type='success') {
@@ -960,7 +3305,7 @@ document.getElementById('addProductForm').addEventListener('submit', async (e) =
             showToast("✅ Producto agregado correctamente.");
             const modal = bootstrap.Modal.getInstance(document.getElementById('addProductModal'));
             modal.hide();
-            setTimeout(() => location.reload(), 1500);
+            e.target.reset(); // La fila llega por el stream de eventos
         } else {
             const error = await res.json();
             showToast("❌ Error: " + (error.detail || "Fallo"), "error");
@@ -976,7 +3321,6 @@ document.getElementById('deleteProductSelectForm').addEventListener('submit', as
         const res = await authFetch(`/inventory/${id}`, { method: 'DELETE' });
         if (res.ok) {
             showToast("🗑️ Producto eliminado.");
-            setTimeout(() => location.reload(), 1000);
         } else { showToast("❌ Error al eliminar", "error"); }
     } catch(e) { console.error(e); }
 });
@@ -987,9 +3331,120 @@ document.getElementById('editProductSelectForm').addEventListener('submit', (e)
     if(id) window.location.href = `/edit-product/${id}`;
 });
 
+// Panel de consumidores: se refresca solo (sin recargar la página)
+function fmtMs(v) { return v === null || v === undefined ? "-" : (v >= 1000 ? (v / 1000).toFixed(1) + " s" : v + " ms"); }
+
+async function refreshConsumerMetrics() {
+    try {
+        const res = await fetch('/metrics');
+        if (!res.ok) return;
+        const data = await res.json();
+        const rows = Object.entries(data.consumers).map(([name, c]) => `
+            <tr><td title="${c.queue}">${name}</td><td>${c.rate_10s}</td><td>${c.in_flight}</td>
+            <td>${c.queue_depth ?? "-"}</td><td>${fmtMs(c.processing.p95_ms)}</td><td>${fmtMs(c.end_to_end.p95_ms)}</td>
+            <td>${c.retried}</td><td>${c.redelivered}</td></tr>`);
+        if (rows.length) document.getElementById('consumer-metrics').innerHTML = rows.join("");
+        document.getElementById('stage-metrics').textContent =
+            `Redis p95: ${fmtMs(data.stages.redis_commit.p95_ms)} | Sync sucursales p95: ${fmtMs(data.stages.branch_sync.p95_ms)} | Parking lot: ${data.parking_lot_depth ?? "-"}`;
+    } catch(e) { console.error(e); }
+}
+
+// --- DASHBOARD EN VIVO (SSE): ventas, inventario y usuarios se parchean en el sitio, sin recargar la página ---
+const SALES_ROWS_MAX = 100;
+const money = v => "$" + Number(v || 0).toFixed(2);
+
+function setMetric(id, value) {
+    const el = document.getElementById(id);
+    if (el) el.textContent = value;
+}
+
+function tableRow(cells) {
+    const tr = document.createElement('tr');
+    for (const text of cells) {
+        const td = document.createElement('td');
+        td.textContent = text; // textContent: los nombres nunca se interpretan como HTML
+        tr.appendChild(td);
+    }
+    return tr;
+}
+
+function productRow(p) {
+    const tr = tableRow([p.id, p.name, money(p.price), p.stock]);
+    tr.dataset.productId = p.id;
+    tr.className = p.stock < 10 ? 'table-danger' : '';
+    return tr;
+}
+
+function productName(id) {
+    const row = document.querySelector(`#inventory-body tr[data-product-id="${id}"]`);
+    return row ? row.cells[1].textContent : '❓';
+}
+
+function saleRow(s) {
+    const ts = new Date(s.timestamp);
+    const tr = tableRow([
+        isNaN(ts) ? 'Fecha Inválida' : ts.toISOString().slice(0, 19).replace('T', ' '),
+        s.branch_id, productName(s.product_id), s.quantity_sold,
+        money(s.total_amount), money(s.money_received), money(s.change), (s.sale_id || 'N/A').slice(-12),
+    ]);
+    tr.lastChild.className = 'text-muted small';
+    return tr;
+}
+
+function applyInventoryEvent(e) {
+    const body = document.getElementById('inventory-body');
+    const row = body.querySelector(`tr[data-product-id="${e.id}"]`);
+    if (e.op === 'delete') {
+        if (row) row.remove();
+    } else if (e.op === 'upsert') {
+        const updated = productRow({...e.product, stock: e.stock});
+        if (row) row.replaceWith(updated);
+        else body.insertBefore(updated, [...body.rows].find(tr => Number(tr.dataset.productId) > e.id) || null);
+    } else if (e.op === 'stock' && row) {
+        row.cells[3].textContent = e.stock;
+        row.className = e.stock < 10 ? 'table-danger' : '';
+    }
+    setMetric('metric-products', body.rows.length);
+}
+
+function applySaleEvent(e) {
+    const body = document.getElementById('sales-body');
+    body.insertBefore(saleRow(e.sale), body.firstChild);
+    while (body.rows.length > SALES_ROWS_MAX) body.deleteRow(-1);
+    setMetric('metric-sales', e.sales_count);
+    setMetric('metric-revenue', money(e.total_revenue));
+}
+
+// Carga de datos (no de la página): al abrir, al reconectar o si el servidor nos pide 'resync'
+async function resyncDashboard() {
+    try {
+        const data = await fetch('/dashboard/data').then(res => res.json());
+        document.getElementById('inventory-body').replaceChildren(...data.inventory.map(productRow)); // Antes que las ventas: da los nombres
+        document.getElementById('sales-body').replaceChildren(...data.sales.map(saleRow));
+        setMetric('metric-products', data.inventory.length);
+        setMetric('metric-sales', data.metrics.sales_count);
+        setMetric('metric-revenue', money(data.metrics.total_revenue));
+        if (data.metrics.users !== null) setMetric('metric-users', data.metrics.users);
+    } catch(e) { console.error(e); }
+}
+
+function connectDashboardEvents() {
+    const source = new EventSource('/events'); // Reconecta solo; una sola conexión inactiva mientras no hay cambios
+    let lost = false;
+    source.onerror = () => { lost = true; };
+    source.onopen = () => { if (lost) resyncDashboard(); lost = false; };
+    source.addEventListener('sale', ev => applySaleEvent(JSON.parse(ev.data)));
+    source.addEventListener('inventory', ev => applyInventoryEvent(JSON.parse(ev.data)));
+    source.addEventListener('users', ev => setMetric('metric-users', JSON.parse(ev.data).total));
+    source.addEventListener('resync', resyncDashboard);
+}
+
 // Iniciar estado de la interfaz
 updateUI();
-</script>
+connectDashboardEvents();
+resyncDashboard();
+refreshConsumerMetrics();
+setInterval(refreshConsumerMetrics, 5000);
 """
 CRUD_FORM_BASE_HTML = """
 <html>
@@ -1041,82 +3496,129 @@ CRUD_ALERT_HTML = """
 # -----------------------------------------------------------------
 
 
-# --- ENDPOINT DEL DASHBOARD (Refactorizado para Redis) ---
-@app.get("/dashboard", response_class=HTMLResponse, tags=["Dashboard"])
-async def dashboard():
+# [NUEVO] Shell estático del dashboard: se arma una sola vez al importar. CSS y JS van aparte con el hash
+# del contenido en la URL, así el navegador (y nginx) los guardan sin volver a pedirlos hasta el próximo deploy.
+DASHBOARD_ASSET_CACHE_CONTROL = "public, max-age=31536000, immutable"
+DASHBOARD_ASSETS: Dict[str, tuple] = {} # nombre versionado -> (bytes, media type)
+
+def register_dashboard_asset(stem: str, extension: str, content: str, media_type: str) -> str:
+    body = content.encode()
+    name = f"{stem}.{hashlib.blake2b(body, digest_size=6).hexdigest()}.{extension}"
+    DASHBOARD_ASSETS[name] = (body, media_type)
+    return f"/dashboard/assets/{name}"
+
+DASHBOARD_SHELL = DASHBOARD_HTML_TEMPLATE.format(
+    SERVER_NAME_TITLE=SERVER_NAME,
+    css_url=register_dashboard_asset("dashboard", "css", DASHBOARD_CSS, "text/css; charset=utf-8"),
+    js_url=register_dashboard_asset("dashboard", "js", DASHBOARD_JS, "text/javascript; charset=utf-8"),
+    add_product_modal_html=ADD_PRODUCT_MODAL_HTML,
+    edit_product_select_modal_html=EDIT_PRODUCT_SELECT_MODAL_HTML,
+    delete_product_select_modal_html=DELETE_PRODUCT_SELECT_MODAL_HTML,
+).encode()
+DASHBOARD_SHELL_ETAG = f'"{hashlib.blake2b(DASHBOARD_SHELL, digest_size=10).hexdigest()}"'
+
+# [NUEVO] Datos del dashboard por fragmentos ya serializados, cada uno atado a su versión: el inventario
+# (mismos bytes que GET /inventory), las últimas ventas (contador de ventas de los agregados) y la respuesta
+# completa (ambos + recaudación + usuarios). Sin cambios, servirla cuesta un pipeline de dos lecturas.
+DASHBOARD_SALES_ROWS = 100
+dashboard_data_cache = {"key": None, "body": b"", "etag": None, "sales_count": None, "sales": b"[]"}
+
+async def read_dashboard_counters():
+    """(recaudación, ventas, usuarios) en un solo viaje a Redis; None si Redis no responde."""
     r = get_redis_client()
-    total_users_count_str = r.get(TOTAL_USERS_KEY) if r else None
-    TOTAL_USERS_CREATED = int(total_users_count_str) if total_users_count_str else 0
-
-    all_sales = await get_sales_from_redis(limit=100)
-    central_inventory_list = await get_all_products_from_redis()
-    
-    inventory_dict_for_lookup = {p.id: p for p in central_inventory_list}
-    real_sales = [n for n in all_sales if n.product_id != TEST_PRODUCT_ID]
+    if not r: return None
+    try:
+        pipeline = r.pipeline(transaction=False)
+        pipeline.hmget(SALES_STATS_KEY, ["revenue", "count"])
+        pipeline.get(TOTAL_USERS_KEY)
+        (revenue, sales_count), users = await pipeline.execute()
+    except Exception as e:
+        note_redis_error(e)
+        logger.error(f"Error al leer contadores del dashboard de Redis: {e}")
+        return None
+    return round(float(revenue or 0), 2), int(sales_count or 0), int(users or 0)
+
+def recent_sales_json(sales: List[SaleNotification]) -> bytes:
+    return ("[" + ",".join(n.json_payload for n in sales) + "]").encode()
+
+def build_dashboard_payload(inventory_body: bytes, sales_body: bytes, revenue: float, sales_count: int, users: Optional[int]) -> bytes:
+    metrics = json.dumps({"sales_count": sales_count, "total_revenue": revenue, "users": users})
+    return b'{"metrics":%s,"inventory":%s,"sales":%s}' % (metrics.encode(), inventory_body, sales_body)
+
+async def get_dashboard_payload():
+    """Retorna (bytes JSON, ETag) de GET /dashboard/data; sin ETag cuando se arma desde fotos de respaldo."""
+    inventory_body, inventory_etag = await get_inventory_payload()
+    counters = await read_dashboard_counters()
+    if counters is None:
+        # Redis caído: historial y agregados desde la última foto buena, sin guardar en caché
+        stats = await get_sales_stats(hours=0)
+        sales, _ = await get_sales_page(limit=DASHBOARD_SALES_ROWS)
+        return build_dashboard_payload(inventory_body, recent_sales_json(sales), stats["total_revenue"], stats["sales_count"], None), None
+
+    cache = dashboard_data_cache
+    key = (inventory_etag, *counters)
+    if key == cache["key"]:
+        return cache["body"], cache["etag"]
+    revenue, sales_count, users = counters
+    if sales_count != cache["sales_count"]: # Cada venta real suma 1 al contador y 1 entrada al stream
+        sales, _ = await get_sales_page(limit=DASHBOARD_SALES_ROWS)
+        cache.update(sales_count=sales_count, sales=recent_sales_json(sales))
+    body = build_dashboard_payload(inventory_body, cache["sales"], revenue, sales_count, users)
+    etag = f'"{hashlib.blake2b(body, digest_size=10).hexdigest()}"'
+    cache.update(key=key, body=body, etag=etag)
+    return body, etag
 
-    total_sales_count = len(all_sales)
-    total_products_count = len(central_inventory_list)
-    total_revenue = sum(n.total_amount for n in real_sales if n.total_amount is not None) 
-    
-    inventory_html = "".join([
-        f"<tr class='{'table-danger' if p.stock < 10 else ''}'>"
-        f"<td>{p.id}</td>"
-        f"<td>{p.name}</td>"
-        f"<td>${p.price:.2f}</td>"
-        f"<td>{p.stock}</td>"
-        f"</tr>"
-        for p in sorted(central_inventory_list, key=lambda x: x.id) # Ordenar por ID
-    ])
+@app.get("/dashboard", response_class=HTMLResponse, tags=["Dashboard"])
+async def dashboard(request: Request):
+    # El shell no cambia en vida del proceso: los navegadores lo revalidan y reciben 304 sin cuerpo
+    headers = {"ETag": DASHBOARD_SHELL_ETAG, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), DASHBOARD_SHELL_ETAG):
+        return Response(status_code=304, headers=headers)
+    return Response(content=DASHBOARD_SHELL, media_type="text/html; charset=utf-8", headers=headers)
+
+@app.get("/dashboard/assets/{name}", include_in_schema=False)
+async def dashboard_asset(name: str):
+    asset = DASHBOARD_ASSETS.get(name)
+    if asset is None: # Versión de otro deploy: mejor 404 que guardar contenido distinto bajo una URL inmutable
+        raise HTTPException(status_code=404, detail="Recurso no encontrado")
+    body, media_type = asset
+    return Response(content=body, media_type=media_type, headers={"Cache-Control": DASHBOARD_ASSET_CACHE_CONTROL})
+
+@app.get("/dashboard/data", tags=["Dashboard"])
+async def dashboard_data(request: Request):
+    """Métricas, inventario y últimas ventas del dashboard en una sola respuesta (con ETag mientras Redis responda)."""
+    body, etag = await get_dashboard_payload()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"} if etag else {}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
-    # --- INICIO DE LA CORRECCIÓN (V5.3 / Dashboard Crash) ---
-    notifications_html_rows = []
-    for n in reversed(all_sales):
-        try:
-            # Intenta formatear la fecha
-            timestamp_str = n.timestamp.strftime('%Y-%m-%d %H:%M:%S')
-        except (ValueError, AttributeError):
-            # Si falla (ej. es None o un string corrupto), usa un placeholder
-            timestamp_str = "Fecha Inválida"
-            
-        try:
-            # Genera la fila
-            row = (
-                f"<tr class='{'table-info' if n.product_id == TEST_PRODUCT_ID else ''}'>"
-                f"<td>{timestamp_str}</td>"
-                f"<td>{n.branch_id}</td>"
-                f"<td>{inventory_dict_for_lookup.get(n.product_id, Product(id=0,name='❓',price=0,stock=0)).name}</td>"
-                f"<td>{n.quantity_sold}</td>"
-                f"<td>${n.total_amount:.2f}</td>"
-                # CORRECCIÓN DE SINTAXIS: Los paréntesis son necesarios
-                f"<td>${(n.money_received if n.money_received is not None else 0.0):.2f}</td>"
-                f"<td>${(n.change if n.change is not None else 0.0):.2f}</td>"
-                f"<td class='text-muted small'>{n.sale_id[-12:] if n.sale_id else 'N/A'}</td></tr>"
-            )
-            notifications_html_rows.append(row)
-        except Exception as e:
-            # Captura cualquier otro error en la fila para que el dashboard no crashee
-            logger.error(f"Error renderizando fila de venta {n.sale_id}: {e}")
-            notifications_html_rows.append(f"<tr><td colspan='8'>Error al renderizar la venta {n.sale_id}</td></tr>")
+# --- ENDPOINTS TEST DE VENTA (Refactorizado para Redis) ---
 
-    notifications_html = "".join(notifications_html_rows)
-    # --- FIN DE LA CORRECCIÓN ---
+@app.get("/events", tags=["Dashboard"])
+async def dashboard_events():
+    """
+    Stream SSE de los dashboards: 'sale' (venta real + totales), 'inventory' (mismo evento versionado del
+    inventario), 'users' (total de usuarios) y 'resync' (el cliente debe volver a pedir los datos completos).
+    """
+    if len(dashboard_hub.clients) >= DASHBOARD_SSE_MAX_CLIENTS:
+        raise HTTPException(status_code=503, detail="Demasiados dashboards conectados a esta instancia")
 
-    return HTMLResponse(DASHBOARD_HTML_TEMPLATE.format(
-        total_products_count=total_products_count,
-        total_sales_count=total_sales_count,
-        total_revenue=total_revenue,
-        TOTAL_USERS_CREATED=TOTAL_USERS_CREATED, 
-        inventory_html=inventory_html,
-        notifications_html=notifications_html,
-        add_product_modal_html=ADD_PRODUCT_MODAL_HTML,
-        edit_product_select_modal_html=EDIT_PRODUCT_SELECT_MODAL_HTML,
-        delete_product_select_modal_html=DELETE_PRODUCT_SELECT_MODAL_HTML,
-        SERVER_NAME_TITLE=SERVER_NAME, 
-        dashboard_js=DASHBOARD_JS_SCRIPT
-    ))
-    
+    async def stream():
+        queue = dashboard_hub.subscribe()
+        try:
+            yield b"retry: 3000\n\n"
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), DASHBOARD_SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield b": ping\n\n" # Mantiene viva la conexión a través de nginx
+        finally:
+            dashboard_hub.unsubscribe(queue)
 
-# --- ENDPOINTS TEST DE VENTA (Refactorizado para Redis) ---
+    # X-Accel-Buffering: nginx entrega cada evento al momento en vez de acumularlo en su buffer
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.get("/test-sale", response_class=HTMLResponse, tags=["Dashboard"])
 async def test_sale_form():
@@ -1132,6 +3634,7 @@ async def submit_test_sale(branch_id: str = Form(...)):
         raise HTTPException(status_code=404, detail=f"Producto de test (ID {TEST_PRODUCT_ID}) no encontrado.")
 
     final_branch_id = branch_id if branch_id.startswith("TEST") else f"TEST-{branch_id}"
+    admit_test_request()
 
     notification_data = {
         "sale_id": f"TEST-{uuid.uuid4().hex[:8]}",
@@ -1144,7 +3647,8 @@ async def submit_test_sale(branch_id: str = Form(...)):
         "timestamp": datetime.now().isoformat()
     }
     
-    await process_sale_notification(notification_data)
+    async with test_http_slots:
+        await process_sale_notification(SaleNotification(**notification_data))
     updated_stock = product.stock 
 
     return JSONResponse({
@@ -1157,9 +3661,16 @@ async def submit_test_sale(branch_id: str = Form(...)):
 @app.get("/users", response_class=HTMLResponse, tags=["Usuarios"])
 async def list_users():
     r = get_redis_client()
-    total_users_count_str = r.get(TOTAL_USERS_KEY) if r else None
+    total_users_count_str, raw_users_data = None, {}
+    if r:
+        try:
+            pipeline = r.pipeline()
+            pipeline.get(TOTAL_USERS_KEY)
+            pipeline.hgetall(USERS_HASH_KEY)
+            total_users_count_str, raw_users_data = await pipeline.execute()
+        except Exception as e:
+            logger.error(f"Error al leer usuarios de Redis: {e}")
     TOTAL_USERS_CREATED_CURRENT = int(total_users_count_str) if total_users_count_str else 0
-    raw_users_data = await asyncio.to_thread(r.hgetall, USERS_HASH_KEY) if r else {}
     
     users_html = ""
     for key, user_json in raw_users_data.items():
@@ -1397,7 +3908,7 @@ async def submit_sale(
         "timestamp": datetime.now().isoformat()
     }
     
-    await process_sale_notification(notification_data)
+    await process_sale_notification(SaleNotification(**notification_data))
 
     content = f"""
         <h3>✅ Venta registrada correctamente!</h3>
@@ -1413,11 +3924,11 @@ async def submit_sale(
 if __name__ == "__main__":
     import uvicorn
     # Cargar variables de entorno para workers (en caso de correr con python)
-    BRANCHES = os.getenv("BRANCHES", "http://sucursal-demo:8002").split(",")
     RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
     RABBITMQ_USER = os.getenv("RABBITMQ_USER", "ecomarket_user")
     RABBITMQ_PASS = os.getenv("RABBITMQ_PASS", "ecomarket_password")
     QUEUE_DIRECT = os.getenv("RABBITMQ_QUEUE_DIRECT", "ventas_central_direct") 
+    QUEUE_DIRECT_TEST = os.getenv("RABBITMQ_QUEUE_TEST", "ventas_central_test")
     EXCHANGE_DIRECT = os.getenv("RABBITMQ_EXCHANGE_DIRECT", "notificaciones_direct") 
     QUEUE_FANOUT = "ventas_central_fanout"
     EXCHANGE_FANOUT = os.getenv("RABBITMQ_EXCHANGE_FANOUT", "ventas_global_fanout") 
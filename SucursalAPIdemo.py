@@ -1,5 +1,5 @@
 from fastapi import FastAPI, HTTPException, BackgroundTasks, Form
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from pydantic import BaseModel, field_validator
 from typing import Dict, List, Optional, Union
 from datetime import datetime, timedelta
@@ -30,6 +30,14 @@ app = FastAPI(
 # ===== CONFIGURACIÓN (MODIFICADA para Modos 5 y 6) =====
 BRANCH_ID = os.getenv("BRANCH_ID", "sucursal-demo")
 CENTRAL_API_URL = os.getenv("CENTRAL_API_URL", "http://central:8000")
+# URL con la que la Central llega a esta sucursal; se anuncia en el registro con heartbeats
+BRANCH_PUBLIC_URL = os.getenv("BRANCH_PUBLIC_URL", f"http://{BRANCH_ID}:8002")
+BRANCH_HEARTBEAT_SECONDS = float(os.getenv("BRANCH_HEARTBEAT_SECONDS", "10")) # Debe ser menor que el TTL de la Central
+BRANCH_REGISTRATION_SECRET = os.getenv("BRANCH_REGISTRATION_SECRET", "") # Secreto compartido con la Central (X-Branch-Token)
+# Inventario: foto inicial de la Central y luego deltas de su changelog (GET /inventory/changes)
+INVENTORY_PULL = os.getenv("INVENTORY_PULL", "1") == "1"
+INVENTORY_LONG_POLL_SECONDS = float(os.getenv("INVENTORY_LONG_POLL_SECONDS", "25")) # 0 = sondeo simple cada INVENTORY_PULL_INTERVAL_SECONDS
+INVENTORY_PULL_INTERVAL_SECONDS = float(os.getenv("INVENTORY_PULL_INTERVAL_SECONDS", "5"))
 
 ### Modo de notificación global (1-3: HTTP, 4: Redis, 5: RabbitMQ Directo, 6: RabbitMQ Fanout)
 NOTIF_MODE = int(os.getenv("NOTIF_MODE", "6")) 
@@ -38,10 +46,16 @@ NOTIF_MODE = int(os.getenv("NOTIF_MODE", "6"))
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
 REDIS_QUEUE = os.getenv("REDIS_QUEUE", "sales_queue_redis")
+REDIS_QUEUE_TEST = os.getenv("REDIS_QUEUE_TEST", f"{REDIS_QUEUE}:test") # Ventas de prueba: lista aparte
+REDIS_QUEUE_DEAD = os.getenv("REDIS_QUEUE_DEAD", f"{REDIS_QUEUE}:dead") # Ventas que la Central rechaza (4xx): revisión manual
 
 # Constante del Producto Falso (Debe ser idéntica a la Central)
 TEST_PRODUCT_ID = 999 # <<-- ¡DEFINICIÓN AGREGADA/CONFIRMADA!
 
+def is_test_sale(product_id: int) -> bool:
+    # Mismo criterio que la Central: producto falso o sucursal de prueba
+    return product_id == TEST_PRODUCT_ID or BRANCH_ID.startswith("TEST")
+
 def get_redis_client():
     return redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
 
@@ -54,6 +68,8 @@ RABBITMQ_PASS = os.getenv("RABBITMQ_PASS", "ecomarket_password")
 # Modo 5: Directo/Punto-a-Punto (P2P)
 RABBITMQ_QUEUE_DIRECT = os.getenv("RABBITMQ_QUEUE_DIRECT", "ventas_central_direct") 
 RABBITMQ_EXCHANGE_DIRECT = os.getenv("RABBITMQ_EXCHANGE_DIRECT", "notificaciones_direct") 
+# Las ventas de prueba van siempre por el exchange directo a su propia cola (modos 5 y 6)
+RABBITMQ_QUEUE_TEST = os.getenv("RABBITMQ_QUEUE_TEST", "ventas_central_test")
 
 # Modo 6: Fanout/Pub/Sub (Ventas)
 RABBITMQ_EXCHANGE_FANOUT = os.getenv("RABBITMQ_EXCHANGE_FANOUT", "ventas_global_fanout") 
@@ -172,14 +188,54 @@ class CircuitBreaker:
 circuit_breaker = CircuitBreaker(failure_threshold=3, recovery_timeout=60)
 
 # ===== INVENTARIO LOCAL Y HISTORIAL DE VENTAS (se mantiene) =====
+# Inventario de arranque: se reemplaza por la foto de la Central en cuanto responde
 local_inventory: Dict[int, Product] = {
     1: Product(id=1, name="Manzanas Orgánicas", price=2.50, stock=25),
     2: Product(id=2, name="Pan Integral", price=1.80, stock=15),
     3: Product(id=3, name="Leche Deslactosada", price=3.20, stock=8)
 }
+inventory_version = 0 # Última versión del changelog de la Central aplicada (0 = sin foto todavía)
 sales_history: List[SaleResponse] = []
 user_db: Dict[str, UserCreate] = {} # Base de datos de usuarios simulada
 
+# ===== EVENTOS EN VIVO DEL DASHBOARD (SSE) =====
+# La sucursal es un solo proceso: los eventos se reparten en memoria a los dashboards conectados
+DASHBOARD_SSE_QUEUE_SIZE = 256 # Eventos pendientes por cliente; si se llena, el cliente recibe 'resync'
+DASHBOARD_SSE_KEEPALIVE_SECONDS = 15.0
+DASHBOARD_SALES_ROWS = 100
+SSE_RESYNC_FRAME = b"event: resync\ndata: {}\n\n"
+dashboard_clients: set = set()
+
+def broadcast_dashboard_frame(frame: bytes):
+    for queue in dashboard_clients:
+        try:
+            queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            # Cliente lento: se descarta lo pendiente y se le pide recargar los datos completos
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(SSE_RESYNC_FRAME)
+
+def publish_dashboard_event(name: str, payload: dict):
+    if dashboard_clients:
+        broadcast_dashboard_frame(f"event: {name}\ndata: {json.dumps(payload)}\n\n".encode())
+
+def publish_product_event(product_id: int):
+    product = local_inventory.get(product_id)
+    if product is None:
+        publish_dashboard_event("inventory", {"op": "delete", "id": product_id})
+    else:
+        publish_dashboard_event("inventory", {"op": "upsert", "id": product_id, "product": product.model_dump()})
+
+def is_real_sale(sale: SaleResponse) -> bool:
+    # Las ventas de prueba (ID 999) o sincronizadas sin id (SYNC) no cuentan en la recaudación ni en el conteo
+    return sale.product_id != TEST_PRODUCT_ID and not sale.sale_id.startswith("TEST") and not sale.sale_id.startswith("SYNC")
+
+def record_sale(sale: SaleResponse):
+    """Agrega la venta al historial y la anuncia a los dashboards conectados."""
+    sales_history.append(sale)
+    publish_dashboard_event("sale", {**sale.model_dump(mode="json"), "real": is_real_sale(sale)})
+
 # =================================================================
 # === FUNCIONES DE NOTIFICACIÓN PARA VENTAS (Paso 1 al 6) =========
 # =================================================================
@@ -252,54 +308,115 @@ def send_notification_to_redis(sale: SaleResponse):
         "total_amount": sale.total_amount, "change": sale.change, 
         "timestamp": sale.timestamp.isoformat()
     }
+    queue = REDIS_QUEUE_TEST if is_test_sale(sale.product_id) else REDIS_QUEUE
     try:
         r = get_redis_client()
-        r.rpush(REDIS_QUEUE, json.dumps(notification))
-        logger.info(f"✅ Notificación encolada en Redis (4/6): {REDIS_QUEUE}")
+        r.rpush(queue, json.dumps(notification))
+        logger.info(f"✅ Notificación encolada en Redis (4/6): {queue}")
         return True
     except Exception as e:
         logger.error(f"❌ Fallo al enviar a Redis: {e}. Venta {sale.sale_id} NO encolada.")
         return False
 
-def _redis_lpop_once():
-    """Helper bloqueante: hace LPOP y devuelve el string (o None)."""
+def _redis_lpop_batch(count: int, queue: str = REDIS_QUEUE):
+    """Helper bloqueante: LPOP con COUNT (Redis >= 6.2). Devuelve una lista (posiblemente vacía)."""
     try:
         r = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
-        raw = r.lpop(REDIS_QUEUE)
-        return raw
+        return r.lpop(queue, count) or []
     except Exception as e:
         logger.error(f"Redis LPOP fallo: {e}")
-        return None
+        return []
 
-def _redis_rpush(value: str):
+def _redis_rpush(*values: str, queue: str = REDIS_QUEUE):
     """Helper bloqueante: rpush."""
     try:
         r = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
-        r.rpush(REDIS_QUEUE, value)
+        r.rpush(queue, *values)
         return True
     except Exception as e:
         logger.error(f"Redis RPUSH fallo: {e}")
         return False
 
+def _redis_requeue_front(*values: str, queue: str = REDIS_QUEUE):
+    """Helper bloqueante: devuelve los valores a la cabeza de la lista conservando su orden (LPUSH en orden inverso)."""
+    try:
+        r = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+        r.lpush(queue, *reversed(values))
+        return True
+    except Exception as e:
+        logger.error(f"Redis LPUSH fallo: {e}")
+        return False
+
+# Tamaño del lote al vaciar la cola de Redis hacia la Central (POST /sale-notifications/batch)
+REDIS_DRAIN_BATCH_SIZE = int(os.getenv("REDIS_DRAIN_BATCH_SIZE", "200"))
+REDIS_TEST_DRAIN_BATCH_SIZE = int(os.getenv("REDIS_TEST_DRAIN_BATCH_SIZE", "50"))
+
+async def notify_batch(notifications: List[dict]):
+    """Envía un lote de ventas a la Central en una sola petición."""
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        resp = await client.post(f"{CENTRAL_API_URL}/sale-notifications/batch", json=notifications)
+        resp.raise_for_status()
+        body = resp.json()
+        for item in body.get("results", []):
+            if item.get("status") == "unknown_product":
+                logger.error(f"❌ Central rechazó la venta {item.get('sale_id')}: producto desconocido.")
+        logger.info(f"✅ Lote de {len(notifications)} notificaciones enviado (ok={body.get('ok')}, duplicadas={body.get('duplicate')})")
+
+def is_transient_failure(error: Exception) -> bool:
+    """Red caída, timeout o 5xx/408/429: vale la pena reintentar el mismo lote. Otro 4xx no se arregla reintentando."""
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status >= 500 or status in (408, 429)
+    return True # Red/timeout u otro fallo local: la Central deduplica, reenviar es seguro
+
+async def drain_batch(notifs: List[dict], queue: str) -> List[dict]:
+    """
+    Envía el lote a la Central. Ante un 4xx lo parte en mitades hasta aislar las ventas rechazadas, que van a
+    REDIS_QUEUE_DEAD. Retorna las ventas a reencolar (fallo transitorio), en su orden original.
+    """
+    try:
+        await notify_batch(notifs)
+        return []
+    except Exception as e:
+        if is_transient_failure(e):
+            logger.error(f"❌ Falló reenvío de {len(notifs)} notificaciones desde Redis: {e}")
+            return notifs
+        if len(notifs) > 1:
+            middle = len(notifs) // 2
+            pending = await drain_batch(notifs[:middle], queue)
+            if pending:
+                return pending + notifs[middle:] # Sin adelantar ventas posteriores a las que quedan pendientes
+            return await drain_batch(notifs[middle:], queue)
+        dead = {"queue": queue, "error": str(e), "parked_at": datetime.now().isoformat(), "notification": notifs[0]}
+        await asyncio.to_thread(lambda: _redis_rpush(json.dumps(dead), queue=REDIS_QUEUE_DEAD))
+        logger.error(f"🅿️ Venta {notifs[0].get('sale_id')} rechazada por la Central ({e}): movida a {REDIS_QUEUE_DEAD}")
+        return []
+
 async def redis_queue_worker(poll_interval: float = 2.0):
     logger.info("🔁 Redis worker iniciado")
     while True:
         try:
-            raw = await asyncio.to_thread(_redis_lpop_once)
-            if raw:
-                try:
-                    notif = json.loads(raw)
-                except Exception:
-                    logger.error("❌ Mensaje Redis no decodable, saltando")
+            # Prioridad a las ventas reales: la lista de prueba solo se vacía cuando la real está vacía
+            queue = REDIS_QUEUE
+            raw_items = await asyncio.to_thread(_redis_lpop_batch, REDIS_DRAIN_BATCH_SIZE)
+            if not raw_items:
+                queue = REDIS_QUEUE_TEST
+                raw_items = await asyncio.to_thread(_redis_lpop_batch, REDIS_TEST_DRAIN_BATCH_SIZE, REDIS_QUEUE_TEST)
+            if raw_items:
+                notifs = []
+                for raw in raw_items:
+                    try:
+                        notifs.append(json.loads(raw))
+                    except Exception:
+                        logger.error("❌ Mensaje Redis no decodable, saltando")
+                if not notifs:
                     continue
 
-                logger.info(f"🔄 Reintentando notificación desde Redis: sale_id={notif.get('sale_id')}")
-                try:
-                    await notify_backoff(notif)
-                    logger.info(f"✅ Reenvío exitoso desde Redis: {notif.get('sale_id')}")
-                except Exception as e:
-                    logger.error(f"❌ Falló reenvío desde Redis: {e}. Re-enqueueando")
-                    await asyncio.to_thread(_redis_rpush, json.dumps(notif))
+                logger.info(f"🔄 Reintentando {len(notifs)} notificaciones desde Redis (lote)")
+                pending = await drain_batch(notifs, queue)
+                if pending:
+                    logger.error(f"❌ {len(pending)} notificaciones vuelven a la cabeza de {queue}")
+                    await asyncio.to_thread(lambda: _redis_requeue_front(*[json.dumps(n) for n in pending], queue=queue))
                     await asyncio.sleep(5.0)
             else:
                 await asyncio.sleep(poll_interval)
@@ -307,8 +424,12 @@ async def redis_queue_worker(poll_interval: float = 2.0):
             logger.error(f"Redis worker encontró error: {e}")
             await asyncio.sleep(5.0)
 
+def published_at_header() -> dict:
+    # La Central mide la latencia extremo a extremo (publicación -> commit) con esta cabecera en ms
+    return {"x-published-at": int(time.time() * 1000)}
+
 # Modo 5: RabbitMQ Publisher (Directo/Punto-a-Punto)
-def publish_sale_direct(sale_data: dict, max_retries: int = 3):
+def publish_sale_direct(sale_data: dict, max_retries: int = 3, routing_key: str = RABBITMQ_QUEUE_DIRECT):
     message = {
         **sale_data, "message_id": str(uuid.uuid4()),
         "timestamp": datetime.now().isoformat(), "source": BRANCH_ID, "mode": "Direct"
@@ -326,9 +447,9 @@ def publish_sale_direct(sale_data: dict, max_retries: int = 3):
                 channel = connection.channel()
                 channel.exchange_declare(exchange=RABBITMQ_EXCHANGE_DIRECT, exchange_type='direct', durable=True)
                 channel.basic_publish(
-                    exchange=RABBITMQ_EXCHANGE_DIRECT, routing_key=RABBITMQ_QUEUE_DIRECT, 
+                    exchange=RABBITMQ_EXCHANGE_DIRECT, routing_key=routing_key, 
                     body=json.dumps(message, default=str),
-                    properties=pika.BasicProperties(delivery_mode=2), mandatory=True
+                    properties=pika.BasicProperties(delivery_mode=2, headers=published_at_header()), mandatory=True
                 )
                 logger.info(f"✅ Mensaje RabbitMQ Directo (5/6) publicado.")
                 return True 
@@ -347,7 +468,10 @@ def send_notification_to_rabbitmq_direct(sale: SaleResponse):
         "total_amount": sale.total_amount, "change": sale.change, 
         "timestamp": sale.timestamp.isoformat()
     }
-    publish_sale_direct(notification_data)
+    if is_test_sale(sale.product_id):
+        publish_sale_direct(notification_data, routing_key=RABBITMQ_QUEUE_TEST)
+    else:
+        publish_sale_direct(notification_data)
 
 # MODO 6: RabbitMQ Publisher (Pub/Sub Fanout - Ventas)
 def publish_sale_fanout(sale_data: dict, max_retries: int = 3):
@@ -368,9 +492,11 @@ def publish_sale_fanout(sale_data: dict, max_retries: int = 3):
                 channel = connection.channel()
                 channel.exchange_declare(exchange=RABBITMQ_EXCHANGE_FANOUT, exchange_type='fanout', durable=True)
                 channel.basic_publish(
-                    exchange=RABBITMQ_EXCHANGE_FANOUT, routing_key='', 
+                    # El fanout ignora la routing key; el exchange x-consistent-hash de la Central (modo particionado)
+                    # la usa para repartir por producto, así las ventas de un producto caen en la misma partición
+                    exchange=RABBITMQ_EXCHANGE_FANOUT, routing_key=str(sale_data.get("product_id", "")), 
                     body=json.dumps(message, default=str),
-                    properties=pika.BasicProperties(delivery_mode=2), mandatory=True
+                    properties=pika.BasicProperties(delivery_mode=2, headers=published_at_header()), mandatory=True
                 )
                 logger.info(f"✅ Mensaje RabbitMQ Fanout (6/6) publicado.")
                 return True 
@@ -427,7 +553,7 @@ def publish_user_created(user_data: dict):
                 exchange=EXCHANGE_USER_EVENTS, 
                 routing_key='', 
                 body=json.dumps(message, default=str),
-                properties=pika.BasicProperties(delivery_mode=2)
+                properties=pika.BasicProperties(delivery_mode=2, headers=published_at_header())
             )
             
             logger.info(f"✅ EVENTO PUBLICADO: UsuarioCreado para {user_data['email']} en exchange {EXCHANGE_USER_EVENTS}")
@@ -453,8 +579,8 @@ async def send_sale_notification(sale: SaleResponse):
     elif NOTIF_MODE == 4:
         # Redis: encolamos usando thread (no bloqueamos loop)
         await asyncio.to_thread(send_notification_to_redis, sale)
-    elif NOTIF_MODE == 5:
-        # RabbitMQ Directo (Punto-a-Punto)
+    elif NOTIF_MODE == 5 or (NOTIF_MODE == 6 and is_test_sale(sale.product_id)):
+        # RabbitMQ Directo (Punto-a-Punto). Las ventas de prueba siempre por aquí, a su propia cola
         await asyncio.to_thread(send_notification_to_rabbitmq_direct, sale)
     elif NOTIF_MODE == 6:
         # RabbitMQ Fanout (Pub/Sub) - ¡NUEVO!
@@ -491,7 +617,8 @@ async def process_sale(sale_request: SaleRequest):
         timestamp=sale_timestamp,
         status="completed"
     )
-    sales_history.append(sale_response)
+    record_sale(sale_response)
+    publish_product_event(product.id)
 
     # Ejecutar envío como tarea asíncrona (no blocking)
     asyncio.create_task(send_sale_notification(sale_response))
@@ -501,18 +628,24 @@ async def process_sale(sale_request: SaleRequest):
 # =======================================================
 # === ENDPOINT DE SINCRONIZACIÓN DE HISTORIAL (CORREGIDO) === TALLER 7 APLICADO
 # =======================================================
-@app.post("/sync-sale-history", tags=["Sincronización"])
-async def sync_sale_history(notification: SaleNotificationFromCentral):
-    """
-    Recibe la notificación de venta de la Central API (incluyendo las ventas de prueba)
-    y la agrega al historial de ventas local para que aparezca en el dashboard.
-    """
-    
+# La Central entrega por un outbox "al menos una vez": tras un reintento puede llegar la misma venta otra vez
+SYNCED_SALE_IDS_MAX = 10000
+synced_sale_ids: Dict[str, None] = {} # Ventas ya sincronizadas (en orden de llegada, acotado)
+
+def append_synced_sale(notification: SaleNotificationFromCentral) -> bool:
+    """Agrega una venta recibida de la Central al historial local. Retorna False si era propia o ya se había recibido."""
     # [CORRECCIÓN 1: FILTRO ANTI-DUPLICADOS]
     # Si la venta se originó en esta misma sucursal, ya la tenemos. No la duplicamos.
     if notification.branch_id == BRANCH_ID:
         logger.info(f"ℹ️ Historial: Venta propia ({notification.sale_id}) omitida. Ya está registrada.")
-        return {"status": "success", "message": "Venta propia omitida."}
+        return False
+    if notification.sale_id:
+        if notification.sale_id in synced_sale_ids:
+            logger.info(f"ℹ️ Historial: Venta {notification.sale_id} ya sincronizada (reentrega). Omitida.")
+            return False
+        synced_sale_ids[notification.sale_id] = None
+        if len(synced_sale_ids) > SYNCED_SALE_IDS_MAX:
+            del synced_sale_ids[next(iter(synced_sale_ids))]
     
     # Buscamos el nombre del producto en el inventario local. Si no existe, usamos un nombre genérico.
     product_name = local_inventory.get(
@@ -539,13 +672,29 @@ async def sync_sale_history(notification: SaleNotificationFromCentral):
     )
     
     # Agregamos al historial
-    sales_history.append(sale_response)
+    record_sale(sale_response)
     
     # [CORRECCIÓN 2: ARREGLO DEL CRASH]
     # Usamos 'notification.branch_id' (que sí existe) en lugar de 'sale_response.branch_id'
     logger.info(f"✅ Historial sincronizado: {sale_response.sale_id} ({notification.branch_id})")
+    return True
+
+@app.post("/sync-sale-history", tags=["Sincronización"])
+async def sync_sale_history(notification: SaleNotificationFromCentral):
+    """
+    Recibe la notificación de venta de la Central API (incluyendo las ventas de prueba)
+    y la agrega al historial de ventas local para que aparezca en el dashboard.
+    """
+    if not append_synced_sale(notification):
+        return {"status": "success", "message": "Venta propia o ya sincronizada omitida."}
     return {"status": "success", "message": "Historial de venta sincronizado."}
 
+@app.post("/sync-sale-history/batch", tags=["Sincronización"])
+async def sync_sale_history_batch(notifications: List[SaleNotificationFromCentral]):
+    """Versión por lotes: la Central envía todas las ventas de un lote en una sola petición."""
+    synced = sum(1 for n in notifications if append_synced_sale(n))
+    return {"status": "success", "synced": synced, "skipped": len(notifications) - synced}
+
 
 # ===== NUEVA RUTA DE REGISTRO DE USUARIO (Taller 4) =====
 @app.post("/users/register", tags=["Usuarios (Taller 4)"])
@@ -607,26 +756,29 @@ async def register_user_form():
 """
 
 # ===== DASHBOARD (ESTABLE Y COMPLETO - Se mantiene) =====
+def dashboard_metrics() -> dict:
+    # Filtramos las ventas de prueba (ID 999) o sincronizadas (branch_id TEST) para la recaudación y el conteo.
+    real_sales = [s for s in sales_history if is_real_sale(s)]
+    return {
+        "stock": sum(p.stock for p in local_inventory.values()),
+        "sales_count": len(real_sales),
+        "total_revenue": sum(s.total_amount for s in real_sales),
+    }
+
 @app.get("/dashboard", response_class=HTMLResponse, tags=["Dashboard"])
 async def dashboard():
     # Cálculo de métricas
-    # Filtramos las ventas de prueba (ID 999) o sincronizadas (branch_id TEST) para la recaudación y el conteo.
-    real_sales = [
-        s for s in sales_history 
-        if s.product_id != TEST_PRODUCT_ID and not s.sale_id.startswith("TEST") and not s.sale_id.startswith("SYNC")
-    ]
-    
-    # Usamos len(real_sales) para el conteo de ventas.
-    total_sales_count = len(real_sales) 
-    total_products_count = sum(p.stock for p in local_inventory.values())
-    total_revenue = sum(s.total_amount for s in real_sales)
+    metrics = dashboard_metrics()
+    total_sales_count = metrics["sales_count"]
+    total_products_count = metrics["stock"]
+    total_revenue = metrics["total_revenue"]
     
     # Opciones del selector de producto para el modal
     options_html = "".join([f"<option value='{p.id}'>{p.name}</option>" for p in local_inventory.values()])
 
     # Tabla de inventario
     inventory_html = "".join([
-        f"<tr><td>{p.id}</td><td>{p.name}</td><td>${p.price:.2f}</td><td>{p.stock}</td></tr>"
+        f"<tr data-product-id='{p.id}'><td>{p.id}</td><td>{p.name}</td><td>${p.price:.2f}</td><td>{p.stock}</td></tr>"
         for p in local_inventory.values()
     ])
 
@@ -790,9 +942,9 @@ body {{
     <a class="navbar-brand" href="#">EcoMarket Sucursal: {BRANCH_ID}</a>
         <div class="ms-auto d-flex align-items-center">
         <div class="metrics-expanded d-flex">
-            <div class="metric-item"><h6>Stock Total</h6><p>{total_products_count}</p></div>
-            <div class="metric-item"><h6>Ventas</h6><p>{total_sales_count}</p></div>
-            <div class="metric-item"><h6>Recaudación</h6><p>${total_revenue:.2f}</p></div>
+            <div class="metric-item"><h6>Stock Total</h6><p id="metric-stock">{total_products_count}</p></div>
+            <div class="metric-item"><h6>Ventas</h6><p id="metric-sales">{total_sales_count}</p></div>
+            <div class="metric-item"><h6>Recaudación</h6><p id="metric-revenue">${total_revenue:.2f}</p></div>
             <div class="metric-item"><h6>Breaker</h6><p>{cb_state}</p></div>
         </div>
     <div class="mode-container">
@@ -811,7 +963,7 @@ body {{
     
     <button onclick="window.location.href='/register-user'" class="btn btn-main ms-2">Registrar Usuario</button> 
     <button class="btn btn-main ms-2" data-bs-toggle="modal" data-bs-target="#saleModal">Registrar Venta</button>
-    <button class="btn btn-sale ms-2" onclick="window.location.reload()">Actualizar</button>
+    <button class="btn btn-sale ms-2" onclick="resyncDashboard()">Actualizar</button>
     </div>
 </nav>
 
@@ -824,7 +976,7 @@ body {{
                     <div class="table-responsive" style="max-height:400px;">
                         <table class="table table-hover table-sm mb-0 align-middle">
                         <thead><tr><th>ID</th><th>Producto</th><th>Precio</th><th>Stock</th></tr></thead>
-                            <tbody>{inventory_html}</tbody>
+                            <tbody id="inventory-body">{inventory_html}</tbody>
                         </table>
                     </div>
                 </div>
@@ -860,7 +1012,7 @@ body {{
                     <div class="modal-body">
                         <div class="mb-2">
                             <label>Producto</label>
-                            <select class="form-select" name="product_id" required>{options_html}</select>
+                            <select class="form-select" id="sale-product" name="product_id" required>{options_html}</select>
                         </div>
                         <div class="mb-2">
                     <label>Cantidad</label>
@@ -898,7 +1050,7 @@ document.getElementById('saleForm').addEventListener('submit', async (e) => {{
         showToast('✅ Venta registrada correctamente');
         const modal = bootstrap.Modal.getInstance(document.getElementById('saleModal'));
         modal.hide();
-        setTimeout(() => window.location.reload(), 1200);
+        form.reset(); // La fila y las métricas llegan por /events
     }} else {{
         const text = await res.text();
         // Intenta extraer el error de la respuesta HTML si falla la venta
@@ -917,11 +1069,129 @@ function showToast(msg, error=false) {{
     toast.style.display = 'block';
     setTimeout(() => toast.style.display = 'none', 3000);
 }}
+
+// ===== Actualización en vivo: una conexión SSE inactiva en vez de recargar la página =====
+const money = v => '$' + Number(v || 0).toFixed(2);
+
+function tableRow(cells) {{
+    const tr = document.createElement('tr');
+    for (const value of cells) {{
+        const td = document.createElement('td');
+        td.textContent = value; // textContent: los nombres de producto no se interpretan como HTML
+        tr.appendChild(td);
+    }}
+    return tr;
+}}
+
+function productRow(p) {{
+    const tr = tableRow([p.id, p.name, money(p.price), p.stock]);
+    tr.dataset.productId = p.id;
+    return tr;
+}}
+
+function saleRow(s) {{
+    const id = String(s.sale_id);
+    const tr = tableRow([
+        String(s.timestamp).replace('T', ' ').slice(0, 19),
+        id.includes('_') ? id.split('_')[0] : id,
+        s.product_name, s.quantity_sold, money(s.total_amount), money(s.money_received), money(s.change), id.slice(-12),
+    ]);
+    tr.className = s.real ? '' : 'table-info';
+    tr.lastChild.className = 'text-muted small';
+    return tr;
+}}
+
+function refreshInventoryDerived() {{
+    const rows = [...document.getElementById('inventory-body').rows];
+    document.getElementById('metric-stock').textContent = rows.reduce((sum, tr) => sum + Number(tr.cells[3].textContent), 0);
+    const select = document.getElementById('sale-product');
+    const selected = select.value;
+    select.replaceChildren(...rows.map(tr => new Option(tr.cells[1].textContent, tr.dataset.productId)));
+    select.value = selected;
+}}
+
+function applyInventoryEvent(e) {{
+    const body = document.getElementById('inventory-body');
+    const row = body.querySelector(`tr[data-product-id="${{e.id}}"]`);
+    if (e.op === 'delete') {{
+        if (row) row.remove();
+    }} else if (row) {{
+        row.replaceWith(productRow(e.product));
+    }} else {{
+        body.appendChild(productRow(e.product));
+    }}
+    refreshInventoryDerived();
+}}
+
+function applySaleEvent(s) {{
+    const body = document.getElementById('sales-body');
+    body.insertBefore(saleRow(s), body.firstChild);
+    while (body.rows.length > {DASHBOARD_SALES_ROWS}) body.deleteRow(-1);
+    if (s.real) {{
+        const sales = document.getElementById('metric-sales');
+        const revenue = document.getElementById('metric-revenue');
+        sales.textContent = Number(sales.textContent) + 1;
+        revenue.textContent = money(Number(revenue.textContent.slice(1)) + s.total_amount);
+    }}
+}}
+
+async function resyncDashboard() {{
+    try {{
+        const data = await (await fetch('/dashboard/data')).json();
+        document.getElementById('inventory-body').replaceChildren(...data.inventory.map(productRow));
+        document.getElementById('sales-body').replaceChildren(...data.sales.map(saleRow));
+        document.getElementById('metric-sales').textContent = data.metrics.sales_count;
+        document.getElementById('metric-revenue').textContent = money(data.metrics.total_revenue);
+        refreshInventoryDerived();
+    }} catch (error) {{
+        showToast('❌ No se pudo actualizar el dashboard.', true);
+    }}
+}}
+
+function connectDashboardEvents() {{
+    const source = new EventSource('/events'); // Reconecta solo; al volver pide los datos completos
+    let lost = false;
+    source.onerror = () => {{ lost = true; }};
+    source.onopen = () => {{ if (lost) resyncDashboard(); lost = false; }};
+    source.addEventListener('sale', ev => applySaleEvent(JSON.parse(ev.data)));
+    source.addEventListener('inventory', ev => applyInventoryEvent(JSON.parse(ev.data)));
+    source.addEventListener('resync', resyncDashboard);
+}}
+
+connectDashboardEvents();
 </script>
 </body>
 </html>
 """
 
+@app.get("/dashboard/data", tags=["Dashboard"])
+async def dashboard_data():
+    """Datos completos del dashboard (inventario, últimas ventas y métricas) para resincronizar en el navegador."""
+    sales = [
+        {**s.model_dump(mode="json"), "real": is_real_sale(s)}
+        for s in reversed(sales_history[-DASHBOARD_SALES_ROWS:])
+    ]
+    return {"inventory": list(local_inventory.values()), "sales": sales, "metrics": dashboard_metrics()}
+
+@app.get("/events", tags=["Dashboard"])
+async def dashboard_events():
+    """Stream SSE del dashboard: 'sale', 'inventory' (producto completo o borrado) y 'resync'."""
+    async def stream():
+        queue = asyncio.Queue(maxsize=DASHBOARD_SSE_QUEUE_SIZE)
+        dashboard_clients.add(queue)
+        try:
+            yield b"retry: 3000\n\n"
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), DASHBOARD_SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield b": ping\n\n"
+        finally:
+            dashboard_clients.discard(queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 # ===== CAMBIO DE MODO (Actualizado para incluir el modo 6) =====
 @app.post("/set-mode", response_class=HTMLResponse, tags=["Dashboard"])
 async def set_mode(mode: int = Form(...)):
@@ -963,7 +1233,8 @@ async def submit_sale_form(
         timestamp=sale_timestamp,
         status="completed"
     )
-    sales_history.append(sale)
+    record_sale(sale)
+    publish_product_event(product.id)
 
     # Ejecutar la notificación en background (usa send_sale_notification)
     asyncio.create_task(send_sale_notification(sale))
@@ -999,10 +1270,12 @@ async def add_product_from_central(product: Product):
     """
     if product.id in local_inventory:
         local_inventory[product.id] = product
+        publish_product_event(product.id)
         logger.info(f"🔄 Producto actualizado desde Central: {product.name}")
         return {"status": "updated", "product": product}
     else:
         local_inventory[product.id] = product
+        publish_product_event(product.id)
         logger.info(f"🆕 Producto agregado desde Central: {product.name}")
         return {"status": "added", "product": product}
 
@@ -1020,6 +1293,7 @@ async def update_product_from_central(product_id: int, product: Product):
         logger.info(f"♻️ Producto forzosamente actualizado/agregado por Central: {product.name}")
     
     local_inventory[product_id] = product
+    publish_product_event(product_id)
     logger.info(f"♻️ Producto actualizado por Central: {product.name} (Stock: {product.stock})")
     return {"status": "updated", "product": product}
 
@@ -1029,6 +1303,7 @@ async def delete_product_from_central(product_id: int):
     if product_id not in local_inventory:
         raise HTTPException(status_code=404, detail="Producto no encontrado")
     removed = local_inventory.pop(product_id)
+    publish_product_event(product_id)
     logger.info(f"🗑️ Producto eliminado por Central: {removed.name}")
     return {"status": "deleted", "product": removed.name}
 
@@ -1065,17 +1340,90 @@ async def root():
         "branch_id": BRANCH_ID,
         "status": "operational",
         "total_products": len(local_inventory),
+        "inventory_version": inventory_version,
         "total_sales": len(sales_history),
         "current_notification_mode": NOTIF_MODE,
         "circuit_breaker_state": circuit_breaker.state.value if NOTIF_MODE in [1,2,3] else 'N/A',
         "circuit_failures": circuit_breaker.failure_count if NOTIF_MODE in [1,2,3] else 'N/A'
     }
 
+async def branch_heartbeat_loop():
+    """Anuncia la sucursal en el registro de la Central; si deja de hacerlo, la Central la retira tras el TTL."""
+    payload = {"branch_id": BRANCH_ID, "url": BRANCH_PUBLIC_URL}
+    registered = False
+    async with httpx.AsyncClient(timeout=5.0) as client:
+        while True:
+            try:
+                resp = await client.post(f"{CENTRAL_API_URL}/branches/heartbeat", json=payload,
+                                         headers={"X-Branch-Token": BRANCH_REGISTRATION_SECRET})
+                resp.raise_for_status()
+                if not registered:
+                    logger.info(f"🏪 Sucursal registrada en la Central como {BRANCH_PUBLIC_URL}")
+                registered = True
+            except Exception as e:
+                logger.warning(f"⚠️ Heartbeat a la Central fallido: {e}")
+                registered = False
+            await asyncio.sleep(BRANCH_HEARTBEAT_SECONDS)
+
+def apply_inventory_changes(body: dict):
+    """
+    Aplica una respuesta de GET /inventory/changes: foto completa o deltas en orden.
+    Stock Independiente: de la Central solo se toma el catálogo (nombre y precio). El stock local se conserva;
+    el de la Central solo sirve de stock inicial para productos nuevos y los eventos 'stock' se ignoran.
+    """
+    global inventory_version
+    if body["mode"] == "snapshot":
+        products = {p["id"]: catalog_product(p, p["stock"]) for p in body["products"]}
+        local_inventory.clear()
+        local_inventory.update(products)
+        broadcast_dashboard_frame(SSE_RESYNC_FRAME) # Inventario completo nuevo: los dashboards lo vuelven a pedir
+        logger.info(f"📦 Catálogo cargado desde la Central (versión {body['version']}, {len(local_inventory)} productos)")
+    else:
+        for event in body["changes"]:
+            product_id = int(event["id"])
+            if event["op"] == "delete":
+                local_inventory.pop(product_id, None)
+            elif event["op"] == "upsert":
+                local_inventory[product_id] = catalog_product(event["product"], event["stock"])
+            else:
+                continue # 'stock': ventas de otras sucursales, NO se sincroniza stock a sucursales
+            publish_product_event(product_id)
+    inventory_version = body["version"]
+
+def catalog_product(data: dict, central_stock: int) -> Product:
+    """Producto con los datos de catálogo de la Central y el stock local (si ya existe en la sucursal)."""
+    current = local_inventory.get(int(data["id"]))
+    return Product(**{**data, "stock": current.stock if current else int(central_stock)})
+
+async def inventory_pull_loop():
+    """Bootstrap desde la foto de la Central y luego deltas por long-poll: el coste sigue a los cambios, no al catálogo."""
+    backoff = INVENTORY_PULL_INTERVAL_SECONDS
+    async with httpx.AsyncClient(timeout=INVENTORY_LONG_POLL_SECONDS + 10.0) as client:
+        while True:
+            try:
+                resp = await client.get(f"{CENTRAL_API_URL}/inventory/changes",
+                                        params={"since": inventory_version, "wait": INVENTORY_LONG_POLL_SECONDS})
+                resp.raise_for_status()
+                apply_inventory_changes(resp.json())
+                backoff = INVENTORY_PULL_INTERVAL_SECONDS
+                if INVENTORY_LONG_POLL_SECONDS <= 0:
+                    await asyncio.sleep(INVENTORY_PULL_INTERVAL_SECONDS)
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudo traer el inventario de la Central: {e}. Reintentando en {backoff:.0f}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 60.0)
+
 # ===== STARTUP: lanzar worker de Redis para procesar cola (si Redis disponible) =====
 @app.on_event("startup")
 async def startup_event():
     # se lanza siempre para estar disponible si el modo cambia a 4
     asyncio.create_task(redis_queue_worker())
+    if BRANCH_REGISTRATION_SECRET:
+        asyncio.create_task(branch_heartbeat_loop())
+    else:
+        logger.warning("⚠️ BRANCH_REGISTRATION_SECRET no definido: la sucursal no se registra en la Central (solo la ve si está en su lista fija BRANCHES).")
+    if INVENTORY_PULL:
+        asyncio.create_task(inventory_pull_loop())
     logger.info("Startup completo - Redis worker lanzado (si Redis está accesible).")
 
 if __name__ == "__main__":
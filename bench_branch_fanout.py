@@ -0,0 +1,69 @@
+"""
+Benchmark: tiempo de una sincronización a N sucursales simuladas (por defecto 500).
+
+Las sucursales son stubs locales (httpx.MockTransport) con una latencia base más jitter; una
+fracción no responde nunca, para comprobar que el plazo por petición acota la sincronización
+completa. Se mide sync_with_branches con distintos cupos de fan-out (SYNC_FANOUT_CONCURRENCY);
+con caídas se sincroniza varias veces seguidas: una vez abiertos sus circuitos, las colgadas no cuestan nada.
+
+Uso:
+    python bench_branch_fanout.py [sucursales] [latencia_ms] [fraccion_caidas]
+"""
+import asyncio
+import logging
+import random
+import sys
+import time
+
+import httpx
+
+import CentralAPI as central
+
+FANOUT_LEVELS = (16, 64, 256)
+
+
+def stub_transport(latency_ms: float, dead: set) -> httpx.MockTransport:
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.host in dead:
+            await asyncio.sleep(3600) # Sucursal colgada: solo la corta el plazo por petición
+        await asyncio.sleep(latency_ms * random.uniform(0.5, 1.5) / 1000)
+        return httpx.Response(200, json={"status": "ok"})
+    return httpx.MockTransport(handler)
+
+
+async def run(branches: int, latency_ms: float, dead_fraction: float, fanout: int, rounds: int = 1) -> list:
+    urls = [f"http://sucursal-{i}:8002" for i in range(branches)]
+    dead = {f"sucursal-{i}" for i in random.sample(range(branches), int(branches * dead_fraction))}
+    central.BRANCHES = []
+    central.refresh_branch_view({url: time.time() for url in urls})
+    central.branch_circuits.clear()
+    central.SYNC_FANOUT_CONCURRENCY = fanout
+    central.init_http_client()
+    await central.http_client.aclose()
+    central.http_client = httpx.AsyncClient(transport=stub_transport(latency_ms, dead))
+    try:
+        elapsed = []
+        for _ in range(rounds):
+            started = time.perf_counter()
+            await central.sync_with_branches("POST", "/sync-sale-history", raw_json='{"sale_id": "bench"}')
+            elapsed.append(time.perf_counter() - started)
+        return elapsed
+    finally:
+        await central.close_http_client()
+
+
+def main():
+    branches = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    latency_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 50.0
+    dead_fraction = float(sys.argv[3]) if len(sys.argv) > 3 else 0.02
+    for name in (central.__name__, "httpx"):
+        logging.getLogger(name).setLevel(logging.CRITICAL) # Sin una línea de log por sucursal
+    print(f"{branches} sucursales, latencia ~{latency_ms:g} ms, plazo por petición {central.SYNC_REQUEST_DEADLINE_SECONDS:g}s")
+    for fanout in FANOUT_LEVELS:
+        healthy, = asyncio.run(run(branches, latency_ms, 0.0, fanout))
+        degraded = asyncio.run(run(branches, latency_ms, dead_fraction, fanout, rounds=central.BRANCH_CB_CONSECUTIVE_FAILURES + 1))
+        print(f"  fan-out {fanout:>4}: {healthy:6.2f} s todas sanas (ideal ~{branches / fanout * latency_ms / 1000:.2f} s) | "
+              f"con {dead_fraction:.0%} caídas: " + " -> ".join(f"{seconds:.2f}" for seconds in degraded) + " s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Benchmark de memoria: idempotencia con una clave por venta vs Bloom filter rotativo.
+
+Inserta N ids con el esquema anterior (SET sale_lock:{sale_id} processed NX EX 3600)
+y con el Bloom filter actual (SETBIT en sale_dedup:{generación}), y compara el
+used_memory de Redis en cada caso. Usa una base de datos aparte (por defecto la 15)
+y la vacía antes y después: NO apuntar a una base con datos reales.
+
+Uso:
+    REDIS_HOST=localhost python bench_idempotency_memory.py [cantidad]
+"""
+import os
+import sys
+import time
+
+import redis
+
+from CentralAPI import DEDUP_BLOOM_BITS, DEDUP_BLOOM_HASHES, DEDUP_FP_RATE, bloom_positions
+
+BENCH_DB = int(os.getenv("REDIS_BENCH_DB", "15"))
+PIPELINE_CHUNK = 10000
+
+
+def used_memory(r: redis.Redis) -> int:
+    time.sleep(0.2) # Deja que el allocator asiente
+    return int(r.info("memory")["used_memory"])
+
+
+def fill_locks(r: redis.Redis, count: int):
+    for start in range(0, count, PIPELINE_CHUNK):
+        pipeline = r.pipeline(transaction=False)
+        for i in range(start, min(start + PIPELINE_CHUNK, count)):
+            pipeline.set(f"sale_lock:sucursal-demo_bench-{i}", "processed", nx=True, ex=3600)
+        pipeline.execute()
+
+
+def fill_bloom(r: redis.Redis, count: int):
+    key = "sale_dedup:bench"
+    for start in range(0, count, PIPELINE_CHUNK):
+        pipeline = r.pipeline(transaction=False)
+        for i in range(start, min(start + PIPELINE_CHUNK, count)):
+            for pos in bloom_positions(f"sucursal-demo_bench-{i}").split(","):
+                pipeline.setbit(key, int(pos), 1)
+        pipeline.execute()
+    r.expire(key, 7200)
+
+
+def measure(r: redis.Redis, fill, count: int) -> int:
+    r.flushdb()
+    before = used_memory(r)
+    fill(r, count)
+    after = used_memory(r)
+    r.flushdb()
+    return after - before
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    print(f"Bloom: {DEDUP_BLOOM_BITS} bits ({DEDUP_BLOOM_BITS / 8 / 1024 ** 2:.1f} MiB por generación), "
+          f"{DEDUP_BLOOM_HASHES} hashes, FP objetivo {DEDUP_FP_RATE:g}")
+    r = redis.Redis(host=os.getenv("REDIS_HOST", "localhost"), port=int(os.getenv("REDIS_PORT", "6379")), db=BENCH_DB)
+    try:
+        r.ping()
+    except redis.ConnectionError as e:
+        print(f"Redis no disponible ({e}); solo se muestran los tamaños teóricos.")
+        return
+
+    locks = measure(r, fill_locks, count)
+    bloom = measure(r, fill_bloom, count)
+    print(f"{'locks por clave':>16}: {locks / 1024 ** 2:8.1f} MiB ({locks / count:6.1f} B/venta)")
+    print(f"{'bloom rotativo':>16}: {bloom / 1024 ** 2:8.1f} MiB ({bloom / count:6.1f} B/venta)")
+    print("  (el Bloom tiene tamaño fijo por ventana: su coste por venta baja al acercarse a DEDUP_EXPECTED_ITEMS)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Microbenchmark: coste de CPU por venta en la ruta caliente de la Central.
+
+Compara la cadena anterior (validar -> model_dump -> re-validar -> model_dump(json)
+-> re-validar en sync_sale_updates -> model_dump_json) contra la ruta tipada actual
+(validar una vez en el borde + JSON serializado una sola vez).
+
+Uso:
+    python bench_sale_pipeline.py [iteraciones]
+"""
+import sys
+import timeit
+from datetime import datetime
+from typing import Optional, Union
+
+from pydantic import BaseModel, field_validator
+
+from CentralAPI import SaleNotification
+
+
+# --- Modelo tal como estaba antes (validador de timestamp original) ---
+class LegacySaleNotification(BaseModel):
+    sale_id: Optional[str] = None
+    branch_id: str
+    product_id: int
+    quantity_sold: int
+    timestamp: Union[datetime, str]
+    money_received: Optional[float] = None
+    total_amount: float
+    change: Optional[float] = None
+
+    @field_validator("timestamp", mode="before")
+    def parse_timestamp(cls, v):
+        if isinstance(v, str):
+            if not v.endswith('Z') and '+' not in v and '-' not in v[10:]:
+                v += 'Z'
+            try:
+                return datetime.fromisoformat(v.replace('Z', '+00:00'))
+            except ValueError:
+                try:
+                    return datetime.strptime(v, '%Y-%m-%dT%H:%M:%S.%f%z')
+                except Exception:
+                    return datetime.now()
+        return v
+
+    class Config:
+        extra = "ignore"
+
+
+PAYLOAD = {
+    "sale_id": "sucursal-demo_2025-11-28T14:03:11.482910",
+    "branch_id": "sucursal-demo",
+    "product_id": 3,
+    "quantity_sold": 2,
+    "timestamp": "2025-11-28T14:03:11.482910",
+    "money_received": 10.0,
+    "total_amount": 6.4,
+    "change": 3.6,
+    "message_id": "6f1c0b1e-1111-4a5b-9c1d-000000000000",
+    "source": "sucursal-demo",
+    "mode": "Fanout",
+}
+
+
+def legacy_pipeline():
+    edge = LegacySaleNotification(**PAYLOAD)                       # FastAPI
+    notification = LegacySaleNotification(**edge.model_dump())     # process_sale_notification
+    stream_json = notification.model_dump_json()                   # historial
+    sync_data = notification.model_dump(mode='json')               # sync_sale_updates(...)
+    LegacySaleNotification(**sync_data)                            # re-parseo en sync_sale_updates
+    return stream_json, sync_data
+
+
+def typed_pipeline():
+    notification = SaleNotification(**PAYLOAD)                     # borde (HTTP o AMQP)
+    return notification.json_payload, notification.json_payload    # historial y sync comparten el JSON
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    results = {}
+    for name, fn in (("anterior", legacy_pipeline), ("tipada", typed_pipeline)):
+        fn() # calentamiento
+        best = min(timeit.repeat(fn, number=iterations, repeat=5))
+        results[name] = best / iterations * 1e6
+        print(f"{name:>9}: {results[name]:8.2f} µs/venta")
+    print(f"  mejora: {results['anterior'] / results['tipada']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
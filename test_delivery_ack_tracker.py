@@ -0,0 +1,75 @@
+"""
+Prueba: DeliveryAckTracker con dos carriles que terminan fuera de orden.
+
+Un mensaje reintentado o rechazado no puede quedar confirmado por el ack múltiple de otro carril
+mientras su handler todavía publica / espera: su ack o nack propio llegaría después con un delivery
+tag desconocido (406 PRECONDITION_FAILED) y el broker cerraría el canal.
+
+Uso:
+    python test_delivery_ack_tracker.py    (o con pytest)
+"""
+import asyncio
+
+from CentralAPI import MESSAGE_ACK, MESSAGE_REJECT, MESSAGE_RETRY, DeliveryAckTracker
+
+
+class FakeMessage:
+    def __init__(self, tag: int, log: list):
+        self.delivery_tag = tag
+        self.log = log
+
+    async def ack(self, multiple: bool = False):
+        self.log.append(("ack", self.delivery_tag, multiple))
+
+    async def nack(self, multiple: bool = False, requeue: bool = True):
+        self.log.append(("nack", self.delivery_tag, requeue))
+
+
+def check_no_tag_settled_twice(log: list):
+    """Simula al broker: un tag ya confirmado (también por un ack múltiple) no se puede volver a confirmar."""
+    settled = set()
+    for action, tag, flag in log:
+        assert tag not in settled, f"delivery tag {tag} confirmado dos veces: {log}"
+        if action == "ack" and flag:
+            settled.update(range(1, tag + 1))
+        else:
+            settled.add(tag)
+
+
+async def two_lanes_out_of_order(failed_outcome: str) -> list:
+    log = []
+
+    async def slow_handler(message):
+        await asyncio.sleep(0.05) # Publicación a la cola de espera (o pausa antes del nack)
+        if failed_outcome == MESSAGE_RETRY:
+            await message.ack()
+        else:
+            await message.nack(requeue=False)
+
+    tracker = DeliveryAckTracker(on_reject=slow_handler, on_retry=slow_handler)
+    first, second = FakeMessage(1, log), FakeMessage(2, log)
+    tracker.track(first)
+    tracker.track(second)
+    lane_a = asyncio.create_task(tracker.settle([first], [failed_outcome]))
+    await asyncio.sleep(0) # El carril A ya está dentro de su handler
+    await tracker.settle([second], [MESSAGE_ACK]) # El carril B termina antes
+    await lane_a
+    return log
+
+
+def test_retry_blocks_multi_ack_until_handler_finishes():
+    log = asyncio.run(two_lanes_out_of_order(MESSAGE_RETRY))
+    assert log == [("ack", 1, False), ("ack", 2, True)], log
+    check_no_tag_settled_twice(log)
+
+
+def test_reject_blocks_multi_ack_until_handler_finishes():
+    log = asyncio.run(two_lanes_out_of_order(MESSAGE_REJECT))
+    assert log == [("nack", 1, False), ("ack", 2, True)], log
+    check_no_tag_settled_twice(log)
+
+
+if __name__ == "__main__":
+    test_retry_blocks_multi_ack_until_handler_finishes()
+    test_reject_blocks_multi_ack_until_handler_finishes()
+    print("OK")
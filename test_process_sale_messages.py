@@ -0,0 +1,57 @@
+"""
+Prueba: process_sale_messages confirma el micro-lote y lanza la sincronización de ventas de prueba
+sin esperarla, pero guardando una referencia fuerte a la tarea hasta que termina (el loop solo guarda
+referencias débiles y una tarea suelta puede ser recolectada a mitad de camino).
+
+Uso:
+    python test_process_sale_messages.py    (o con pytest)
+"""
+import asyncio
+import gc
+
+import CentralAPI
+from CentralAPI import MESSAGE_ACK, SaleNotification
+
+
+def make_notification(sale_id: str) -> SaleNotification:
+    return SaleNotification(
+        sale_id=sale_id, branch_id="TEST-1", product_id=1, quantity_sold=1,
+        timestamp="2026-01-01T00:00:00", total_amount=10.0,
+    )
+
+
+async def ack_does_not_wait_for_sync() -> list:
+    log = []
+    release = asyncio.Event()
+
+    async def fake_commit(notifications):
+        return [], list(notifications)
+
+    async def slow_sync(committed):
+        await release.wait()
+        log.append(("synced", [n.sale_id for n in committed]))
+
+    original_commit, original_sync = CentralAPI.commit_sale_batch, CentralAPI.sync_sales_history_batch
+    CentralAPI.commit_sale_batch, CentralAPI.sync_sales_history_batch = fake_commit, slow_sync
+    try:
+        outcomes = await CentralAPI.process_sale_messages([make_notification("a"), make_notification("b")])
+        log.append(("acked", outcomes))
+        assert len(CentralAPI.sales_sync_tasks) == 1, "la sincronización debe quedar referenciada"
+        gc.collect() # Sin la referencia fuerte, la tarea suspendida podría desaparecer aquí
+        release.set()
+        await asyncio.wait(CentralAPI.sales_sync_tasks, timeout=1)
+        await asyncio.sleep(0) # Deja correr el done_callback que la descarta
+        assert not CentralAPI.sales_sync_tasks, "la tarea terminada debe descartarse"
+    finally:
+        CentralAPI.commit_sale_batch, CentralAPI.sync_sales_history_batch = original_commit, original_sync
+    return log
+
+
+def test_sale_sync_is_tracked_until_done():
+    log = asyncio.run(ack_does_not_wait_for_sync())
+    assert log == [("acked", [MESSAGE_ACK, MESSAGE_ACK]), ("synced", ["a", "b"])], log
+
+
+if __name__ == "__main__":
+    test_sale_sync_is_tracked_until_done()
+    print("OK")